@@ -2,6 +2,7 @@ CREATE EXTENSION IF NOT EXISTS cube;
 CREATE EXTENSION IF NOT EXISTS earthdistance;
 DROP FUNCTION IF EXISTS pr_create_campaigns(int, varchar, varchar, varchar, varchar);
 DROP FUNCTION IF EXISTS pr_crear_serie(int, date, date, date, int);
+DROP FUNCTION IF EXISTS pr_crear_series(int[], date, date, date, int);
 DROP FUNCTION IF EXISTS pr_año_agrario(date);
 DROP FUNCTION IF EXISTS pr_año_agrario(date, int);
 DROP FUNCTION IF EXISTS is_leap(int);
@@ -12,8 +13,10 @@ DROP FUNCTION IF EXISTS pr_campaigns_acum_rainfall(int);
 DROP FUNCTION IF EXISTS pr_campaigns_acum_rainfall(int, int);
 DROP FUNCTION IF EXISTS pr_campaigns_rainfall(int);
 DROP FUNCTION IF EXISTS pr_campaigns_rainfall(int, int);
+DROP FUNCTION IF EXISTS pr_stations_acum_rainfall(int[], int);
 DROP FUNCTION IF EXISTS pr_historic_series(int, varchar);
 DROP FUNCTION IF EXISTS pr_serie_agraria(int, int);
+DROP FUNCTION IF EXISTS pr_actualizar_registro_completo(int[], date);
 
 /* Función que determina si un año es bisiesto. */
 CREATE OR REPLACE FUNCTION is_leap(year integer)
@@ -72,6 +75,19 @@ AS $$
 $$ LANGUAGE SQL;
 
 
+/* Lluvia acumulada de los primeros 365 días de cada campaña completa de las estaciones dadas (ver
+   pr_campaigns_acum_rainfall), una fila por estación y campaña, ordenadas por estación y campaña. */
+CREATE OR REPLACE FUNCTION pr_stations_acum_rainfall(omm_ids int[], mes_fin_de_campaña int default 5)
+RETURNS TABLE(omm_id INT, campaign INT, sums DOUBLE PRECISION[])
+AS $$
+    SELECT estaciones.omm_id, acum.campaign, (array_agg(acum.sum ORDER BY acum.fecha))[1:365]
+    FROM unnest($1) AS estaciones(omm_id)
+    CROSS JOIN LATERAL pr_campaigns_acum_rainfall(estaciones.omm_id, $2) acum
+    GROUP BY estaciones.omm_id, acum.campaign
+    ORDER BY 1, 2
+$$ LANGUAGE SQL;
+
+
 CREATE OR REPLACE FUNCTION pr_crear_serie(omm_id int, fecha_inicio date, fecha_inflexion date, fecha_fin date, year_inflexion int)
 RETURNS TABLE (fecha date, fecha_original date, tmax double precision, tmin double precision, prcp double precision, rad double precision)
 AS $$
@@ -118,6 +134,19 @@ AS $$
 $$ LANGUAGE plpgsql;
 
 
+/* Exporta, en una sola llamada, las series combinadas de todas las campañas completas de una lista de estaciones.
+   Las filas se devuelven ordenadas por estación, campaña y fecha para que el cliente pueda separarlas por año. */
+CREATE OR REPLACE FUNCTION pr_crear_series(omm_ids int[], fecha_inicio date, fecha_inflexion date, fecha_fin date, mes_fin_de_campaña int default 5)
+RETURNS TABLE (omm_id int, year_inflexion int, fecha date, fecha_original date, tmax double precision, tmin double precision, prcp double precision, rad double precision)
+AS $$
+    SELECT e.omm_id, c.pr_year, s.fecha, s.fecha_original, s.tmax, s.tmin, s.prcp, s.rad
+    FROM unnest($1) AS e(omm_id)
+    CROSS JOIN LATERAL pr_campañas_completas(e.omm_id, $5) AS c(pr_year)
+    CROSS JOIN LATERAL pr_crear_serie(e.omm_id, $2, $3, $4, c.pr_year) AS s
+    ORDER BY 1, 2, 3
+$$ LANGUAGE sql;
+
+
 CREATE OR REPLACE FUNCTION pr_serie_agraria(omm_id int, year_agrario int, mes_fin_de_campaña int default 5)
 RETURNS TABLE (fecha date, fecha_original date, tmax double precision, tmin double precision, prcp double precision, rad double precision)
 AS $$
@@ -152,4 +181,31 @@ AS $$
         SELECT fo.fechas_generadas, datos.fecha_original, datos.tmax, datos.tmin, datos.prcp, datos.rad
         FROM datos_ordenados datos LEFT JOIN fechas_ordenadas fo ON fo.row_number = datos.row_number;
     END
-$$ LANGUAGE plpgsql;
\ No newline at end of file
+$$ LANGUAGE plpgsql;
+
+
+/* Reemplaza los registros de estacion_registro_diario_completo cuando es una tabla (ver
+   core/modules/data_updater/impute_script/Incremental.sql) para las estaciones dadas, a partir de fecha_desde (o todo
+   su historial si es NULL). Si omm_ids es NULL se reemplazan los registros de todas las estaciones.
+   Usa la consulta de la vista materializada (ver core/modules/data_updater/impute_script/Schema.sql) pero con un
+   LEFT JOIN en lugar del FULL OUTER JOIN con estacion_registro_diario_imputado: en la vista, las filas que solo están
+   en la tabla imputada toman omm_id y fecha de estacion_registro_diario, es decir NULL, así que ninguna consulta por
+   estación las lee. Aquí se descartan porque no pueden filtrarse por estación ni fecha (se acumularían con cada
+   actualización, ya que el DELETE tampoco las alcanza). */
+CREATE OR REPLACE FUNCTION pr_actualizar_registro_completo(omm_ids int[], fecha_desde date default NULL)
+RETURNS void AS $$
+BEGIN
+    DELETE FROM estacion_registro_diario_completo erdc
+    WHERE (omm_ids IS NULL OR erdc.omm_id = ANY(omm_ids))
+      AND (fecha_desde IS NULL OR erdc.fecha >= fecha_desde);
+
+    INSERT INTO estacion_registro_diario_completo
+    SELECT erd.omm_id, erd.fecha, coalesce(erdi.tmax, erd.tmax) tmax, coalesce(erdi.tmin, erd.tmin) tmin, coalesce(erdi.prcp, erd.prcp) prcp, rad, erd.helio, erd.nub
+    FROM estacion_registro_diario erd
+    LEFT JOIN estacion_registro_diario_imputado erdi ON erdi.omm_id = erd.omm_id AND erdi.fecha = erd.fecha
+    LEFT JOIN estacion_radiacion_diaria rad ON erd.omm_id = rad.omm_id AND erd.fecha = rad.fecha
+    WHERE (omm_ids IS NULL OR erd.omm_id = ANY(omm_ids))
+      AND (fecha_desde IS NULL OR erd.fecha >= fecha_desde)
+    ORDER BY erd.fecha;
+END;
+$$ LANGUAGE plpgsql;
@@ -1,4 +1,4 @@
-from datetime import date, datetime
+from datetime import datetime
 import os
 import csv
 import numpy as np
@@ -43,6 +43,29 @@ class DSSATWthWriter:
 
     @staticmethod
     def write_wth_file(scenario_index, file_rows_content, output_file_path, location, write_original_date=False):
+        """
+        Writes the weather file of a scenario.
+        :param file_rows_content: An iterable of rows whose first row is a header with the variable names, or the
+        scenario columns (see write_wth_columns).
+        :returns A dict with the content written for each variable (see write_wth_columns).
+        """
+        if isinstance(file_rows_content, (np.ndarray, dict)):
+            file_columns = file_rows_content
+        else:
+            file_columns = DSSATWthWriter.__rows_to_columns__(file_rows_content)
+
+        return DSSATWthWriter.write_wth_columns(scenario_index, file_columns, output_file_path, location,
+                                                write_original_date)
+
+    @staticmethod
+    def write_wth_columns(scenario_index, file_columns, output_file_path, location, write_original_date=False):
+        """
+        Columnar version of write_wth_file: dates, TAV/AMP and the file body are computed with whole-array operations.
+        :param file_columns: A structured NumPy array or a dict mapping each variable name to a sequence of values.
+        Dates can be date objects, "%Y-%m-%d" strings or datetime64 values. Missing values (None, NaN or empty
+        strings) are written as 0.
+        :returns A dict mapping each expected variable to a NumPy array, dates are converted to the YYDDD format.
+        """
         lat = float(location['coord_y'])
         lon = float(location['coord_x'])
 
@@ -50,71 +73,49 @@ class DSSATWthWriter:
         var_names = ['SRAD', 'TMAX', 'TMIN', 'RAIN']
 
         _expected_variables = DSSATWthWriter.expected_variables
-        _expected_variables_set = DSSATWthWriter.expected_var_set
         _variables_format = ['%.5d'] + ['%6.1f'] * len(var_names)
         if write_original_date:
             _expected_variables = DSSATWthWriter.expected_variables + ['fecha_original']
-            _expected_variables_set.add('fecha_original')
             _variables_format += ['     !%2.d']
 
+        if isinstance(file_columns, np.ndarray):
+            csv_variables = list(file_columns.dtype.names or [])
+        else:
+            csv_variables = list(file_columns.keys())
+
+        # Check that the header variables match the expected variables.
+        if len(set(_expected_variables).intersection(csv_variables)) != len(_expected_variables):
+            raise RuntimeError("The variables in the weather stream (%s) don't match the expected ones (%s)"
+                               "." % (csv_variables, DSSATWthWriter.expected_variables))
+
+        dates = DSSATWthWriter.__to_dates__(file_columns['fecha'])
+        years = dates.astype('datetime64[Y]')
+        months = dates.astype('datetime64[M]').astype(int) % 12 + 1
+
         csv_content = dict()
-        csv_variables = []
-        months = []
-
-        for r_index, row in enumerate(file_rows_content):
-                if r_index == 0:
-                    # Header
-                    csv_variables = row
-
-                    # Check that the header variables match the expected variables.
-                    if len(_expected_variables_set.intersection(csv_variables)) != len(_expected_variables):
-                        raise RuntimeError("The variables in the weather stream (%s) don't match the expected ones (%s)"
-                                           "." % (csv_variables, DSSATWthWriter.expected_variables))
-
-                    for column in row:
-                        csv_content[column] = []
-
-                else:
-                    for v, value in enumerate(row):
-                        var_name = csv_variables[v]
-
-                        if var_name not in DSSATWthWriter.expected_variables:
-                            continue
-
-                        if var_name == 'fecha':
-                            dt = value
-                            if not isinstance(value, date):
-                                dt = datetime.strptime(value, '%Y-%m-%d')
-                            csv_content[var_name].append(int(dt.strftime("%y%j")))
-                            months.append(dt.month)
-                        elif var_name == 'fecha_original':
-                            dt = value
-                            if not isinstance(value, date):
-                                dt = datetime.strptime(value, '%Y-%m-%d')
-                            csv_content[var_name].append(int(dt.strftime("%Y%m%d")))
-                        else:
-                            csv_content[var_name].append(float(value or 0))
+        csv_content['fecha'] = (years.astype(int) + 1970) % 100 * 1000 + (dates - years).astype(int) + 1
+        for var_name in DSSATWthWriter.expected_variables[1:]:
+            csv_content[var_name] = DSSATWthWriter.__to_floats__(file_columns[var_name])
+
+        if write_original_date:
+            original_dates = DSSATWthWriter.__to_dates__(file_columns['fecha_original'])
+            original_months = original_dates.astype('datetime64[M]')
+            csv_content['fecha_original'] = (original_dates.astype('datetime64[Y]').astype(int) + 1970) * 10000 + \
+                (original_months.astype(int) % 12 + 1) * 100 + (original_dates - original_months).astype(int) + 1
 
         nt = len(csv_content['fecha'])
-        tmin, tmax = np.array(csv_content['tmin']), np.array(csv_content['tmax'])
-        months = np.array(months)
+        tmin, tmax = csv_content['tmin'], csv_content['tmax']
         tav = float(0.5 * (tmin.sum() + tmax.sum()) / nt)  # function of scen
 
         # compute amp
         month_averages = []
         for j in range(1, 13):
-            month_indexes = np.where(months == j)[0]
-            t = 0.5 * (tmin[month_indexes].sum() + tmax[month_indexes].sum()) / len(month_indexes)
+            month_days = months == j
+            t = 0.5 * (tmin[month_days].sum() + tmax[month_days].sum()) / month_days.sum()
             month_averages.append(t)
         amp = max(month_averages) - min(month_averages)
 
-        data = None
-        for index, v in enumerate(DSSATWthWriter.expected_variables):
-            if index == 0:
-                data = (csv_content[v], )
-                continue
-            data = data + (csv_content[v], )
-        data = np.column_stack(data)
+        data = np.column_stack([csv_content[v] for v in _expected_variables])
 
         filename = os.path.join(output_file_path, ('WTH' + str(scenario_index).zfill(5) + '.WTH'))
 
@@ -130,13 +131,55 @@ class DSSATWthWriter:
         if os.path.exists(filename):
             raise RuntimeError('Attempted to write a weather file that was already created (%s).\n'
                                'Increase the weather grid resolution to avoid collisions.' % filename)
-        # write body
+        # write header and body with a single write
+        content = asbytes(head) + DSSATWthWriter.encode_wth_body(data, _variables_format)
         with open(filename, 'wb') as f:
-            f.write(asbytes(head))
-            np.savetxt(f, data, fmt=_variables_format, delimiter='')
+            f.write(content)
 
         return csv_content
 
+    @staticmethod
+    def encode_wth_body(data, variables_format):
+        """
+        Renders the rows of a weather file into a bytes buffer. The output is the same that np.savetxt(f, data,
+        fmt=variables_format, delimiter='') would produce, but the whole block is formatted with a single string
+        interpolation instead of one per row.
+        :param data: A 2D array with one row per day.
+        :param variables_format: The printf-style format of each column.
+        """
+        if len(data) == 0:
+            return b''
+        row_format = ''.join(variables_format) + '\n'
+        return asbytes((row_format * len(data)) % tuple(data.ravel().tolist()))
+
+    @staticmethod
+    def __rows_to_columns__(file_rows_content):
+        rows = iter(file_rows_content)
+        # Header
+        csv_variables = next(rows, [])
+        columns = list(zip(*rows))
+
+        if len(columns) == 0:
+            columns = [()] * len(csv_variables)
+        return dict(zip(csv_variables, columns))
+
+    @staticmethod
+    def __to_dates__(values):
+        if isinstance(values, np.ndarray) and np.issubdtype(values.dtype, np.datetime64):
+            return values.astype('datetime64[D]')
+        return np.asarray(values, dtype='datetime64[D]')
+
+    @staticmethod
+    def __to_floats__(values):
+        if isinstance(values, np.ma.MaskedArray):
+            values = values.astype('f8').filled(np.nan)
+        try:
+            values = np.asarray(values, dtype='f8')
+        except ValueError:
+            # Empty strings (e.g. CSV files with missing values).
+            values = np.array([v or np.nan for v in values], dtype='f8')
+        return np.where(np.isnan(values), 0., values)
+
     @staticmethod
     def extract_rainfall(rainfall_data, csv_content, forecast_date, scen_name):
         # Calculate forecast date as time difference (in days).
@@ -0,0 +1,63 @@
+__author__ = 'Federico Schmidt'
+
+
+class CSVBodyStream:
+    """
+    Read-only file-like object over the chunks of a CSV payload (e.g. a streamed HTTP response) that skips the header
+    line and the trailing whitespace. Used to feed a COPY ... FROM STDIN statement without holding the whole payload
+    in memory.
+    """
+    def __init__(self, chunks, skip_header=True):
+        """
+        :param chunks: An iterable of bytes.
+        :param skip_header: Whether to skip the first line or not.
+        """
+        self.chunks = iter(chunks)
+        self.skip_header = skip_header
+        self.buffer = b''
+        # Whitespace is held back until some data comes after it, since the trailing whitespace is dropped.
+        self.pending_whitespace = b''
+        self.finished = False
+        # Amount of bytes of data (excluding the header).
+        self.data_size = 0
+
+    def read(self, size=-1):
+        while not self.finished and (size is None or size < 0 or len(self.buffer) < size):
+            self.__next_chunk__()
+
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while not self.finished and b'\n' not in self.buffer:
+            self.__next_chunk__()
+
+        line_end = self.buffer.find(b'\n') + 1
+        if line_end == 0:
+            line_end = len(self.buffer)
+        if size is not None and 0 <= size < line_end:
+            line_end = size
+        line, self.buffer = self.buffer[:line_end], self.buffer[line_end:]
+        return line
+
+    def __next_chunk__(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.finished = True
+            return
+
+        if self.skip_header:
+            header_end = chunk.find(b'\n')
+            if header_end < 0:
+                # The header continues in the next chunk.
+                return
+            chunk = chunk[header_end + 1:]
+            self.skip_header = False
+
+        chunk = self.pending_whitespace + chunk
+        data = chunk.rstrip()
+        self.pending_whitespace = chunk[len(data):]
+        self.buffer += data
+        self.data_size += len(data)
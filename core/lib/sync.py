@@ -1,32 +1,37 @@
 __author__ = 'Federico Schmidt'
 
+import queue
 from contextlib import contextmanager
-from threading import RLock, Semaphore
+from threading import RLock, Semaphore, Thread
 
 
 class PrioritizedRWLock(object):
     """
     Read-write lock. Writers go first, readers can read all at the same time.
-    Writers access order is determined by priority.
+    Writers (and waiting readers) access order is determined by priority.
 
     Based on: https://hdknr.github.io/docs/django/modules/django/utils/synch.html#RWLock
     """
     def __init__(self):
         self.inner_lock = RLock()
-        self.read_lock = Semaphore(0)
         self.active_readers = 0
         self.waiting_readers = 0
+        self.queued_readers = dict()
         self.active_writers = 0
         self.queued_writers = dict()
 
-    def acquire_read(self):
-        with self.inner_lock:
-            if self.active_writers == 0 and len(self.queued_writers) == 0:
-                self.active_readers += 1
-                self.read_lock.release()
-            else:
-                self.waiting_readers += 1
-        self.read_lock.acquire()
+    def acquire_read(self, priority=0):
+        self.inner_lock.acquire()
+        if self.__can_read__():
+            self.active_readers += 1
+            self.inner_lock.release()
+        else:
+            # Queue reader with it's own lock.
+            new_lock = self.__enqueue__(self.queued_readers, priority)
+            self.waiting_readers += 1
+            # The inner lock is released before locking the reader, otherwise we could end up with a deadlock.
+            self.inner_lock.release()
+            new_lock.acquire()
 
     def acquire_write(self, priority=0):
         self.inner_lock.acquire()
@@ -36,12 +41,7 @@ class PrioritizedRWLock(object):
             self.inner_lock.release()
         else:
             # Queue writer with it's own lock.
-            new_lock = Semaphore(0)
-            # Enqueue writer.
-            if priority in self.queued_writers:
-                self.queued_writers[priority].append(new_lock)
-            else:
-                self.queued_writers[priority] = [new_lock]
+            new_lock = self.__enqueue__(self.queued_writers, priority)
             # We must release the inner lock before locking the writer, otherwise we could end up with a deadlock.
             self.inner_lock.release()
             # Calling new_lock.acquire() will lock the writer.
@@ -59,33 +59,60 @@ class PrioritizedRWLock(object):
             if len(self.queued_writers) != 0:
                 # Writers go first, unlock the most prioritized writer.
                 self.__unlock_writer__()
-            elif self.waiting_readers != 0:
-                # Release readers lock.
-                for i in range(0, self.waiting_readers):
-                    self.read_lock.release()
-                # Update active and waiting readers count.
-                self.active_readers += self.waiting_readers
-                self.waiting_readers = 0
+            else:
+                # Release every waiting reader.
+                while self.waiting_readers != 0:
+                    self.__unlock_reader__()
 
-    def __unlock_writer__(self):
+    def __can_read__(self):
+        return self.active_writers == 0 and len(self.queued_writers) == 0
+
+    @staticmethod
+    def __enqueue__(queue, priority):
         """
-        Releases the lock on the writer with the highest priority inside the queued_writers dict.
+        Adds a lock to the group of the given priority inside a queue (queued_writers or queued_readers).
+        :returns The new lock, which is locked.
+        """
+        new_lock = Semaphore(0)
+        if priority in queue:
+            queue[priority].append(new_lock)
+        else:
+            queue[priority] = [new_lock]
+        return new_lock
+
+    @staticmethod
+    def __dequeue__(queue):
+        """
+        Releases the lock with the highest priority inside a queue (queued_writers or queued_readers).
 
-        Priority is determined by sorting the dictionary's keys in descending order. If more than one writer with max
+        Priority is determined by sorting the dictionary's keys in descending order. If more than one lock with max
          priority is found, the order is FIFO.
         """
+        highest_priority = sorted(queue, reverse=True)[0]
+        queue[highest_priority].pop(0).release()
+
+        if len(queue[highest_priority]) == 0:
+            # Remove the highest priority section for it has no more locks waiting.
+            del queue[highest_priority]
+
+    def __unlock_writer__(self):
+        """
+        Releases the lock on the writer with the highest priority inside the queued_writers dict.
+        """
         self.active_writers += 1
-        # Release a writer inside the highest priority group.
-        highest_priority = sorted(self.queued_writers, reverse=True)[0]
-        self.queued_writers[highest_priority].pop(0).release()
+        self.__dequeue__(self.queued_writers)
 
-        if len(self.queued_writers[highest_priority]) == 0:
-            # Remove the highest priority section for it has no more writers waiting.
-            del self.queued_writers[highest_priority]
+    def __unlock_reader__(self):
+        """
+        Releases the lock on the reader with the highest priority inside the queued_readers dict.
+        """
+        self.active_readers += 1
+        self.waiting_readers -= 1
+        self.__dequeue__(self.queued_readers)
 
     @contextmanager
-    def reader(self):
-        self.acquire_read()
+    def reader(self, priority=0):
+        self.acquire_read(priority)
         try:
             yield
         finally:
@@ -110,19 +137,11 @@ class JobsLock(PrioritizedRWLock):
         super(JobsLock, self).__init__()
         self.max_concurrent_readers = max_parallel_tasks
 
-    def acquire_read(self):
+    def __can_read__(self):
         """
         Readers (non blocking jobs) are restricted to a max parallel amount.
-        :return:
         """
-        with self.inner_lock:
-            if self.active_writers == 0 and len(self.queued_writers) == 0 and \
-               self.active_readers < self.max_concurrent_readers:
-                self.active_readers += 1
-                self.read_lock.release()
-            else:
-                self.waiting_readers += 1
-        self.read_lock.acquire()
+        return super(JobsLock, self).__can_read__() and self.active_readers < self.max_concurrent_readers
 
     def release_write(self):
         with self.inner_lock:
@@ -130,13 +149,10 @@ class JobsLock(PrioritizedRWLock):
             if len(self.queued_writers) != 0:
                 # Writers go first, unlock the most prioritized writer.
                 self.__unlock_writer__()
-            elif self.waiting_readers != 0:
-                # Release readers lock.
-                for i in range(0, min(self.waiting_readers, self.max_concurrent_readers)):
-                    self.read_lock.release()
-                    # Update active and waiting readers count.
-                    self.active_readers += 1
-                    self.waiting_readers -= 1
+            else:
+                # Release the most prioritized readers.
+                while self.waiting_readers != 0 and self.active_readers < self.max_concurrent_readers:
+                    self.__unlock_reader__()
 
     def release_read(self):
         with self.inner_lock:
@@ -145,15 +161,81 @@ class JobsLock(PrioritizedRWLock):
                 if self.active_readers == 0:
                     self.__unlock_writer__()
             elif self.waiting_readers > 0:
-                # Release a reader.
-                self.read_lock.release()
-                # Update active and waiting readers count.
-                self.active_readers += 1
-                self.waiting_readers -= 1
+                # Release the most prioritized reader.
+                self.__unlock_reader__()
 
     # Create aliases for the reader and writer context managers.
-    def parallel_job(self):
-        return self.reader()
+    def parallel_job(self, priority=0):
+        return self.reader(priority)
 
     def blocking_job(self, priority=0):
         return self.writer(priority)
+
+
+class WritersPipeline(object):
+    """
+    Hands items from a producer thread to a pool of writer threads through a bounded queue, so the producer is blocked
+    (and the memory used by pending items is bounded) when the writers are slower. Subclasses implement write, which
+    is called by the writers with each item. When a writer fails the remaining items are discarded and the first error
+    is raised to the producer. Must be used as a context manager, the writers are stopped (and their errors raised)
+    when the context exits.
+    """
+    def __init__(self, writers=1, max_pending=2, name='writer'):
+        """
+        :param writers: Amount of writer threads.
+        :param max_pending: Maximum amount of items waiting for the writers.
+        :param name: Prefix of the writer threads names.
+        """
+        if writers < 1:
+            raise RuntimeError('Invalid amount of writers: %s.' % writers)
+
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.writers = [Thread(target=self.__run_writer__, name='%s_%d' % (name, i), daemon=True)
+                        for i in range(writers)]
+        self.errors = []
+
+    def __enter__(self):
+        for writer in self.writers:
+            writer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for _ in self.writers:
+            self.queue.put(None)
+        for writer in self.writers:
+            writer.join()
+
+        if exc_type is None and len(self.errors) > 0:
+            raise self.errors[0]
+
+    def enqueue(self, item):
+        """
+        Queues an item to be written, blocks while the queue is full.
+        :raise Exception: The first error raised by a writer, if any.
+        """
+        while True:
+            if len(self.errors) > 0:
+                raise self.errors[0]
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, item):
+        raise NotImplementedError()
+
+    def __run_writer__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            if len(self.errors) > 0:
+                # A writer failed, drain the queue so the producer isn't blocked.
+                continue
+
+            try:
+                self.write(item)
+            except Exception as e:
+                self.errors.append(e)
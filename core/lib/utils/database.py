@@ -1,9 +1,17 @@
 import os
+import time
+import threading
 import psycopg2
+import psycopg2.extensions
 import pymongo
+from contextlib import contextmanager
 
 __author__ = 'Federico Schmidt'
 
+# Field of the yield database documents holding the (UTC) time they became ready to be synchronized with the frontend
+# database (see core.modules.data_updater.sync.YieldDatabaseSync).
+SYNC_TIMESTAMP_FIELD = 'sync_timestamp'
+
 
 class DatabaseUtils:
 
@@ -38,6 +46,25 @@ class DatabaseUtils:
         except Exception as e:
             raise RuntimeError('Failed to create database connection "%s". Reason: "%s".' % (conn_name, str(e).strip()))
 
+    @staticmethod
+    def create_postgresql_pool(conn_dictionary, config_path='.'):
+        """
+        Creates a pool of PostgreSQL connections. The pool size is taken from the "pool_size" property of the
+        connection dictionary (defaults to 10 connections).
+        """
+        # Open the first connection right away, so an invalid configuration fails at load time.
+        first_connection = DatabaseUtils.connect_postgresql(conn_dictionary, config_path)
+        max_connections = conn_dictionary.get('pool_size', 10)
+
+        if (not isinstance(max_connections, int)) or max_connections < 1:
+            raise RuntimeError('Invalid pool_size value (%s) for database connection "%s".' %
+                               (max_connections, conn_dictionary['name']))
+
+        pool = PostgreSQLConnectionPool(lambda: DatabaseUtils.connect_postgresql(conn_dictionary, config_path),
+                                        max_connections=max_connections)
+        pool.checkin(first_connection, release_slot=False)
+        return pool
+
     @staticmethod
     def connect_mongodb(conn_dictionary, config_path='.'):
         conn_dictionary = DatabaseUtils.__validate_connection_dict__(conn_dictionary)
@@ -94,3 +121,104 @@ class DatabaseUtils:
             return None
         with open(pwd_file_path, mode='r') as f:
             return f.read()
+
+
+class PostgreSQLConnectionPool:
+    """
+    A bounded, thread safe pool of PostgreSQL connections.
+
+    At most max_connections connections are checked out at the same time, any other thread calling checkout blocks
+    until a connection is returned. Idle connections are checked before being handed out and replaced if they were
+    closed or broken.
+    """
+
+    def __init__(self, connect, max_connections=10, checkout_timeout=None, health_check_interval=30):
+        """
+        :param connect: A callable that opens a new connection.
+        :param max_connections: Maximum amount of connections that can be checked out at the same time.
+        :param checkout_timeout: Seconds to wait for a free connection (None waits forever).
+        :param health_check_interval: Connections idle for more than this amount of seconds are tested with a query
+        before being handed out.
+        """
+        self.connect = connect
+        self.max_connections = max_connections
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.inner_lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_connections)
+        # Idle connections as (connection, returned at) tuples.
+        self.idle_connections = []
+
+    def checkout(self):
+        if not self.slots.acquire(timeout=self.checkout_timeout):
+            raise RuntimeError('Timed out waiting for a free database connection (pool size: %d).' %
+                               self.max_connections)
+        try:
+            while True:
+                with self.inner_lock:
+                    if len(self.idle_connections) == 0:
+                        break
+                    conn, returned_at = self.idle_connections.pop()
+
+                if self.__is_healthy__(conn, returned_at):
+                    return conn
+                self.__close__(conn)
+
+            return self.connect()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def checkin(self, conn, release_slot=True):
+        try:
+            if not conn.closed:
+                # Don't leave open transactions (or locks) on connections that are going to be reused.
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+
+                with self.inner_lock:
+                    self.idle_connections.append((conn, time.time()))
+        except psycopg2.Error:
+            self.__close__(conn)
+        finally:
+            if release_slot:
+                self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def close_all(self):
+        with self.inner_lock:
+            idle_connections = self.idle_connections
+            self.idle_connections = []
+
+        for conn, _ in idle_connections:
+            self.__close__(conn)
+
+    def __is_healthy__(self, conn, returned_at):
+        if conn.closed:
+            return False
+
+        if time.time() - returned_at < self.health_check_interval:
+            return True
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def __close__(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
@@ -25,3 +25,9 @@ class Location(DotDict):
         v = copy.deepcopy(self.__dict__)
         del v['id']
         return v
+
+    def fingerprint(self):
+        """
+        :returns A hash of the persistent view, used to skip the database update of locations that didn't change.
+        """
+        return xxh64(repr(sorted(self.persistent_view().items())).encode('utf8')).hexdigest()
@@ -16,24 +16,27 @@ class CheckWeatherDB(BaseJob):
             raise RuntimeError('No weather database connection was provided. '
                                'Plase provide one under the "weather_db" key.')
 
-        wth_db_connection = self.system_config.database['weather_db']
-        cursor = wth_db_connection.cursor()
-
-        cursor.execute("SELECT tablename FROM pg_tables WHERE schemaname = 'public'")
-        tables_set = {r[0] for r in cursor}
-
-        if self.needed_tables & tables_set != self.needed_tables:
-            table_diff = list(self.needed_tables - tables_set)
-            raise RuntimeError('Weather database schema has missing tables: %s. '
-                               'Consider running setup.sh again.' % table_diff)
-
-        cursor.execute("SELECT relname FROM pg_class WHERE relkind = 'm'")
-        materialized_views_set = {r[0] for r in cursor}
-
-        if self.needed_materialized_views & materialized_views_set != self.needed_materialized_views:
-            views_diff = list(self.needed_materialized_views - materialized_views_set)
-            raise RuntimeError('Weather database schema has missing materialized views: %s. '
-                               'Consider running setup.sh again.' % views_diff)
+        with self.system_config.database['weather_db'].connection() as wth_db_connection:
+            cursor = wth_db_connection.cursor()
+
+            cursor.execute("SELECT tablename FROM pg_tables WHERE schemaname = 'public'")
+            tables_set = {r[0] for r in cursor}
+
+            if self.needed_tables & tables_set != self.needed_tables:
+                table_diff = list(self.needed_tables - tables_set)
+                raise RuntimeError('Weather database schema has missing tables: %s. '
+                                   'Consider running setup.sh again.' % table_diff)
+
+            cursor.execute("SELECT relname FROM pg_class WHERE relkind = 'm'")
+            materialized_views_set = {r[0] for r in cursor}
+
+            # Materialized views can be replaced with tables that are updated incrementally (see
+            # core/modules/data_updater/impute_script/Incremental.sql).
+            materialized_views_set |= tables_set
+            if self.needed_materialized_views & materialized_views_set != self.needed_materialized_views:
+                views_diff = list(self.needed_materialized_views - materialized_views_set)
+                raise RuntimeError('Weather database schema has missing materialized views: %s. '
+                                   'Consider running setup.sh again.' % views_diff)
 
 
 class CheckYieldDB(BaseJob):
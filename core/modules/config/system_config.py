@@ -80,6 +80,7 @@ class SystemConfiguration(DotDict):
         self.weather_stations_ids = set()
         self.alias_dict = None
         self.max_parallelism = 1
+        self.psims_slots = 1
         self.jobs_lock = None
         self.observer = None
 
@@ -95,6 +96,11 @@ class SystemConfiguration(DotDict):
             if (not isinstance(max_parallelism, int)) or (max_parallelism < 1):
                 raise RuntimeError('Invalid max_parallelism value (%s).' % max_parallelism)
 
+        if 'psims_slots' in system_config_yaml:
+            psims_slots = system_config_yaml['psims_slots']
+            if (not isinstance(psims_slots, int)) or (psims_slots < 1):
+                raise RuntimeError('Invalid psims_slots value (%s).' % psims_slots)
+
         config_object.system_config_yaml = system_config_yaml  # This will be used by forecasts to inherit the global config.
         # Update this class __dict__ property to add the properties defined in the config yaml.
         config_object.update(system_config_yaml)
@@ -120,7 +126,7 @@ class SystemConfiguration(DotDict):
             properties['name'] = db_conn
 
             if properties['type'] == 'postgresql':
-                connection = DatabaseUtils.connect_postgresql(properties, config_object.config_path)
+                connection = DatabaseUtils.create_postgresql_pool(properties, config_object.config_path)
             elif properties['type'] == 'mongodb':
                 connection = DatabaseUtils.connect_mongodb(properties, config_object.config_path)
             else:
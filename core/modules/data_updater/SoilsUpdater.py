@@ -1,5 +1,7 @@
+from datetime import datetime
 from core.lib.jobs.base import BaseJob
 from core.lib.jobs.monitor import ProgressMonitor, JOB_STATUS_WAITING, JOB_STATUS_RUNNING
+from core.lib.utils.database import SYNC_TIMESTAMP_FIELD
 from core.modules.config.priority import UPDATE_DB_DATA
 from core.modules.simulations_manager.soil.SoilDAO import SoilDAO, load_soils, soils_dict
 import logging
@@ -17,7 +19,7 @@ class SoilsUpdater(BaseJob):
     def run(self):
         logging.info('Running soils update.')
 
-        # Reload Soils
+        # Reload soils (this rebuilds the soils catalog if the soil files changed).
         soils_dict.clear()
         load_soils()
 
@@ -31,38 +33,19 @@ class SoilsUpdater(BaseJob):
             self.progress_monitor.update_progress(job_status=JOB_STATUS_RUNNING)
 
             for pm_actual_value, (soil_name, soil_file_name) in enumerate(iter(soils_dict.items()), 1):
-                soil_json = SoilDAO.get_soil(soil_name)['soils'][0]
-                soil_id = soil_json['soil_id']
-                soil_layers = soil_json['soilLayer']
-                soil_metrics = self.calculate_metrics(soil_layers)
+                soil_id = SoilDAO.get_soil(soil_name)['soils'][0]['soil_id']
+                # Soils are cached along with their metrics, only the modified soil files are read again.
+                soil_metrics = SoilDAO.get_metrics(soil_name)
                 # Update (or insert) soils.
-                self.db['soils'].update_one({'_id':soil_id}, {'$set':{'metrics': soil_metrics}}, upsert=True)
+                self.db['soils'].update_one({'_id':soil_id}, {
+                    '$set': {'metrics': soil_metrics},
+                    '$setOnInsert': {SYNC_TIMESTAMP_FIELD: datetime.utcnow()}
+                }, upsert=True)
                 # Update progress information.
                 self.progress_monitor.update_progress(new_value=pm_actual_value)
 
         logging.info('Updated (or Inserted) %s soils.' % len(soils_dict))
 
-
     @staticmethod
     def calculate_metrics(soil_layers):
-        prev_layer_depth = 0
-        wilting_point = 0
-        field_capacity = 0
-        field_saturation = 0
-
-        for layer in soil_layers:
-            layer_depth = int(layer['sllb']) * 10
-            layer_depth_diff = layer_depth - prev_layer_depth
-
-            wilting_point += float(layer['slll']) * layer_depth_diff
-            field_capacity += float(layer['sldul']) * layer_depth_diff
-            field_saturation += float(layer['slsat']) * layer_depth_diff
-
-            prev_layer_depth = layer_depth
-
-        return {
-            'wilting_point': wilting_point,
-            'field_capacity': field_capacity,
-            'field_saturation': field_saturation,
-            'max_available_water': field_capacity - wilting_point
-        }
+        return SoilDAO.calculate_metrics(soil_layers)
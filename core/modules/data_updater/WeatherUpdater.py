@@ -1,25 +1,36 @@
+import concurrent.futures
+import itertools
 import logging
+import threading
 import numpy as np
+from pymongo import UpdateOne
 from core.lib.utils.log import log_format_exception
 from core.lib.jobs.monitor import NullMonitor, ProgressMonitor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from core.modules.config.priority import UPDATE_DB_DATA, UPDATE_MAX_WEATHER_DATES, UPDATE_RAINFALL_QUANTILES
 from core.lib.jobs.monitor import JOB_STATUS_WAITING, JOB_STATUS_RUNNING
-from core.lib.utils.database import DatabaseUtils
+from core.lib.utils.database import DatabaseUtils, SYNC_TIMESTAMP_FIELD
 from datetime import datetime, timedelta
 from core.lib.utils.extended_collections import group_by, DotDict
-import io
+from core.lib.io.stream import CSVBodyStream
 from core.modules.data_updater.impute import RunImputation
+from core.modules.simulations_manager.weather.WeatherScenarioCache import WeatherScenarioCache
 
 __author__ = 'Federico Schmidt'
 
 
 class WeatherUpdater:
+    # Size of the chunks read from the weather update API and sent to the database.
+    copy_buffer_size = 64 * 1024
+
     def __init__(self, system_config):
         self.system_config = system_config
-        self.wth_db = None
         self.weather_stations_ids = set()
         self.wth_max_date = DotDict()
+        self.api_session = None
+        self.api_session_lock = threading.Lock()
 
     def add_weather_station_id(self, omm_id):
         try:
@@ -77,50 +88,66 @@ class WeatherUpdater:
             request_groups = group_by(stations_max_data_date, lambda x: x[1])
 
             stations_updated = set()
+            # (stations, first new date) of each batch of records inserted.
+            inserted_records = []
             n_stations_updated = 0
             cursor = None
+            wth_db_pool = self.system_config.database['weather_db']
+            wth_db = wth_db_pool.checkout()
 
             try:
-                wth_db = self.system_config.database['weather_db']
                 cursor = wth_db.cursor()
                 cursor.execute('BEGIN TRANSACTION')
 
-                for min_date, omm_ids in request_groups.items():
-                    stations_ids = {omm_id[0] for omm_id in omm_ids}
-
-                    n_stations_updated += len(stations_ids)
-
-                    str_ids = {str(omm_id) for omm_id in stations_ids}
-                    req_params['omm_ids'] = ','.join(str_ids)
-                    req_params['min_date'] = min_date + timedelta(days=1)
-
-                    response = requests.get('%(url)s?login=%(user)s&password=%(password)s'
-                                            '&tabla=%(table)s&fecha_desde=%(min_date)s&omm_id=%(omm_ids)s' % req_params)
-
-                    if not response.ok:
-                        raise RuntimeError('API request failed (status: %s). Reason: %s.' %
-                                           (response.status_code, response.reason))
-
-                    if 'text/csv' not in response.headers['content-type']:
-                        raise RuntimeError('Wrong response type in update API: %s.' % response.headers['content-type'])
-
-                    update_data = response.content.decode('utf8').strip().split('\n')
-
-                    progress_monitor.update_progress(new_value=n_stations_updated)
-
-                    # Check if the imputation should be forced.
-                    if self.system_config.system_config_yaml.get('force_imputation', False):
-                        stations_updated |= self.weather_stations_ids
-
-                    if len(update_data) < 2:
-                        continue
-
-                    header = update_data[0].split('\t')
-                    update_data = io.StringIO('\n'.join(update_data[1:]))
-
-                    # Insert new data into the database.
-                    cursor.copy_from(update_data, 'estacion_registro_diario')
-                    stations_updated |= stations_ids  # Extend set.
+                max_workers = int(api_config.get('max_workers', 4))
+                with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    api_requests = {}
+
+                    for min_date, omm_ids in request_groups.items():
+                        stations_ids = {omm_id[0] for omm_id in omm_ids}
+
+                        str_ids = {str(omm_id) for omm_id in stations_ids}
+                        group_params = dict(req_params, omm_ids=','.join(str_ids),
+                                            min_date=min_date + timedelta(days=1))
+
+                        url = '%(url)s?login=%(user)s&password=%(password)s' \
+                              '&tabla=%(table)s&fecha_desde=%(min_date)s&omm_id=%(omm_ids)s' % group_params
+                        request = executor.submit(self.__fetch_update__, url, api_config, max_workers)
+                        api_requests[request] = (stations_ids, group_params['min_date'])
+
+                    try:
+                        # Requests are sent concurrently, their data is inserted as they complete.
+                        for request in concurrent.futures.as_completed(api_requests):
+                            stations_ids, first_date = api_requests[request]
+                            response = request.result()
+
+                            n_stations_updated += len(stations_ids)
+                            progress_monitor.update_progress(new_value=n_stations_updated)
+
+                            # Check if the imputation should be forced.
+                            if self.system_config.system_config_yaml.get('force_imputation', False):
+                                stations_updated |= self.weather_stations_ids
+
+                            # Insert new data into the database, streaming the response body (without the header).
+                            update_data = CSVBodyStream(response.iter_content(chunk_size=self.copy_buffer_size))
+                            try:
+                                cursor.copy_expert("COPY estacion_registro_diario FROM STDIN "
+                                                   "WITH (FORMAT text, ENCODING 'UTF8')", update_data,
+                                                   size=self.copy_buffer_size)
+                            finally:
+                                response.close()
+
+                            if update_data.data_size == 0:
+                                continue
+
+                            stations_updated |= stations_ids  # Extend set.
+                            inserted_records.append((stations_ids, first_date))
+                    except:
+                        for request in api_requests:
+                            if not request.cancel() and not request.exception():
+                                # Release the connection of the responses that won't be read.
+                                request.result().close()
+                        raise
 
                 if len(stations_updated) > 0:
                     cursor.execute("COMMIT")
@@ -133,10 +160,16 @@ class WeatherUpdater:
                     else:
                         ret_val = 0
 
+                    # The imputation may change any record of the imputed stations, the rest of the stations only
+                    # changed from the first date inserted.
+                    updated_stations = [(sorted(stations_to_impute), None)] if len(stations_to_impute) > 0 else []
+                    updated_stations += [(sorted(ids - stations_to_impute), min_date)
+                                         for ids, min_date in inserted_records if len(ids - stations_to_impute) > 0]
+
                     pm = ProgressMonitor()
                     progress_monitor.add_subjob(pm, 'Refresh materialized view')
                     # Refresh materialized view.
-                    self.refresh_view(pm)
+                    self.refresh_view(pm, wth_db_connection=wth_db, updated_stations=updated_stations)
 
                     if ret_val == 0:
                         # Update max dates again.
@@ -161,8 +194,37 @@ class WeatherUpdater:
             finally:
                 if cursor:
                     cursor.close()
+                wth_db_pool.checkin(wth_db)
         return 1
 
+    def __fetch_update__(self, url, api_config, max_workers):
+        """
+        Requests new weather data to the update API using a pooled session (with keep-alive connections and retries).
+        :returns The API response.
+        """
+        with self.api_session_lock:
+            if not self.api_session:
+                retries = Retry(total=int(api_config.get('retries', 3)), backoff_factor=1,
+                                status_forcelist=[500, 502, 503, 504])
+                adapter = HTTPAdapter(pool_maxsize=max_workers, max_retries=retries)
+
+                self.api_session = requests.Session()
+                self.api_session.mount('http://', adapter)
+                self.api_session.mount('https://', adapter)
+
+        # The body is streamed into the database (see update_weather_db).
+        response = self.api_session.get(url, timeout=api_config.get('timeout', 120), stream=True)
+
+        if not response.ok:
+            response.close()
+            raise RuntimeError('API request failed (status: %s). Reason: %s.' %
+                               (response.status_code, response.reason))
+
+        if 'text/csv' not in response.headers['content-type']:
+            response.close()
+            raise RuntimeError('Wrong response type in update API: %s.' % response.headers['content-type'])
+        return response
+
     def update_max_dates(self, progress_monitor=None, run_blocking=True):
         logging.getLogger().info('Running weather series max date update.')
 
@@ -184,9 +246,6 @@ class WeatherUpdater:
 
     def __update_max_dates__(self, progress_monitor=None):
         try:
-            self.wth_db = self.system_config.database['weather_db']
-            cursor = self.wth_db.cursor()
-
             ids = list(self.weather_stations_ids)
 
             # Find the max "useful" date for each station.
@@ -208,12 +267,14 @@ class WeatherUpdater:
                 ) GROUP BY erdc.omm_id, min_date
             """
 
-            cursor.execute(max_date_query, (ids, ids))
+            with self.system_config.database['weather_db'].connection() as wth_db:
+                cursor = wth_db.cursor()
+                cursor.execute(max_date_query, (ids, ids))
 
-            for record in cursor:
-                self.wth_max_date[record[0]] = record[1]
+                for record in cursor:
+                    self.wth_max_date[record[0]] = record[1]
 
-            cursor.close()
+                cursor.close()
             logging.getLogger().info('Updated weather series max date.')
         except Exception as ex:
             logging.getLogger().error('Failed to update weather series max date. Reason: %s.',
@@ -226,9 +287,6 @@ class WeatherUpdater:
         max_dates = {}
 
         try:
-            self.wth_db = self.system_config.database['weather_db']
-            cursor = self.wth_db.cursor()
-
             ids = omm_ids
             if not isinstance(ids, list):
                 ids = list(ids)
@@ -243,34 +301,68 @@ class WeatherUpdater:
             """
 
             # Find max dates for stations in use and their neighbors.
-            cursor.execute(max_date_query, (ids, ids))
+            with self.system_config.database['weather_db'].connection() as wth_db:
+                cursor = wth_db.cursor()
+                cursor.execute(max_date_query, (ids, ids))
 
-            for record in cursor:
-                max_dates[record[0]] = record[1]
+                for record in cursor:
+                    max_dates[record[0]] = record[1]
 
-            cursor.close()
+                cursor.close()
         except Exception as ex:
             logging.getLogger().error('Failed to find weather series max date. Reason: %s.',
                                       log_format_exception())
 
         return max_dates
 
-    def refresh_view(self, progress_monitor=None):
+    def refresh_view(self, progress_monitor=None, wth_db_connection=None, updated_stations=None):
+        """
+        Updates the estacion_registro_diario_completo records. If it's a regular table (see
+        core/modules/data_updater/impute_script/Incremental.sql), only the records of the updated stations are
+        replaced. Otherwise, the whole materialized view is refreshed.
+        :param updated_stations: A list of (omm_ids, min_date) tuples with the stations whose records changed from
+        min_date on (or in their whole history, if min_date is None). If it's None, every record is replaced.
+        """
         if not progress_monitor:
             progress_monitor = NullMonitor()
 
-        # DROP INDEX IF EXISTS erdi_index;
-        # REFRESH MATERIALIZED VIEW estacion_registro_diario_completo;
-        # CREATE INDEX erdi_index ON estacion_registro_diario_completo (omm_id, fecha);
-        progress_monitor.end_value = 3
-        progress_monitor.job_started()
-        cursor = self.system_config.database['weather_db'].cursor()
-        cursor.execute('DROP INDEX IF EXISTS erdi_index;')
-        progress_monitor.update_progress(1)
-        cursor.execute('REFRESH MATERIALIZED VIEW estacion_registro_diario_completo;')
-        progress_monitor.update_progress(2)
-        cursor.execute('CREATE INDEX erdi_index ON estacion_registro_diario_completo (omm_id, fecha);')
+        if not wth_db_connection:
+            with self.system_config.database['weather_db'].connection() as wth_db_connection:
+                return self.refresh_view(progress_monitor, wth_db_connection, updated_stations)
+
+        cursor = wth_db_connection.cursor()
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = 'estacion_registro_diario_completo'")
+        is_materialized_view = cursor.fetchone()[0] == 'm'
+
+        if is_materialized_view:
+            # DROP INDEX IF EXISTS erdi_index;
+            # REFRESH MATERIALIZED VIEW estacion_registro_diario_completo;
+            # CREATE INDEX erdi_index ON estacion_registro_diario_completo (omm_id, fecha);
+            progress_monitor.end_value = 3
+            progress_monitor.job_started()
+            cursor.execute('DROP INDEX IF EXISTS erdi_index;')
+            progress_monitor.update_progress(1)
+            cursor.execute('REFRESH MATERIALIZED VIEW estacion_registro_diario_completo;')
+            progress_monitor.update_progress(2)
+            cursor.execute('CREATE INDEX erdi_index ON estacion_registro_diario_completo (omm_id, fecha);')
+        else:
+            if updated_stations is None:
+                updated_stations = [(None, None)]
+
+            progress_monitor.end_value = len(updated_stations)
+            progress_monitor.job_started()
+            for index, (omm_ids, min_date) in enumerate(updated_stations):
+                # See core/lib/SQL/Base Functions.sql.
+                cursor.execute('SELECT pr_actualizar_registro_completo(%s, %s)',
+                               (list(omm_ids) if omm_ids is not None else None, min_date))
+                progress_monitor.update_progress(index + 1)
         cursor.execute('COMMIT')
+        cursor.close()
+
+        # Cached weather scenarios were built with the previous data, invalidate them.
+        scenario_cache = WeatherScenarioCache.from_config(self.system_config)
+        if scenario_cache:
+            scenario_cache.bump_data_version()
         progress_monitor.job_ended()
 
     def update_rainfall_quantiles(self, omm_ids=None, progress_monitor=None):
@@ -287,7 +379,8 @@ class WeatherUpdater:
                 progress_monitor = NullMonitor()
 
             progress_monitor.start_value = 0
-            progress_monitor.end_value = len(omm_ids)
+            # Query the rainfalls, compute the quantiles and store them.
+            progress_monitor.end_value = 3
 
             progress_monitor.update_progress(job_status=JOB_STATUS_WAITING)
             # Acquire a blocking job lock with the update weather dates priority.
@@ -295,29 +388,36 @@ class WeatherUpdater:
                 # Lock acquired, notify observers.
                 progress_monitor.update_progress(job_status=JOB_STATUS_RUNNING)
 
-                for index, omm_id in enumerate(omm_ids):
-                    wth_db = self.system_config.database['weather_db']
-                    cursor = wth_db.cursor()
-                    cursor.execute('SELECT campaign, sum FROM pr_campaigns_acum_rainfall(%s,%s)', (omm_id,self.system_config.campaign_first_month))
+                with self.system_config.database['weather_db'].connection() as wth_db:
+                    # Server side cursor, the accumulated rainfalls of every station are fetched in batches.
+                    cursor = wth_db.cursor(name='stations_acum_rainfall')
+                    cursor.execute('SELECT omm_id, campaign, sums FROM pr_stations_acum_rainfall(%s, %s)',
+                                   ([int(omm_id) for omm_id in omm_ids], self.system_config.campaign_first_month))
 
-                    np_prcp_sums = WeatherUpdater.parse_rainfalls(cursor)
+                    stations, np_prcp_sums, invalid_stations = WeatherUpdater.parse_rainfalls(cursor)
+                    cursor.close()
+                progress_monitor.update_progress(1)
 
-                    # daily_cursor = wth_db.cursor()
-                    # daily_cursor.execute('SELECT campaign, sum FROM pr_campaigns_rainfall(%s)', (omm_id,))
-                    #
-                    # np_prcp_values = WeatherUpdater.parse_rainfalls(daily_cursor)
+                quantiles = WeatherUpdater.get_quantiles(np_prcp_sums, quantiles=[5, 25, 50, 75, 95])
+                progress_monitor.update_progress(2)
 
+                if len(stations) > 0:
                     # Update (or insert) weather quantiles.
                     db = self.system_config.database['yield_db']
-                    db.reference_rainfall.update_one(
-                        {"omm_id": omm_id},
-                        {"$set": {
-                            "quantiles": WeatherUpdater.get_quantiles(np_prcp_sums, quantiles=[5, 25, 50, 75, 95])
-                        }}, upsert=True)
-                    # Update progress information.
-                    progress_monitor.update_progress(index)
+                    db.reference_rainfall.bulk_write([
+                        UpdateOne({"omm_id": omm_id},
+                                  {"$set": {
+                                      "quantiles": dict([(q, values[idx]) for q, values in quantiles.items()])
+                                  }, "$setOnInsert": {SYNC_TIMESTAMP_FIELD: datetime.utcnow()}}, upsert=True)
+                        for idx, omm_id in enumerate(stations)
+                    ], ordered=False)
+                progress_monitor.update_progress(3)
 
-            logging.getLogger().info('Updated rainfall quantiles for stations %s.' % list(omm_ids))
+            logging.getLogger().info('Updated rainfall quantiles for stations %s.' % stations)
+
+            if len(invalid_stations) > 0:
+                raise InvalidRainfallValue('There are missing rainfall values in the Weather DB for stations %s' %
+                                           invalid_stations)
 
         except InvalidRainfallValue as e:
             logging.getLogger().error('Failed to update rainfall quantiles. Reason: %s.', e.message)
@@ -326,36 +426,47 @@ class WeatherUpdater:
             logging.getLogger().error('Failed to update rainfall quantiles. Reason: %s.', log_format_exception())
 
     @staticmethod
-    def parse_rainfalls(cursor):
-        prcp_values = []
-        last_id = None
-
-        for record in cursor:
-            if record[0] != last_id:
-                prcp_values.append([])
-                last_id = record[0]
-            # Check if record[1] (the current rainfall value) isn't None.
-            # If it is, the imputation process has failed at some point.
-            if record[1] is None:
-                raise InvalidRainfallValue()
-            # Append values to the last campaign (the one we're processing).
-            prcp_values[-1].append(float(record[1]))
-
-        # Convert to numpy array.
-        np_prcp_values = np.empty(shape=(len(prcp_values), 365))
-        for idx, prcps in enumerate(prcp_values):
-            np_prcp_values[idx] = prcps[0:365]  # Exclude leap years.
-
-        return np_prcp_values
+    def parse_rainfalls(records, days=365):
+        """
+        Builds a cube with the accumulated rainfalls of every campaign of every station. Stations with fewer campaigns
+        are padded with NaN.
+        :param records: (omm_id, campaign, sums) rows sorted by station (see pr_stations_acum_rainfall).
+        :param days: Amount of days of each campaign (leap days are excluded).
+        :returns A (stations, cube, invalid stations) tuple where cube has shape (stations, campaigns, days). Stations
+        with missing rainfall values (the imputation process has failed at some point) are left out of the cube.
+        """
+        stations = []
+        stations_sums = []
+        invalid_stations = []
+
+        for omm_id, station_records in itertools.groupby(records, key=lambda r: r[0]):
+            sums = [r[2] for r in station_records]
+
+            if any([len(s) < days or None in s for s in sums]):
+                invalid_stations.append(omm_id)
+                continue
+
+            stations.append(omm_id)
+            stations_sums.append([s[0:days] for s in sums])  # Exclude leap days.
+
+        max_campaigns = max([len(sums) for sums in stations_sums]) if len(stations_sums) > 0 else 0
+        np_prcp_values = np.full(shape=(len(stations), max_campaigns, days), fill_value=np.nan)
+        for idx, sums in enumerate(stations_sums):
+            np_prcp_values[idx, 0:len(sums)] = sums
+
+        return stations, np_prcp_values, invalid_stations
 
     @staticmethod
-    def get_quantiles(np_arr, quantiles=None, axis=0):
-        if not quantiles:
-            return {}
-        q = {}
-        for quantile in quantiles:
-            q[str(quantile)] = np.percentile(np_arr, q=quantile, axis=axis).tolist()
-        return q
+    def get_quantiles(np_arr, quantiles=None, axis=1):
+        """
+        Computes the quantiles of every station with a single call.
+        :param np_arr: A (stations, campaigns, days) cube, as returned by parse_rainfalls.
+        :returns A dict mapping each quantile (as a string) to a list with the (days) values of each station.
+        """
+        if not quantiles or np_arr.shape[0] == 0:
+            return dict([(str(quantile), []) for quantile in (quantiles or [])])
+        values = np.nanpercentile(np_arr, q=quantiles, axis=axis)
+        return dict([(str(quantile), values[idx].tolist()) for idx, quantile in enumerate(quantiles)])
 
 
 class InvalidRainfallValue(Exception):
@@ -0,0 +1,68 @@
+import threading
+from pymongo.errors import BulkWriteError
+from core.lib.sync import WritersPipeline
+
+__author__ = 'Federico Schmidt'
+
+
+def insert_new_documents(collection, documents):
+    """
+    Inserts the given documents skipping the ones that are already present in the collection.
+    :param collection: A Pymongo collection.
+    :param documents: An iterable of documents.
+    """
+    documents = list(documents)
+    if len(documents) == 0:
+        return
+
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as bwe:
+        # Check if every error that was raised was a duplicate key error (11000).
+        for err in bwe.details['writeErrors']:
+            if err['code'] != 11000:
+                raise RuntimeError('Non recoverable error found while trying to sync yield '
+                                   'databases. Details: %s' % bwe.details)
+
+
+class DocumentsCopier(WritersPipeline):
+    """
+    Copies documents between two collections with a pipeline: the calling thread reads the documents from the source
+    collection in batches and queues them, from where a pool of writer threads inserts them into the target collection
+    (see insert_new_documents). Must be used as a context manager, the writers are stopped (and their errors raised)
+    when the context exits.
+    """
+    def __init__(self, source_collection, target_collection, writers=4, batch_size=1000, projection=None):
+        """
+        :param source_collection: The collection the documents are read from.
+        :param target_collection: The collection the documents are inserted into.
+        :param writers: Amount of writer threads.
+        :param batch_size: Amount of documents read from the source and inserted into the target at once.
+        :param projection: An optional projection of the documents read.
+        """
+        # Each writer has at most two batches waiting, this bounds the memory used when the target is slower.
+        super(DocumentsCopier, self).__init__(writers=writers, max_pending=2 * writers, name='sync_writer')
+        self.source_collection = source_collection
+        self.target_collection = target_collection
+        self.batch_size = batch_size
+        self.projection = projection
+        self.copied_count = 0
+        self.lock = threading.Lock()
+
+    def copy(self, ids):
+        """
+        Copies the documents with the given ids.
+        :param ids: A list of documents ids.
+        """
+        for batch_start in range(0, len(ids), self.batch_size):
+            cursor = self.source_collection.find({'_id': {'$in': ids[batch_start:batch_start + self.batch_size]}},
+                                                 projection=self.projection).batch_size(self.batch_size)
+            documents = list(cursor)
+
+            if len(documents) > 0:
+                self.enqueue(documents)
+
+    def write(self, documents):
+        insert_new_documents(self.target_collection, documents)
+        with self.lock:
+            self.copied_count += len(documents)
@@ -0,0 +1,14 @@
+--REEMPLAZA LA VISTA MATERIALIZADA estacion_registro_diario_completo POR UNA TABLA CON EL MISMO NOMBRE Y COLUMNAS.
+--LA TABLA SE ACTUALIZA DE FORMA INCREMENTAL (SOLO LAS ESTACIONES Y FECHAS ACTUALIZADAS) CON LA FUNCIÓN
+--pr_actualizar_registro_completo (VER core/lib/SQL/Base Functions.sql). VOLVER A EJECUTARLO NO TIENE EFECTO.
+DO $$
+BEGIN
+	IF EXISTS (SELECT 1 FROM pg_matviews WHERE matviewname = 'estacion_registro_diario_completo') THEN
+		CREATE TABLE estacion_registro_diario_completo_tmp AS TABLE estacion_registro_diario_completo;
+		DROP MATERIALIZED VIEW estacion_registro_diario_completo;
+		ALTER TABLE estacion_registro_diario_completo_tmp RENAME TO estacion_registro_diario_completo;
+		ALTER TABLE estacion_registro_diario_completo OWNER TO postgres;
+		CREATE INDEX erdi_index ON estacion_registro_diario_completo (omm_id, fecha);
+	END IF;
+END
+$$;
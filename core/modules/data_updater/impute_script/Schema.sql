@@ -1,4 +1,12 @@
 DROP INDEX IF EXISTS erdi_index;
+--estacion_registro_diario_completo ES UNA TABLA SI SE EJECUTÓ Incremental.sql.
+DO $$
+BEGIN
+	IF EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'estacion_registro_diario_completo') THEN
+		DROP TABLE estacion_registro_diario_completo;
+	END IF;
+END
+$$;
 DROP MATERIALIZED VIEW IF EXISTS estacion_registro_diario_completo;
 DROP TABLE IF EXISTS estacion_radiacion_diaria;
 DROP TABLE IF EXISTS estacion_registro_diario_imputado;
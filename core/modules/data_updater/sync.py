@@ -1,19 +1,30 @@
-from pymongo.errors import BulkWriteError
+from datetime import datetime, timedelta
 from core.lib.jobs.base import BaseJob
 from core.lib.jobs.monitor import ProgressMonitor, JOB_STATUS_WAITING, JOB_STATUS_RUNNING
 from paramiko.ssh_exception import NoValidConnectionsError, AuthenticationException, BadAuthenticationType
 from invoke.exceptions import UnexpectedExit
 from fabric import Connection
+from core.lib.utils.database import SYNC_TIMESTAMP_FIELD
+from core.modules.data_updater.copier import DocumentsCopier, insert_new_documents
 import logging
 
 __author__ = 'Federico Schmidt'
 
 
 class YieldDatabaseSync(BaseJob):
+    # Target database collection where the synchronization state (watermark) of each collection is stored.
+    state_collection = 'sync_state'
+    # Documents stamped up to this long before the watermark are read again, since a document could be stamped before
+    # but become visible after the last synchronized one. Duplicates are skipped.
+    watermark_overlap = timedelta(minutes=10)
 
     def __init__(self, system_config):
         super(YieldDatabaseSync, self).__init__(progress_monitor=ProgressMonitor(end_value=4))
         self.system_config = system_config
+        # Amount of documents read from the source database (and checkpointed) at once.
+        self.batch_size = int(system_config.system_config_yaml.get('yield_sync_batch_size', 1000))
+        # Threads inserting simulations into the target database.
+        self.writers = int(system_config.system_config_yaml.get('yield_sync_writers', 4))
 
     def run(self):
         logging.info('Running yield database synchronization.')
@@ -26,36 +37,16 @@ class YieldDatabaseSync(BaseJob):
                 source_db = self.system_config.database['yield_db']
                 target_db = self.system_config.database['yield_sync_db']
 
-                new_forecasts = self.__find_collection_diff__(collection_name='forecasts', source_db=source_db,
-                                                              target_db=target_db)
+                forecasts_insert_monitor = ProgressMonitor()
+                self.progress_monitor.add_subjob(forecasts_insert_monitor, job_name='Synchronize forecasts')
 
-                if new_forecasts.count() > 0:
-                    forecasts_insert_monitor = ProgressMonitor(end_value=new_forecasts.count())
-                    self.progress_monitor.add_subjob(forecasts_insert_monitor, job_name='Synchronize forecasts')
-                    inserted_forecasts_count = 0
-
-                    # Sync new forecasts.
-                    for f in new_forecasts:
-                        simulations_ids = f['simulations']
-
-                        bulk_op = target_db.simulations.initialize_unordered_bulk_op()
-
-                        # Fetch this forecast' simulations.
-                        for simulation in source_db.simulations.find({'_id': {'$in': simulations_ids}}):
-                            bulk_op.insert(simulation)
-
-                        try:
-                            bulk_op.execute()
-                        except BulkWriteError as bwe:
-                            # Check if every error that was raised was a duplicate key error (11000).
-                            for err in bwe.details['writeErrors']:
-                                if err['code'] != 11000:
-                                    raise RuntimeError('Non recoverable error found while trying to sync yield '
-                                                       'databases. Details: %s' % bwe.details)
-
-                        target_db.forecasts.insert(f)
-                        inserted_forecasts_count += 1
-                        forecasts_insert_monitor.update_progress(inserted_forecasts_count)
+                # Sync new forecasts.
+                self.__sync_collection__(collection_name='forecasts',
+                                         source_db=source_db,
+                                         target_db=target_db,
+                                         insert_documents=lambda forecasts: self.__insert_forecasts__(
+                                             forecasts, source_db, target_db),
+                                         progress_monitor=forecasts_insert_monitor)
 
                 # Notify we finished syncing forecasts (the first part of the job).
                 self.progress_monitor.update_progress(new_value=1)
@@ -123,33 +114,145 @@ class YieldDatabaseSync(BaseJob):
 
     def __insert_missing_documents__(self, collection_name, source_db, target_db, id_field='_id'):
         """
-        Finds documents inside the given collection that are present in the source database but not in the target
-        database and inserts them.
+        Inserts the documents of the given collection that are new in the source database into the target database.
         :param collection_name: A collection name.
         :param source_db: Source database Pymongo connection.
         :param target_db: Target database Pymongo connection.
+        :param id_field: The field that identifies a document in both databases.
+        """
+        def insert_documents(documents):
+            if id_field != '_id':
+                # Skip the documents that were inserted in the target database with a different "_id".
+                found_ids = set([d[id_field] for d in target_db[collection_name].find(
+                    {id_field: {'$in': [d[id_field] for d in documents]}}, projection=[id_field])])
+                documents = [d for d in documents if d[id_field] not in found_ids]
+
+            insert_new_documents(target_db[collection_name], documents)
+
+        self.__sync_collection__(collection_name, source_db, target_db, insert_documents, id_field)
+
+    def __insert_forecasts__(self, forecasts, source_db, target_db):
         """
-        new_documents = self.__find_collection_diff__(collection_name, source_db, target_db, id_field)
+        Inserts the given forecasts into the target database along with their simulations. The simulations of every
+        forecast are copied first (see DocumentsCopier), so a forecast is never found in the target database without
+        its simulations.
+        """
+        # Skip the forecasts that are already in the target database (e.g. read again because of the watermark
+        # overlap), their simulations were copied before them.
+        found_ids = set([f['_id'] for f in target_db.forecasts.find({'_id': {'$in': [f['_id'] for f in forecasts]}},
+                                                                    projection=['_id'])])
+        forecasts = [f for f in forecasts if f['_id'] not in found_ids]
+        if len(forecasts) == 0:
+            return
 
-        if new_documents.count() > 0:
-            bulk_operator = target_db[collection_name].initialize_unordered_bulk_op()
+        simulations_ids = [sim_id for f in forecasts for sim_id in f.get('simulations', [])]
 
-            for document in new_documents:
-                bulk_operator.insert(document)
+        with DocumentsCopier(source_db.simulations, target_db.simulations, writers=self.writers,
+                             batch_size=self.batch_size) as copier:
+            copier.copy(simulations_ids)
 
-            bulk_operator.execute()
+        logging.info('Synchronized %d simulations of %d forecasts.' % (copier.copied_count, len(forecasts)))
+        insert_new_documents(target_db.forecasts, forecasts)
 
-    def __find_collection_diff__(self, collection_name, source_db, target_db, id_field='_id'):
+    def __sync_collection__(self, collection_name, source_db, target_db, insert_documents, id_field='_id',
+                            progress_monitor=None):
         """
-        Finds documents inside the given collection that are present in the source database but not in the target
-        database.
+        Streams the documents of the given collection that are new in the source database, in batches, to the
+        insert_documents function. New documents are found with a watermark: the greatest synchronization timestamp
+        (see core.lib.utils.database.SYNC_TIMESTAMP_FIELD) that was synchronized, which is checkpointed in the target
+        database after every batch, so an interrupted synchronization resumes from the last inserted batch.
+
+        The first synchronization of a collection (i.e. there's no watermark yet) compares the ids of both databases,
+        in batches, instead.
         :param collection_name: A collection name.
         :param source_db: Source database Pymongo connection.
         :param target_db: Target database Pymongo connection.
-        :returns The list of documents that are missing in the target_db's collection.
+        :param insert_documents: A function that receives a list of documents and inserts them into the target
+        database.
+        :param id_field: The field that identifies a document in both databases.
+        :param progress_monitor: An optional ProgressMonitor, updated with the amount of documents read.
+        """
+        state = target_db[self.state_collection].find_one({'_id': collection_name}) or {'_id': collection_name}
+
+        if 'watermark' not in state:
+            self.__sync_collection_ids__(collection_name, source_db, target_db, insert_documents, id_field, state,
+                                         progress_monitor)
+            return
+
+        query = {SYNC_TIMESTAMP_FIELD: {'$gt': state['watermark'] - self.watermark_overlap}}
+        source_db[collection_name].create_index(SYNC_TIMESTAMP_FIELD)
+
+        if progress_monitor:
+            progress_monitor.end_value = source_db[collection_name].count_documents(query)
+
+        cursor = source_db[collection_name].find(query).sort(SYNC_TIMESTAMP_FIELD, 1).batch_size(self.batch_size)
+        synced_count = 0
+
+        for batch in self.__batches__(cursor):
+            insert_documents(batch)
+
+            state['watermark'] = max(state['watermark'], batch[-1][SYNC_TIMESTAMP_FIELD])
+            self.__save_state__(target_db, state)
+
+            synced_count += len(batch)
+            if progress_monitor:
+                progress_monitor.update_progress(synced_count)
+
+    def __sync_collection_ids__(self, collection_name, source_db, target_db, insert_documents, id_field, state,
+                                progress_monitor=None):
+        """
+        Finds the documents of the given collection that are present in the source database but not in the target
+        database, comparing the ids of both databases in batches sorted by id. The last compared id is checkpointed
+        in the synchronization state after each batch. When every id was compared, the watermark is set to the time
+        the comparison started.
+        """
+        if 'ids_sync_start' not in state:
+            state['ids_sync_start'] = datetime.utcnow()
+
+        query = {}
+        if 'ids_sync_last_id' in state:
+            query = {id_field: {'$gt': state['ids_sync_last_id']}}
+
+        if progress_monitor:
+            progress_monitor.end_value = source_db[collection_name].count_documents(query)
+
+        cursor = source_db[collection_name].find(query, projection=[id_field]).sort(id_field, 1)\
+            .batch_size(self.batch_size)
+        compared_count = 0
+
+        for batch in self.__batches__(cursor):
+            ids = [d[id_field] for d in batch]
+            found_ids = set([d[id_field] for d in target_db[collection_name].find({id_field: {'$in': ids}},
+                                                                                   projection=[id_field])])
+            missing_ids = [i for i in ids if i not in found_ids]
+
+            if len(missing_ids) > 0:
+                insert_documents(list(source_db[collection_name].find({id_field: {'$in': missing_ids}})))
+
+            state['ids_sync_last_id'] = ids[-1]
+            self.__save_state__(target_db, state)
+
+            compared_count += len(batch)
+            if progress_monitor:
+                progress_monitor.update_progress(compared_count)
+
+        state['watermark'] = state.pop('ids_sync_start')
+        state.pop('ids_sync_last_id', None)
+        self.__save_state__(target_db, state)
+
+    def __save_state__(self, target_db, state):
+        target_db[self.state_collection].replace_one({'_id': state['_id']}, state, upsert=True)
+
+    def __batches__(self, cursor):
         """
-        found_ids = target_db[collection_name].distinct(id_field)
-        # Find documents in source DB with id's that are NOT in the "found_ids" list.
-        return source_db[collection_name].find({
-            id_field: {'$nin': found_ids}
-        })
+        Splits a cursor in lists of at most batch_size documents.
+        """
+        batch = []
+        for document in cursor:
+            batch.append(document)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+
+        if len(batch) > 0:
+            yield batch
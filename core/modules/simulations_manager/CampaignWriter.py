@@ -1,5 +1,7 @@
 import json
 import os
+import re
+import shutil
 import numpy as np
 
 from core.lib.io.file import create_folder_with_permissions
@@ -11,6 +13,8 @@ from netCDF4 import Dataset
 
 
 class CampaignWriter:
+    # The run directories created by pSIMS in its working directory.
+    psims_run_regex = re.compile(r'^run\d{3}$')
 
     def __init__(self):
         pass
@@ -28,6 +32,7 @@ class CampaignWriter:
 
         psims_path = os.path.abspath(forecast.paths.psims)
         root_path = forecast.paths.rundir
+        workdir_path = CampaignWriter.create_psims_workdir(psims_path, os.path.join(root_path, 'psims'))
 
         res_variables = set(forecast.results.cycle)
         if 'ADAT' in res_variables or 'MDAT' in res_variables:
@@ -99,12 +104,15 @@ class CampaignWriter:
                     delta,
                     n_scens,
                     num_years,
+                    root_path,
                     'mongodb://%s:%d' % (forecast.configuration.database.host, forecast.configuration.database.port),
                     forecast.configuration.database.name,
                     out_collection_name,
                     'mongodb://%s:%d' % (forecast.configuration.database.host, forecast.configuration.database.port),
                     forecast.configuration.database.name,
                     out_collection_name,
+                    root_path,
+                    root_path,
                     dssat_executable
                 ))
 
@@ -113,19 +121,43 @@ class CampaignWriter:
 
             with open(run_sh_path, mode='w') as run_sh:
                 run_sh.write(sh_script % (
-                    psims_path,
+                    workdir_path,
+                    root_path,
+                    root_path,
                     root_path
                 ))
 
         crop_template_path = os.path.abspath(os.path.join('.', 'data', 'templates', forecast.crop_template))
-        os.symlink(crop_template_path, exp_template_path)
+        shutil.copyfile(crop_template_path, exp_template_path)
 
         forecast.paths.campaign_path = os.path.dirname(netcdf_file_path)
         forecast.paths.params_path = params_file_path
         forecast.paths.gridlist_path = gridlist_file_path
+        forecast.paths.psims_workdir = workdir_path
 
         return run_sh_path
 
+    @staticmethod
+    def create_psims_workdir(psims_path, workdir_path):
+        """
+        Creates a view of the pSIMS installation made of symbolic links to each of its entries. pSIMS creates its run
+        directory (runNNN) and its temporary files in the folder it's started from, so starting it from this view
+        instead of the installation folder keeps every forecast's run isolated from the others running concurrently.
+        :param psims_path: The pSIMS installation folder.
+        :param workdir_path: The folder where the view is created (inside the forecast's rundir).
+        :returns The absolute path of the view.
+        """
+        workdir_path = os.path.abspath(workdir_path)
+        create_folder_with_permissions(workdir_path)
+
+        for entry in os.listdir(psims_path):
+            # Skip the outputs of previous runs started from the installation folder.
+            if entry == 'campaigns' or CampaignWriter.psims_run_regex.match(entry):
+                continue
+            os.symlink(os.path.join(psims_path, entry), os.path.join(workdir_path, entry))
+
+        return workdir_path
+
     @staticmethod
     def create_grids(forecast, output_dir):
         gridlist_file_path = os.path.join(output_dir, 'gridList.txt')
@@ -161,33 +193,30 @@ class CampaignWriter:
                     if not soil:
                         raise RuntimeError('Soil %s not found.' % soil_id)
                     else:
-                        json.dump(soil, open(soil_json_path, mode='w'), ensure_ascii=True, indent=4)
+                        with open(soil_json_path, mode='w') as soil_file:
+                            json.dump(soil, soil_file, ensure_ascii=True, indent=4)
                 else:
                     soil = soils[soil_id]
 
+                # The grid tree is written in place (pSIMS reads the rundir, see data/templates/run_psims.sh) and
+                # each cell links to its soil file and to its weather station folder, so no file is copied.
                 soil_lat_folder = os.path.join(forecast.paths.soil_grid_path, '%03d' % sim.lat_idx)
                 soil_lon_folder = os.path.join(soil_lat_folder, '%03d' % sim.lon_idx)
-
-                if not os.path.exists(soil_lat_folder):
-                    create_folder_with_permissions(soil_lat_folder)
-
-                if not os.path.exists(soil_lon_folder):
-                    create_folder_with_permissions(soil_lon_folder)
-
-                # Create symlink.
-                os.symlink(soil_json_path, os.path.join(soil_lon_folder, 'soil.json'))
-
                 wth_lat_folder = os.path.join(forecast.paths.weather_grid_path, '%03d' % sim.lat_idx)
                 wth_lon_folder = os.path.join(wth_lat_folder, '%03d' % sim.lon_idx)
 
-                if not os.path.exists(wth_lat_folder):
+                if sim_idx == 0:
+                    # First simulation of this location.
+                    create_folder_with_permissions(soil_lat_folder)
                     create_folder_with_permissions(wth_lat_folder)
 
-                if os.path.exists(wth_lon_folder):
-                    raise RuntimeError('Couldn\t create symlink at "%s", folder already exists.' % wth_lon_folder)
+                create_folder_with_permissions(soil_lon_folder)
+                os.symlink(soil_json_path, os.path.join(soil_lon_folder, 'soil.json'))
 
-                weather_folder_path = os.path.join(forecast.paths.rundir, sim.weather_station['weather_path'])
+                if os.path.lexists(wth_lon_folder):
+                    raise RuntimeError('Couldn\'t create symlink at "%s", folder already exists.' % wth_lon_folder)
 
+                weather_folder_path = os.path.join(forecast.paths.rundir, sim.weather_station['weather_path'])
                 os.symlink(weather_folder_path, wth_lon_folder)
 
                 # Get the first soil (we're working only with one soil per file).
@@ -198,7 +227,7 @@ class CampaignWriter:
                     raise RuntimeError('Mismatch between count of soil horizons in forecast specification file (%s)'
                                        ' and soil file (%s) for soil "%s".' %
                                        (sim.soil.n_horizons, len_layers, sim.soil.id))
-                sim['initial_conditions']['icbl'] = [int(layer['sllb']) for layer in soil['soilLayer']]
+                sim['initial_conditions']['icbl'] = SoilDAO.get_layers_bounds(soil_id)
                 sim['management']['soil_id'] = soil_id
 
                 soil_layers_count.append(len_layers)
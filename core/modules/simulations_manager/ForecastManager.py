@@ -1,19 +1,26 @@
 # -*- coding: utf-8 -*-
 import os
-import re
 import shutil
-import threading
+import uuid
+import concurrent.futures
 import logging
 import copy
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-from core.lib.io.file import create_folder_with_permissions, listdir_fullpath
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from core.lib.io.file import create_folder_with_permissions
+from core.lib.sync import JobsLock
+from core.lib.utils.database import SYNC_TIMESTAMP_FIELD
 from core.lib.utils.extended_collections import DotDict
 from core.lib.utils.log import log_format_exception
 from core.modules.config.loaders import ForecastLoader
 from core.modules.simulations_manager.CampaignWriter import CampaignWriter
 from core.modules.simulations_manager.weather.DatabaseWeatherSeries import DatabaseWeatherSeries
 from core.modules.simulations_manager.RunpSIMS import RunpSIMS
+from core.modules.simulations_manager.RunDSSAT import RunDSSAT
+from core.modules.simulations_manager.ResultsIngestion import ResultsIngestion, find_negative_hwam_simulations
 from core.lib.jobs.monitor import NullMonitor, ProgressMonitor
 from core.lib.jobs.monitor import JOB_STATUS_WAITING, JOB_STATUS_RUNNING, JOB_STATUS_RESCHEDULED
 from core.modules.config.priority import RUN_FORECAST, RUN_REFERENCE_FORECAST
@@ -25,10 +32,22 @@ __author__ = 'Federico Schmidt'
 class ForecastManager:
     def __init__(self, scheduler, system_config, weather_updater):
         self.system_config = system_config
-        self.psims_runner = RunpSIMS()
+        if system_config.system_config_yaml.get('simulations_executor', 'psims') == 'local':
+            # Run DSSAT directly, without pSIMS.
+            self.psims_runner = RunDSSAT(system_config,
+                                         max_workers=system_config.system_config_yaml.get('dssat_workers'))
+        else:
+            self.psims_runner = RunpSIMS()
         self.scheduler = scheduler
         self.weather_updater = weather_updater
         self.scheduled_reference_simulations_ids = set()
+        # Fingerprint of the last version of each location upserted into the database.
+        self.locations_fingerprints = dict()
+        # Each forecast's series maker limits how many of its series are created concurrently.
+        self.weather_series_pool = concurrent.futures.ThreadPoolExecutor(max_workers=system_config.max_parallelism,
+                                                                         thread_name_prefix='create_series')
+        # Each pSIMS run works in its own rundir, this limits how many forecasts run at once (see forecast_slot).
+        self.psims_slots = JobsLock(max_parallel_tasks=system_config.psims_slots)
 
     def start(self):
         for file_name, forecast_list in self.system_config.forecasts.items():
@@ -98,7 +117,7 @@ class ForecastManager:
         progress_monitor.job_started()
         progress_monitor.update_progress(job_status=JOB_STATUS_WAITING)
 
-        with self.system_config.jobs_lock.blocking_job(priority=priority):
+        with self.forecast_slot(priority):
             # Lock acquired.
             progress_monitor.update_progress(job_status=JOB_STATUS_RUNNING)
 
@@ -137,7 +156,8 @@ class ForecastManager:
                     raise RuntimeError('The specified collection (%s) does not exist in the results database.' %
                                        forecast.configuration['simulation_collection'])
 
-                folder_name = "%s" % (datetime.now().isoformat())
+                # Forecasts started at the same time must not share their folders.
+                folder_name = "%s_%s" % (datetime.now().isoformat(), uuid.uuid4().hex[:8])
                 folder_name = folder_name.replace('"', '').replace('\'', '').replace(' ', '_')
                 forecast.folder_name = folder_name
 
@@ -158,7 +178,7 @@ class ForecastManager:
                 forecast.paths.wth_csv_export = os.path.join(forecast.paths.wth_csv_export, folder_name)
                 create_folder_with_permissions(forecast.paths.wth_csv_read)
 
-                active_threads = dict()
+                series_locations = dict()
 
                 forecast.weather_stations = {}
                 forecast.rainfall = {}
@@ -169,19 +189,20 @@ class ForecastManager:
                 else:
                     run_date = datetime.strptime(forecast.forecast_date, '%Y-%m-%d').date()
 
+                locations_upserts = []
+                locations_fingerprints = {}
+
                 for loc_key, location in forecast['locations'].items():
                     omm_id = location['weather_station']
 
-                    # Upsert location.
-                    db.locations.update_one({'_id': location.id}, {
-                        # '$set': {
-                        #     "name": location.name,
-                        #     "coord_x": location.coord_x,
-                        #     "coord_y": location.coord_y,
-                        #     "weather_station": location.weather_station
-                        # }
-                        '$set': location.persistent_view()
-                    }, upsert=True)
+                    # Upsert location (unless it didn't change since it was last upserted).
+                    fingerprint = location.fingerprint()
+                    if self.locations_fingerprints.get(location.id) != fingerprint:
+                        locations_upserts.append(UpdateOne({'_id': location.id}, {
+                            '$set': location.persistent_view(),
+                            '$setOnInsert': {SYNC_TIMESTAMP_FIELD: datetime.utcnow()}
+                        }, upsert=True))
+                        locations_fingerprints[location.id] = fingerprint
 
                     # If this forecast is creating weather files from the weather database, check that the station
                     # associated with each location is currently updated.
@@ -199,15 +220,17 @@ class ForecastManager:
                             stations_not_updated.add(omm_id)
                             continue
 
-                    if omm_id not in active_threads:
+                    if omm_id not in series_locations:
                         # Weather station data updated, forecast can be ran.
-                        active_threads[omm_id] = threading.Thread(target=wth_series_maker.create_series,
-                                                                  name='create_series for omm_id = %s' % omm_id,
-                                                                  args=(location, forecast))
+                        series_locations[omm_id] = location
                     else:
-                        # Weather station already has an associated thread that will create the weather series.
+                        # Weather station already has an associated location that will create the weather series.
                         continue
 
+                if len(locations_upserts) > 0:
+                    db.locations.bulk_write(locations_upserts, ordered=False)
+                    self.locations_fingerprints.update(locations_fingerprints)
+
                 if len(stations_not_updated) > 0:
                     # Forecast can't continue, must be rescheduled.
                     progress_monitor.update_progress(new_value=progress_monitor.end_value-1)
@@ -220,21 +243,15 @@ class ForecastManager:
 
                 progress_monitor.update_progress(new_value=1)
 
-                weather_series_monitor = ProgressMonitor(end_value=len(active_threads))
+                weather_series_monitor = ProgressMonitor(end_value=len(series_locations))
                 progress_monitor.add_subjob(weather_series_monitor,
                                             job_name='Create weather series (%s)' %
                                                      forecast.configuration.weather_maker_class.__name__)
-                joined_threads_count = 0
-
-                # Start all weather maker threads.
-                for t in list(active_threads.values()):
-                    t.start()
 
-                # Wait for the weather grid to be populated.
-                for t in list(active_threads.values()):
-                    t.join()
-                    joined_threads_count += 1
-                    weather_series_monitor.update_progress(joined_threads_count)
+                try:
+                    self.create_weather_series(wth_series_maker, forecast, series_locations, weather_series_monitor)
+                finally:
+                    wth_series_maker.close()
 
                 weather_series_monitor.job_ended()
                 progress_monitor.update_progress(new_value=2)
@@ -256,6 +273,7 @@ class ForecastManager:
 
                 simulations_ids = []
                 reference_ids = []
+                simulations = []
 
                 # Flatten simulations and update location info (with id's and computed weather stations).
                 for loc_key, loc_simulations in forecast.simulations.items():
@@ -269,9 +287,11 @@ class ForecastManager:
                             sim.forecast_date = forecast.forecast_date
                             reference_ids.append(sim.reference_id)
 
-                        sim_id = db[forecast.configuration['simulation_collection']].insert_one(sim.persistent_view()).inserted_id
-                        sim['_id'] = sim_id
-                        simulations_ids.append(sim_id)
+                        simulations.append(sim)
+
+                # simulations_ids is filled with the id's actually inserted, even if the insertion fails.
+                self.insert_simulations(db[forecast.configuration['simulation_collection']], simulations,
+                                        simulations_ids)
 
                 if not is_reference_forecast:
                     # Find which simulations have a reference simulation associated.
@@ -329,44 +349,54 @@ class ForecastManager:
                 # Ejecutar simulaciones.
                 weather_series_monitor = ProgressMonitor()
                 progress_monitor.add_subjob(weather_series_monitor, job_name='Run pSIMS')
+                run_options = {'verbose': self.system_config.system_config_yaml.get('verbose_execution', False)}
+                if self.psims_runner.streams_results:
+                    # The results are checked as they're written (no need to read them again).
+                    batch_size = int(self.system_config.system_config_yaml.get('results_batch_size', 100))
+                    run_options['ingestion'] = ResultsIngestion(db[forecast.configuration['simulation_collection']],
+                                                                simulations_ids, batch_size=batch_size,
+                                                                check_hwam='HWAM' in forecast.results.cycle,
+                                                                progress_monitor=weather_series_monitor)
+
                 psims_exit_code = self.psims_runner.run(forecast, progress_monitor=weather_series_monitor,
-                                                        verbose=self.system_config.system_config_yaml.get('verbose_execution', False))
+                                                        **run_options)
 
                 # Check results
-                if psims_exit_code == 0:
-                    inserted_simulations = db[forecast.configuration['simulation_collection']].find(
-                        {
-                            '_id': {'$in': simulations_ids},
-                            # Find simulations that have results field (either cycle or daily).
-                            # This property is created by the pSIMS Mongo hook so if a simulation doesn't have this
-                            # field it means that the execution inside pSIMS failed.
-                            '$or': [{'daily_results': {'$exists': True}}, {'cycle_results': {'$exists': True}}]
-                        },
-                        projection=['daily_results', 'cycle_results', 'name'])
-
-                    if len(simulations_ids) != inserted_simulations.count():
+                if psims_exit_code == 0 and not self.psims_runner.streams_results:
+                    collection = db[forecast.configuration['simulation_collection']]
+                    finished_count = collection.count_documents({
+                        '_id': {'$in': simulations_ids},
+                        # Find simulations that have results field (either cycle or daily).
+                        # This property is created by the pSIMS Mongo hook so if a simulation doesn't have this
+                        # field it means that the execution inside pSIMS failed.
+                        '$or': [{'daily_results': {'$exists': True}}, {'cycle_results': {'$exists': True}}]
+                    })
+
+                    if len(simulations_ids) != finished_count:
                         raise RuntimeError('Mismatch between simulations id\'s length and finished simulations '
-                                           'count (%s != %s)' % (len(simulations_ids), inserted_simulations.count()))
+                                           'count (%s != %s)' % (len(simulations_ids), finished_count))
 
                     if 'HWAM' in forecast.results.cycle:
-                        # Check that there are no -99 values in the crop yield.
-                        for sim in inserted_simulations:
-                            if 'cycle_results' not in sim:
-                                continue
-                            for scen_idx, scenario in enumerate(sim['cycle_results']['HWAM']['scenarios']):
-
-                                if not (isinstance(scenario['value'], int) or isinstance(scenario['value'], float)):
-                                    # Nested years inside the scenario.
-                                    for year_index, v in enumerate(scenario['value']):
-                                        if v['value'] < 0:
-                                            raise RuntimeError('Found a negative value for HWAM inside a simulation '
-                                                               '(%s, id = %s, scenario index = %d, year index = %d).' %
-                                                               (sim['name'], sim['_id'], scen_idx, year_index))
-
-                                elif scenario['value'] < 0:
-                                    raise RuntimeError('Found a negative value for HWAM inside a simulation (%s, '
-                                                       'id = %s, scenario index = %d).' % (sim['name'], sim['_id'],
-                                                                                           scen_idx))
+                        # Check that there are no -99 values in the crop yield (the check runs in the database).
+                        negative_values = find_negative_hwam_simulations(collection, simulations_ids)
+
+                        if len(negative_values) > 0:
+                            sim_id, sim_name, scen_idx, year_index = negative_values[0]
+                            if year_index is not None:
+                                raise RuntimeError('Found a negative value for HWAM inside a simulation '
+                                                   '(%s, id = %s, scenario index = %d, year index = %d).' %
+                                                   (sim_name, sim_id, scen_idx, year_index))
+                            raise RuntimeError('Found a negative value for HWAM inside a simulation (%s, '
+                                               'id = %s, scenario index = %d).' % (sim_name, sim_id, scen_idx))
+
+                if psims_exit_code == 0:
+                    # The results are complete, the forecast (or the reference simulations) can be synchronized.
+                    sync_timestamp = {'$set': {SYNC_TIMESTAMP_FIELD: datetime.utcnow()}}
+                    if forecast_id:
+                        db.forecasts.update_one({'_id': forecast_id}, sync_timestamp)
+                    else:
+                        db[forecast.configuration['simulation_collection']].update_many(
+                            {'_id': {'$in': simulations_ids}}, sync_timestamp)
 
                 logging.getLogger().info('Finished running forecast "%s" (time=%s).\n' %
                                          (forecast.name, datetime.now() - run_start_time))
@@ -390,20 +420,87 @@ class ForecastManager:
                 delete_folders = self.system_config.system_config_yaml.get('delete_psims_folders', False)
 
                 if (not psims_exit_code or psims_exit_code == 0) and delete_folders:
-                    # Clean the rundir.
+                    # Clean the rundir (this includes the pSIMS run directory, see CampaignWriter.create_psims_workdir).
                     if os.path.exists(forecast.paths.rundir):
                         shutil.rmtree(forecast.paths.rundir)
 
-                if psims_exit_code == 0 and delete_folders:
-                    # Clean pSIMS run folder.
-                    rundir_regex = re.compile('.+/run(\d){3}$')
-                    files_filter = lambda file_name: rundir_regex.match(file_name) is not None
+                return psims_exit_code
 
-                    psims_run_dirs = sorted(listdir_fullpath(forecast.paths.psims, filter=files_filter),
-                                            reverse=True)
+    @contextmanager
+    def forecast_slot(self, priority):
+        """
+        Waits for a forecast's turn to run. With a single pSIMS slot, forecasts are blocking jobs. With more slots, up to
+        "psims_slots" forecasts run at once as parallel jobs, so they still exclude the blocking jobs (e.g. the
+        database updates) while they run. In both cases, waiting forecasts are dequeued by priority (e.g. reference
+        forecasts go first).
+        """
+        if self.system_config.psims_slots == 1:
+            with self.system_config.jobs_lock.blocking_job(priority=priority):
+                yield
+            return
 
-                    if len(psims_run_dirs) > 0:
-                        # Remove the last runNNN directory (the one this execution created).
-                        shutil.rmtree(psims_run_dirs[0])
+        # Slots are always taken before the jobs lock, so forecasts can't deadlock each other.
+        with self.psims_slots.parallel_job(priority=priority):
+            with self.system_config.jobs_lock.parallel_job(priority=priority):
+                yield
+
+    def create_weather_series(self, wth_series_maker, forecast, locations, progress_monitor):
+        """
+        Creates the weather series of each location in the weather series pool, which is shared by every forecast.
+        If the creation of a series fails, the series that haven't started yet are cancelled and the exception is
+        raised once the running ones finish.
+        :param locations: A dict mapping weather stations to the location used to create their series.
+        """
+        futures = [self.weather_series_pool.submit(wth_series_maker.create_series, location, forecast)
+                   for location in locations.values()]
+
+        try:
+            for completed_count, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+                future.result()
+                progress_monitor.update_progress(completed_count)
+        except:
+            for future in futures:
+                future.cancel()
+            concurrent.futures.wait(futures)
+            raise
+
+    def insert_simulations(self, collection, simulations, inserted_ids):
+        """
+        Inserts the simulations in batches of "simulations_insert_batch_size" documents (see config/system.yaml).
+        :param collection: The simulations collection.
+        :param simulations: A list of simulations, their "_id" field is set after being inserted.
+        :param inserted_ids: A list where the id's of the inserted simulations are appended. When a batch fails, the
+        id's of the documents that may have been inserted before raising the exception are appended too, so they can be
+        rolled back. Simulations that already existed before the batch are never appended (their id's are
+        deterministic, so a failed run must not delete the documents of a previous one).
+        """
+        batch_size = int(self.system_config.system_config_yaml.get('simulations_insert_batch_size', 1000))
+        if batch_size < 1:
+            raise RuntimeError('Invalid simulations insert batch size: %s.' % batch_size)
+
+        for batch_start in range(0, len(simulations), batch_size):
+            batch = simulations[batch_start:batch_start + batch_size]
+            documents = [sim.persistent_view() for sim in batch]
+
+            # Find the simulations that already exist, so a failed insert only rolls back the ones it wrote.
+            existing_ids = set([d['_id'] for d in collection.find({
+                '_id': {'$in': [d['_id'] for d in documents]}
+            }, projection=['_id'])])
 
-                return psims_exit_code
+            try:
+                collection.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                # Unordered inserts go on after an error, only the documents with errors weren't inserted.
+                failed_indexes = set([error['index'] for error in e.details.get('writeErrors', [])])
+                inserted_ids.extend([d['_id'] for index, d in enumerate(documents)
+                                     if index not in failed_indexes and d['_id'] not in existing_ids])
+                raise
+            except Exception:
+                # Any other error (e.g. a lost connection) may interrupt the insert after part of the batch was
+                # written, so every simulation of the batch that didn't exist before is rolled back.
+                inserted_ids.extend([d['_id'] for d in documents if d['_id'] not in existing_ids])
+                raise
+
+            for sim, document in zip(batch, documents):
+                sim['_id'] = document['_id']
+                inserted_ids.append(document['_id'])
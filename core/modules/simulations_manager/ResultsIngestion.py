@@ -0,0 +1,145 @@
+from pymongo import UpdateOne
+from core.lib.jobs.monitor import NullMonitor
+from core.lib.sync import WritersPipeline
+
+__author__ = 'Federico Schmidt'
+
+
+def find_negative_hwam(cycle_results):
+    """
+    :param cycle_results: The "cycle_results" field of a simulation.
+    :returns A (scenario index, year index) tuple with the first negative crop yield (HWAM) of the simulation or None
+    if there aren't any. The year index is None when the scenarios have a single value.
+    """
+    if 'HWAM' not in cycle_results:
+        return None
+
+    for scen_idx, scenario in enumerate(cycle_results['HWAM']['scenarios']):
+        if not (isinstance(scenario['value'], int) or isinstance(scenario['value'], float)):
+            # Nested years inside the scenario.
+            for year_index, v in enumerate(scenario['value']):
+                if v['value'] < 0:
+                    return scen_idx, year_index
+
+        elif scenario['value'] < 0:
+            return scen_idx, None
+    return None
+
+
+def find_negative_hwam_simulations(collection, simulations_ids):
+    """
+    Looks for negative crop yields (HWAM) in the results of the given simulations with an aggregation, so the check
+    runs in the database and only the offending values are transferred (never the simulations' results).
+    :param collection: The simulations collection.
+    :param simulations_ids: The id's of the simulations to check.
+    :returns A list of (simulation id, simulation name, scenario index, year index) tuples, one for each negative
+    value. The year index is None when the scenarios have a single value.
+    """
+    pipeline = [
+        {'$match': {
+            '_id': {'$in': simulations_ids},
+            # Skip the simulations without negative values, either as a scenario value or in a nested year.
+            '$or': [{'cycle_results.HWAM.scenarios.value': {'$lt': 0}},
+                    {'cycle_results.HWAM.scenarios.value.value': {'$lt': 0}}]
+        }},
+        {'$project': {'name': 1, 'scenario': '$cycle_results.HWAM.scenarios'}},
+        {'$unwind': {'path': '$scenario', 'includeArrayIndex': 'scenario_index'}},
+        {'$project': {'name': 1, 'scenario_index': 1, 'year': '$scenario.value'}},
+        # Nested years are unwound. A single value is unwound as is and its index is null.
+        {'$unwind': {'path': '$year', 'includeArrayIndex': 'year_index'}},
+        {'$match': {'$or': [{'year': {'$lt': 0}}, {'year.value': {'$lt': 0}}]}},
+        {'$project': {'name': 1, 'scenario_index': 1, 'year_index': 1}}
+    ]
+
+    return [(value['_id'], value.get('name'), value['scenario_index'], value['year_index'])
+            for value in collection.aggregate(pipeline)]
+
+
+class ResultsIngestion(WritersPipeline):
+    """
+    Writes the results of a forecast's simulations while they're being run: the executor puts the results of each
+    finished cell, they're grouped in batches and a writer thread updates the simulations with a bulk write per batch.
+    When the writer is idle, the results gathered so far are handed to it without waiting for a full batch, so results
+    land as soon as the writer is free. At most max_pending_batches batches wait for the writer, which bounds the
+    memory used by results (each one holds its daily values) when the database is slower than the executor.
+    Completion, the HWAM checks and the progress are tracked with each result, so the forecast is validated without
+    reading its simulations again. Must be used as a context manager, the writer is stopped (and its errors raised)
+    when the context exits.
+    """
+    def __init__(self, collection, simulations_ids, batch_size=100, check_hwam=False, progress_monitor=None,
+                 max_pending_batches=2):
+        """
+        :param collection: The simulations collection.
+        :param simulations_ids: The id's of the simulations whose results are expected.
+        :param batch_size: Maximum amount of simulations updated with each bulk write.
+        :param check_hwam: Whether to reject results with negative crop yields (HWAM).
+        :param progress_monitor: Updated with the amount of simulations written.
+        :param max_pending_batches: Maximum amount of batches waiting for the writer.
+        """
+        if batch_size < 1:
+            raise RuntimeError('Invalid results batch size: %s.' % batch_size)
+
+        super(ResultsIngestion, self).__init__(writers=1, max_pending=max_pending_batches, name='results_writer')
+        self.collection = collection
+        self.pending = set(simulations_ids)
+        self.expected_count = len(self.pending)
+        self.batch_size = batch_size
+        self.check_hwam = check_hwam
+        self.progress_monitor = progress_monitor or NullMonitor()
+        # Results not handed to the writer yet.
+        self.batch = []
+        self.ingested_count = 0
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None and len(self.batch) > 0:
+                self.__put_batch__()
+        finally:
+            super(ResultsIngestion, self).__exit__(exc_type, exc_val, exc_tb)
+
+    def put(self, sim_id, results):
+        """
+        Adds the results of a simulation to the current batch, blocks while the writer has max_pending_batches
+        batches waiting.
+        :param results: A dict with the result fields of the simulation (cycle_results and/or daily_results).
+        :raise RuntimeError: If the simulation isn't expected (or its results were already put) or if it has a
+        negative crop yield.
+        :raise Exception: The first error raised by the writer, if any.
+        """
+        if sim_id not in self.pending:
+            raise RuntimeError('Unexpected results for simulation "%s".' % sim_id)
+
+        if self.check_hwam and 'cycle_results' in results:
+            negative_hwam = find_negative_hwam(results['cycle_results'])
+            if negative_hwam:
+                raise RuntimeError('Found a negative value for HWAM inside a simulation (id = %s, scenario index = %d'
+                                   ', year index = %s).' % (sim_id, negative_hwam[0], negative_hwam[1]))
+
+        self.pending.remove(sim_id)
+        self.batch.append((sim_id, results))
+
+        if len(self.batch) >= self.batch_size or self.queue.empty():
+            self.__put_batch__()
+
+    def validate(self):
+        """
+        Checks that the results of every simulation were written. Must be called after the context exits.
+        """
+        if self.ingested_count != self.expected_count:
+            raise RuntimeError('Mismatch between simulations id\'s length and finished simulations count (%s != %s)' %
+                               (self.expected_count, self.ingested_count))
+
+    def __put_batch__(self):
+        self.enqueue(self.batch)
+        self.batch = []
+
+    def write(self, batch):
+        result = self.collection.bulk_write([UpdateOne({'_id': sim_id}, {'$set': results})
+                                             for sim_id, results in batch], ordered=False)
+
+        if result.matched_count != len(batch):
+            raise RuntimeError('Results of %d simulations were written but only %d simulations were found.' %
+                               (len(batch), result.matched_count))
+
+        self.ingested_count += len(batch)
+        self.progress_monitor.update_progress(new_value=self.ingested_count)
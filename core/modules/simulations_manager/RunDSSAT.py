@@ -0,0 +1,357 @@
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+from datetime import datetime
+from core.lib.jobs.monitor import NullMonitor, JOB_STATUS_ERROR
+
+__author__ = 'Federico Schmidt'
+
+# Scratch folder of the current worker process (see __init_worker__).
+worker_scratch_dir = None
+# The campaign settings of the current worker process (see RunDSSAT.read_campaign).
+worker_campaign = None
+
+# Arguments pSIMS adds to the campaign translator (tappcamp) of each grid cell.
+campaign_translator_args = '--latidx %s --lonidx %s --ref_year %s --delta %s --nyers %s --nscens %s'
+
+
+def read_params(params_path):
+    """
+    Reads a pSIMS params file (see data/templates/params_template) expanding the variables ($name) in its values.
+    :returns A dict mapping each parameter to its value.
+    """
+    params = {}
+    with open(params_path) as f:
+        for line in f:
+            tokens = shlex.split(line, comments=True)
+            if len(tokens) < 2:
+                continue
+            params[tokens[0]] = ' '.join(tokens[1:])
+
+    variable = re.compile(r'\$(\w+)')
+
+    def expand(key, value):
+        # Parameters referencing themselves (e.g. PATH) refer to the environment variable.
+        return variable.sub(lambda m: params[m.group(1)] if m.group(1) in params and m.group(1) != key else
+                            os.environ.get(m.group(1), ''), value)
+
+    # Expand twice, some values reference parameters that reference other parameters.
+    for _ in range(2):
+        params = dict([(key, expand(key, value)) for key, value in params.items()])
+    return params
+
+
+def parse_value(value):
+    """
+    :returns The value as an int or a float, if possible.
+    """
+    for value_type in (int, float):
+        try:
+            return value_type(value)
+        except ValueError:
+            pass
+    return value
+
+
+def read_summary(file_path):
+    """
+    Reads the runs of a DSSAT Summary.OUT file. Values are right aligned to the end of their column header, so each
+    column is read up to the end of its header (this doesn't hold for text columns like TNAM, which aren't needed).
+    :returns A list with a dict for each run (in the order they were written) mapping column names to values.
+    """
+    columns = None
+    runs = []
+
+    with open(file_path, encoding='latin-1') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line.startswith('@'):
+                columns = [(m.group().strip('.'), m.end()) for m in re.finditer(r'[^\s@]+', line)]
+                continue
+            if not columns or not line.strip() or line[0] in '*!$':
+                continue
+
+            run = {}
+            for name, end in columns:
+                if end > len(line) or line[end - 1].isspace():
+                    # Empty value.
+                    continue
+                run[name] = parse_value(line[:end].split()[-1])
+            runs.append(run)
+    return runs
+
+
+def read_daily_outputs(file_path, omitted_value=0):
+    """
+    Reads a DSSAT daily output file (e.g. PlantGro.OUT). Each run has its own header, followed by a line per day.
+    Columns are fixed width (each value is right aligned to the end of its column header), so empty and invalid values
+    (e.g. overflowed ones) are read as the omitted value, like the pSIMS daily Mongo hook (DailyOUT2Mongo.py) does.
+    :param omitted_value: The value of the empty or invalid cells.
+    :returns A list with a dict for each run mapping column names to lists of daily values.
+    """
+    runs = []
+    columns = None
+
+    with open(file_path, encoding='latin-1') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line.startswith('@'):
+                # The name of each column and the positions where its values start and end.
+                columns = []
+                start = 0
+                for m in re.finditer(r'[^\s@]+', line):
+                    columns.append((m.group(), start, m.end()))
+                    start = m.end()
+                runs.append(dict([(name, []) for name, _, _ in columns]))
+                continue
+            if line.startswith('*'):
+                # A new run starts (its header follows).
+                columns = None
+                continue
+            if not columns or not line.strip() or line[0] in '!$':
+                continue
+
+            for name, start, end in columns:
+                value = parse_value(line[start:end].strip())
+                if not (isinstance(value, int) or isinstance(value, float)):
+                    value = omitted_value
+                runs[-1][name].append(value)
+    return runs
+
+
+def cycle_results(summary_runs, variables, scen_names, num_years):
+    """
+    Builds the "cycle_results" field of a simulation: {variable: {"scenarios": [{"scenario_name", "value"}]}}. Runs
+    are written by scenario (and year) so each scenario takes the next num_years runs. When a campaign simulates more
+    than one year, the value of each scenario is a list with a {"value"} document per year.
+    """
+    if len(summary_runs) != len(scen_names) * num_years:
+        raise RuntimeError('Expected %d runs in Summary.OUT, found %d.' % (len(scen_names) * num_years,
+                                                                            len(summary_runs)))
+    results = {}
+    for variable in variables:
+        scenarios = []
+        for scen_idx, scen_name in enumerate(scen_names):
+            values = [run.get(variable, -99) for run in summary_runs[scen_idx * num_years:(scen_idx + 1) * num_years]]
+            if num_years == 1:
+                scenarios.append({'scenario_name': scen_name, 'value': values[0]})
+            else:
+                scenarios.append({'scenario_name': scen_name, 'value': [{'value': v} for v in values]})
+        results[variable] = {'scenarios': scenarios}
+    return results
+
+
+def daily_results(daily_files, variables, scen_names, num_years):
+    """
+    Builds the "daily_results" field of a simulation, with the layout of cycle_results: the value of each scenario is
+    the list of daily values of its run or, when a campaign simulates more than one year, a list with a {"value"}
+    document per year holding the daily values of that year's run.
+    :param daily_files: A list with the runs of each daily output file (see read_daily_outputs).
+    """
+    results = {}
+    for variable in variables:
+        for runs in daily_files:
+            if len(runs) == 0 or variable not in runs[0]:
+                continue
+            if len(runs) != len(scen_names) * num_years:
+                raise RuntimeError('Expected %d runs with daily values of %s, found %d.' %
+                                   (len(scen_names) * num_years, variable, len(runs)))
+            scenarios = []
+            for scen_idx, scen_name in enumerate(scen_names):
+                values = [run[variable] for run in runs[scen_idx * num_years:(scen_idx + 1) * num_years]]
+                if num_years == 1:
+                    scenarios.append({'scenario_name': scen_name, 'value': values[0]})
+                else:
+                    scenarios.append({'scenario_name': scen_name, 'value': [{'value': v} for v in values]})
+            results[variable] = {'scenarios': scenarios}
+            break
+    return results
+
+
+def __init_worker__(scratch_root, campaign):
+    global worker_scratch_dir, worker_campaign
+    worker_scratch_dir = tempfile.mkdtemp(dir=scratch_root, prefix='worker_')
+    worker_campaign = campaign
+
+
+def __link_folder__(source_folder, target_folder):
+    for file_name in os.listdir(source_folder):
+        source_path = os.path.join(source_folder, file_name)
+        if os.path.isfile(source_path):
+            os.symlink(source_path, os.path.join(target_folder, file_name))
+
+
+def __run_command__(command, cwd, env):
+    p = subprocess.run(shlex.split(command), cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if p.returncode != 0:
+        raise RuntimeError('Command "%s" failed (exit code = %d). Output:\n%s' %
+                           (command, p.returncode, p.stdout.decode('utf8', errors='replace')))
+
+
+def run_cell(lat_idx, lon_idx, sim_id, scen_names):
+    """
+    Runs the simulation of a grid cell in the worker's scratch folder, like pSIMS does: the campaign translator
+    (tappcamp) and the DSSAT inputs translator (tappinp) write the experiment inputs and then DSSAT is run.
+    :returns A (simulation id, results) tuple, where results holds the cycle_results and daily_results fields.
+    """
+    campaign = worker_campaign
+    work_dir = worker_scratch_dir
+
+    # Clean the outputs of the previous cell.
+    for file_name in os.listdir(work_dir):
+        os.remove(os.path.join(work_dir, file_name))
+
+    # Inputs are linked, never copied: DSSAT reference files, campaign files, soil and weather files.
+    __link_folder__(campaign['dssat_files'], work_dir)
+    for file_name in ('campaign.nc4', 'exp_template.json'):
+        os.symlink(os.path.join(campaign['rundir'], file_name), os.path.join(work_dir, file_name))
+    os.symlink(os.path.join(campaign['soils'], lat_idx, lon_idx, 'soil.json'), os.path.join(work_dir, 'soil.json'))
+    __link_folder__(os.path.join(campaign['weather'], lat_idx, lon_idx), work_dir)
+
+    env = dict(os.environ, PATH=campaign['path'])
+    __run_command__('%s %s' % (campaign['tappcamp'], campaign_translator_args % (
+        lat_idx, lon_idx, campaign['ref_year'], campaign['delta'], campaign['num_years'], campaign['scens'])),
+        work_dir, env)
+    __run_command__(campaign['tappinp'], work_dir, env)
+    __run_command__(campaign['executable'], work_dir, env)
+
+    summary_path = os.path.join(work_dir, 'Summary.OUT')
+    if not os.path.exists(summary_path):
+        raise RuntimeError('DSSAT didn\'t write the Summary.OUT file of simulation %s.' % sim_id)
+
+    results = {}
+    if len(campaign['variables']) > 0:
+        results['cycle_results'] = cycle_results(read_summary(summary_path), campaign['variables'], scen_names,
+                                                 campaign['num_years'])
+    if len(campaign['daily_variables']) > 0:
+        daily_files = [read_daily_outputs(os.path.join(work_dir, file_name), campaign['omitted_value'])
+                       for file_name in sorted(os.listdir(work_dir))
+                       if file_name.endswith('.OUT') and file_name != 'Summary.OUT']
+        results['daily_results'] = daily_results(daily_files, campaign['daily_variables'], scen_names,
+                                                 campaign['num_years'])
+    return sim_id, results
+
+
+class RunDSSAT:
+    """
+    Runs the campaigns written by CampaignWriter without pSIMS: the grid cells are simulated in a process pool, each
+    worker in its own scratch folder, and the results are written in the simulations collection with the same shape
+    the pSIMS Mongo hooks (OUT2Mongo.py and DailyOUT2Mongo.py) use. Enabled with "simulations_executor: 'local'" in
+    config/system.yaml.
+    """
+    # The results are written (and validated) by a ResultsIngestion as the cells finish.
+    streams_results = True
+
+    def __init__(self, system_config, max_workers=None):
+        self.system_config = system_config
+        self.max_workers = max_workers or system_config.max_parallelism
+
+    @staticmethod
+    def read_campaign(forecast):
+        """
+        :returns The settings the workers need to run the campaign's cells, read from its pSIMS params file.
+        """
+        params = read_params(forecast.paths.params_path)
+        # The value DailyOUT2Mongo.py writes for empty daily values.
+        omitted_value = re.search(r'--omitted_value\s+(\S+)', params.get('postprocess_daily', ''))
+        return {
+            'rundir': forecast.paths.rundir,
+            'dssat_files': params['refdata'],
+            'soils': params['soils'],
+            'weather': params['weather'],
+            'path': params['PATH'],
+            'tappcamp': params['tappcamp'],
+            'tappinp': params['tappinp'],
+            'executable': params['executable'],
+            'ref_year': params['ref_year'],
+            'delta': params['delta'],
+            'scens': params['scens'],
+            'num_years': int(params['num_years']),
+            'variables': [v for v in params['variables'].split(',') if v],
+            'daily_variables': [v for v in params.get('daily_variables', '').split(',') if v],
+            'omitted_value': parse_value(omitted_value.group(1)) if omitted_value else 0
+        }
+
+    @staticmethod
+    def read_cells(forecast):
+        """
+        :returns A list with the (lat index, lon index, simulation id, scenario names) of each cell of gridList.txt.
+        """
+        with open(os.path.join(forecast.paths.rundir, 'sim_data.json')) as f:
+            sim_data = json.load(f)['simulations']
+
+        cells = []
+        with open(forecast.paths.gridlist_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                lat_idx, lon_idx = line.strip().split('/')
+                simulation = sim_data[int(lat_idx)][int(lon_idx)]
+                cells.append((lat_idx, lon_idx, simulation['id'], simulation['scen_names']))
+        return cells
+
+    def run(self, forecast, ingestion, progress_monitor=None, verbose=False):
+        """
+        :param ingestion: The ResultsIngestion that writes (and validates) the results.
+        :returns 0 if every simulation was run and its results were written, 1 otherwise.
+        """
+        if not progress_monitor:
+            progress_monitor = NullMonitor()
+
+        logging.getLogger().info('Running DSSAT for forecast "%s" (%s).' % (forecast.name, forecast.forecast_date))
+
+        progress_monitor.end_value = forecast.simulation_count
+        progress_monitor.job_started()
+
+        start_time = datetime.now()
+        try:
+            self.__run__(forecast, progress_monitor, verbose, ingestion)
+            ret_val = 0
+        except:
+            logging.getLogger().exception('Failed to run DSSAT for forecast "%s".' % forecast.name)
+            ret_val = 1
+        end_time = datetime.now()
+
+        logging.getLogger().info('Finished running DSSAT for forecast "%s" (%s). Retval = %s. Time: %s.' %
+                                 (forecast.name, forecast.forecast_date, ret_val, end_time - start_time))
+
+        if ret_val != 0:
+            progress_monitor.job_ended(end_status=JOB_STATUS_ERROR)
+        else:
+            progress_monitor.job_ended()
+
+        return ret_val
+
+    def __run__(self, forecast, progress_monitor, verbose, ingestion):
+        cells = self.read_cells(forecast)
+
+        scratch_root = os.path.join(forecast.paths.rundir, 'scratch')
+        os.makedirs(scratch_root, exist_ok=True)
+
+        # This process runs other threads (the scheduler, pymongo's and the results writer), so the workers are
+        # started by a fork server instead of forking it.
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers,
+                                                          mp_context=multiprocessing.get_context('forkserver'),
+                                                          initializer=__init_worker__,
+                                                          initargs=(scratch_root, self.read_campaign(forecast)))
+        try:
+            with ingestion:
+                futures = [executor.submit(run_cell, *cell) for cell in cells]
+
+                for completed_count, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+                    ingestion.put(*future.result())
+
+                    if verbose:
+                        print('\rCompleted: %02d/%02d.' % (completed_count, len(cells)), end='')
+        finally:
+            executor.shutdown(cancel_futures=True)
+            shutil.rmtree(scratch_root, ignore_errors=True)
+
+        ingestion.validate()
@@ -1,4 +1,3 @@
-import time
 import re
 from datetime import datetime
 import shlex
@@ -14,17 +13,15 @@ __author__ = 'Federico Schmidt'
 
 
 class RunpSIMS:
+    # The results are written by pSIMS (see the postprocess hooks in data/templates/params_template).
+    streams_results = False
+    # Amount of bytes read from the pSIMS output at once.
+    read_size = 64 * 1024
 
-    def __init__(self, max_events=10000):
-        self.max_events = max_events
-        self.selecting = re.compile('Selecting site:(\d+)')
-        self.active = re.compile('Active:(\d+)')
-        self.finished = re.compile('Finished successfully:(\d+)')
-        self.submitted = re.compile('Submitted:(\d+)')
-        self.submitting = re.compile('Submitting:(\d+)')
-        self.stage_out = re.compile('Stage out:(\d+)')
-        self.stage_in = re.compile('Stage in:(\d+)')
-        self.failed = re.compile('Failed:(\d+)')
+    def __init__(self):
+        # Counters of a Swift progress line, e.g. "Progress: ... Selecting site:1 Active:4 Finished successfully:10".
+        self.progress_counter = re.compile(r'(Selecting site|Active|Finished successfully|Submitted|Submitting|'
+                                           r'Stage out|Stage in|Failed):(\d+)')
 
     def run(self, forecast, progress_monitor=None, verbose=False):
         if not progress_monitor:
@@ -53,89 +50,87 @@ class RunpSIMS:
     def __run__(self, sh_script, forecast_name, sim_count, progress_monitor, verbose):
         command = shlex.split('sh "%s"' % sh_script)
 
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=os.setsid, encoding='utf8')
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+        stdout_fd = p.stdout.fileno()
+        os.set_blocking(stdout_fd, False)
 
         stdout_lines = []
+        # Incomplete last line of the output read so far.
+        pending = b''
+        killed = False
 
         epoll = select.epoll()
-        epoll.register(p.stdout.fileno(), select.EPOLLOUT | select.EPOLLIN)
-
-        i = 0
+        epoll.register(stdout_fd, select.EPOLLIN | select.EPOLLHUP)
 
         try:
-            while i < self.max_events:
-                i += 1
-                events = epoll.poll(timeout=1)
-                for fileno, event in events:
-
-                    if event & select.EPOLLIN:
-                        if fileno == p.stdout.fileno():
-                            read = p.stdout.readline()
-                            stdout_lines.append(read)
-                            # if verbose:
-                            #     sys.stdout.write('> ' + read)
-                            if read.startswith('Progress'):
-                                selecting = self.selecting.search(read)
-                                active = self.active.search(read)
-                                finished = self.finished.search(read)
-                                submitted = self.submitted.search(read)
-                                submitting = self.submitting.search(read)
-                                stage_out = self.stage_out.search(read)
-                                stage_in = self.stage_in.search(read)
-                                failed = self.failed.search(read)
-                                running = 0
-                                completed = 0
-                                total = 0
-
-                                if active:
-                                    running = int(active.groups()[0])
-                                    total += running
-                                if selecting:
-                                    total += int(selecting.groups()[0])
-                                if finished:
-                                    completed = int(finished.groups()[0])
-                                    total += completed
-                                if submitted:
-                                    total += int(submitted.groups()[0])
-                                if submitting:
-                                    total += int(submitting.groups()[0])
-                                if stage_out:
-                                    total += int(stage_out.groups()[0])
-                                if stage_in:
-                                    total += int(stage_in.groups()[0])
-
-                                if total == 0:
-                                    continue
-
-                                if failed:
-                                    logging.getLogger().error("A task has failed, dumping pSIMS output.")
-                                    err_file_name = "ERR [%s] - %s.txt" % (datetime.now().isoformat(), forecast_name)
-                                    with open(err_file_name, mode='w') as err_file:
-                                        err_file.write(''.join(stdout_lines))
-                                    # Kill processes.
-                                    os.killpg(os.getpgid(p.pid), signal.SIGKILL)
-                                else:
-                                    progress_monitor.update_progress(new_value=completed)
-
-                                if verbose:
-                                    sys.stdout.write("\rRunning: %d. Completed: %02d/%02d. "
-                                                     % (running, completed, total))
-                                    sys.stdout.flush()
-
-                    elif event & select.EPOLLHUP:
-                        if fileno == p.stdout.fileno():
-                            raise RuntimeError("Program ended.")
-
-        except RuntimeError as err:
-            # en realidad no reporta un error
-            # sino solo la finalización del pSIMS
-            # por eso no siempre se imprime
-            if verbose:
-                print(str(err).strip())
+            eof = False
+            while not eof:
+                # Wait (without timeout) until there's output or pSIMS closes its output.
+                epoll.poll()
+
+                # Drain all the available output.
+                chunks = [pending]
+                while True:
+                    try:
+                        chunk = os.read(stdout_fd, self.read_size)
+                    except BlockingIOError:
+                        break
+                    if not chunk:
+                        eof = True
+                        break
+                    chunks.append(chunk)
+
+                lines = b''.join(chunks).split(b'\n')
+                # The last element is an incomplete line (or an empty string).
+                pending = lines.pop()
+                if eof and pending:
+                    lines.append(pending)
+
+                for line in lines:
+                    line = line.decode('utf8', errors='replace') + '\n'
+                    stdout_lines.append(line)
+
+                    if killed or not line.startswith('Progress'):
+                        continue
+
+                    if not self.__progress__(line, forecast_name, stdout_lines, progress_monitor, verbose):
+                        # A task has failed, kill processes.
+                        os.killpg(os.getpgid(p.pid), signal.SIGKILL)
+                        killed = True
         finally:
-            epoll.unregister(p.stdout.fileno())
-
-        while p.poll() is None:
-            time.sleep(1)
-
-        return p.poll()
+            epoll.unregister(stdout_fd)
+            epoll.close()
+
+        if verbose:
+            print('Program ended.')
+
+        # The output was closed, wait for the process to exit.
+        return p.wait()
+
+    def __progress__(self, line, forecast_name, stdout_lines, progress_monitor, verbose):
+        """
+        Parses a Swift progress line and updates the progress monitor.
+        :returns False if a task has failed, True otherwise.
+        """
+        counters = dict([(name, int(value)) for name, value in self.progress_counter.findall(line)])
+
+        running = counters.get('Active', 0)
+        completed = counters.get('Finished successfully', 0)
+        total = sum([value for name, value in counters.items() if name != 'Failed'])
+
+        if total == 0:
+            return True
+
+        if 'Failed' in counters:
+            logging.getLogger().error("A task has failed, dumping pSIMS output.")
+            err_file_name = "ERR [%s] - %s.txt" % (datetime.now().isoformat(), forecast_name)
+            with open(err_file_name, mode='w') as err_file:
+                err_file.write(''.join(stdout_lines))
+            return False
+
+        progress_monitor.update_progress(new_value=completed)
+
+        if verbose:
+            sys.stdout.write("\rRunning: %d. Completed: %02d/%02d. " % (running, completed, total))
+            sys.stdout.flush()
+        return True
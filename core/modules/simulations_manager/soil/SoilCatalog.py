@@ -0,0 +1,153 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+__author__ = 'Federico Schmidt'
+
+
+class SoilCatalog:
+    """
+    A single file with every soil profile of the soils directory, read through a memory map. Layout (little endian):
+        header: magic, version, soils count, layers offset, index offset and index length (see header_format).
+        data: the compact JSON of each soil, one after another.
+        layers: the layer bounds (sllb) of the first profile of every soil, as a single int32 column.
+        index: a JSON object mapping each soil id to its [data offset, data length, layers offset, layers count,
+        source JSON path (relative to the catalog folder)].
+    The catalog is built from the JSON soil files with SoilCatalog.build (python -m
+    core.modules.simulations_manager.soil.SoilCatalog) and must be rebuilt when they change (see SoilsUpdater).
+    """
+    magic = b'PRSC'
+    version = 1
+    header_format = struct.Struct('<4sIIQQQ')
+    layer_format = struct.Struct('<i')
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+        with open(file_path, mode='rb') as f:
+            stat = os.fstat(f.fileno())
+            # The (mtime, size) of the catalog file when it was opened, used to detect a rebuilt catalog.
+            self.file_stat = (stat.st_mtime_ns, stat.st_size)
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count, self.layers_offset, index_offset, index_length = \
+            self.header_format.unpack_from(self.data, 0)
+
+        if magic != self.magic or version != self.version:
+            raise RuntimeError('Invalid soils catalog file: "%s".' % file_path)
+
+        self.index = json.loads(self.data[index_offset:index_offset + index_length].decode('utf8'))
+
+        if len(self.index) != count:
+            raise RuntimeError('Corrupted soils catalog file: "%s".' % file_path)
+
+    @staticmethod
+    def open(file_path):
+        """
+        :returns The catalog or None if the file doesn't exist or isn't a valid catalog.
+        """
+        if not os.path.exists(file_path):
+            return None
+        try:
+            return SoilCatalog(file_path)
+        except Exception as ex:
+            logging.warning('Failed to open the soils catalog "%s", falling back to the soil files. Reason: %s.' %
+                            (file_path, ex))
+            return None
+
+    def __contains__(self, soil_id):
+        return soil_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, soil_id):
+        """
+        :returns The parsed soil, same as loading its JSON file.
+        """
+        offset, length, _, _, _ = self.index[soil_id]
+        return json.loads(self.data[offset:offset + length].decode('utf8'))
+
+    def layers_bounds(self, soil_id):
+        """
+        :returns A tuple with the depth of the bottom of each layer (sllb) of the soil.
+        """
+        _, _, layers_offset, layers_count, _ = self.index[soil_id]
+        return struct.unpack_from('<%di' % layers_count, self.data,
+                                  self.layers_offset + layers_offset * self.layer_format.size)
+
+    def source(self, soil_id):
+        """
+        :returns The path of the JSON file the soil was built from.
+        """
+        return os.path.join(os.path.dirname(self.file_path), self.index[soil_id][4])
+
+    def sources(self):
+        """
+        :returns A dict mapping each soil id to the path of the JSON file it was built from.
+        """
+        return dict([(soil_id, self.source(soil_id)) for soil_id in self.index])
+
+    @staticmethod
+    def build(soil_files, file_path):
+        """
+        Builds a catalog with the given soils. The catalog is written to a temporary file that replaces the previous
+        catalog (if any) once it's complete, so processes reading the previous one aren't affected.
+        :param soil_files: A dict mapping each soil id to its JSON file path.
+        :param file_path: The catalog file path.
+        :returns The amount of soils in the catalog.
+        """
+        catalog_folder = os.path.dirname(os.path.abspath(file_path))
+        index = {}
+        layers = []
+
+        fd, temp_path = tempfile.mkstemp(dir=catalog_folder, prefix='.soils_catalog')
+        try:
+            with os.fdopen(fd, mode='wb') as f:
+                # Leave room for the header, it's written at the end.
+                f.write(b'\0' * SoilCatalog.header_format.size)
+                offset = SoilCatalog.header_format.size
+
+                for soil_id in sorted(soil_files.keys()):
+                    soil_path = soil_files[soil_id]
+                    with open(soil_path, encoding='latin-1') as soil_file:
+                        soil = json.load(soil_file)
+
+                    data = json.dumps(soil, separators=(',', ':')).encode('utf8')
+                    f.write(data)
+
+                    soil_layers = soil['soils'][0].get('soilLayer', [])
+                    index[soil_id] = [offset, len(data), len(layers), len(soil_layers),
+                                      os.path.relpath(os.path.abspath(soil_path), catalog_folder)]
+                    layers.extend([int(layer['sllb']) for layer in soil_layers])
+                    offset += len(data)
+
+                layers_offset = offset
+                f.write(struct.pack('<%di' % len(layers), *layers))
+                index_offset = layers_offset + len(layers) * SoilCatalog.layer_format.size
+                index_data = json.dumps(index, separators=(',', ':')).encode('utf8')
+                f.write(index_data)
+
+                f.seek(0)
+                f.write(SoilCatalog.header_format.pack(SoilCatalog.magic, SoilCatalog.version, len(index),
+                                                       layers_offset, index_offset, len(index_data)))
+
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, file_path)
+        except:
+            os.remove(temp_path)
+            raise
+
+        return len(index)
+
+
+if __name__ == '__main__':
+    # Build the catalog used by SoilDAO from the soil files.
+    from core.modules.simulations_manager.soil.SoilDAO import find_soil_files, catalog_path
+
+    output_path = sys.argv[1] if len(sys.argv) > 1 else catalog_path
+    print('Built soils catalog "%s" with %d soils.' % (output_path, SoilCatalog.build(find_soil_files(), output_path)))
@@ -1,29 +1,71 @@
+import concurrent.futures
 import logging
 import os
 import json
+import threading
+import time
 from core.lib.io.file import listdir_fullpath, filename_without_ext
+from core.modules.simulations_manager.soil.SoilCatalog import SoilCatalog
 
 __author__ = 'Federico Schmidt'
 
 soils_path = os.path.join('.', 'data', 'soils')
+# Soils catalog built from the soil files (see SoilCatalog), the soil files are read when it doesn't exist.
+catalog_path = os.path.join('.', 'data', 'soils.catalog')
 soils_dict = None
 
 
-def load_soils():
+def find_soil_files():
+    """
+    :returns A dict mapping each soil id to its JSON file inside the soils directory.
+    """
     def is_soil_file(x):
         return os.path.splitext(x)[1].lower() == '.json'
 
     soil_files = listdir_fullpath(soils_path, recursive=True, onlyFiles=True, filter=is_soil_file)
+    found_soils = {}
 
     for f in soil_files:
         key = filename_without_ext(f)
 
-        if key in soils_dict:
+        if key in found_soils:
             logging.warning('Duplicated soil name "%s". Found at two different paths: "%s" and "%s".' % (key,
-                                                                                                         soils_dict[key],
+                                                                                                         found_soils[key],
                                                                                                          f))
             continue
-        soils_dict[key] = f
+        found_soils[key] = f
+
+    return found_soils
+
+
+def catalog_is_stale(catalog, soil_files):
+    """
+    :param soil_files: A dict mapping each soil id to its JSON file (see find_soil_files).
+    :returns True if a soil file was added, removed or modified after the catalog was built.
+    """
+    normalize = lambda files: dict([(soil_id, os.path.abspath(path)) for soil_id, path in files.items()])
+    if normalize(catalog.sources()) != normalize(soil_files):
+        return True
+
+    catalog_mtime = catalog.file_stat[0]
+    return any([os.stat(path).st_mtime_ns > catalog_mtime for path in soil_files.values()])
+
+
+def load_soils():
+    """
+    Loads the soil files of the soils directory. If there's a soils catalog and it's out of date with the soil files,
+    it's rebuilt.
+    """
+    soil_files = find_soil_files()
+    soils_dict.update(soil_files)
+
+    catalog = SoilCatalog.open(catalog_path)
+    if catalog and catalog_is_stale(catalog, soil_files):
+        try:
+            logging.info('Rebuilt the soils catalog with %d soils.' % SoilCatalog.build(soil_files, catalog_path))
+        except Exception as ex:
+            # Modified soils are still read from their files (see SoilDAO.get_cached_soil).
+            logging.warning('Failed to rebuild the soils catalog "%s". Reason: %s.' % (catalog_path, ex))
 
 
 if not soils_dict:
@@ -31,22 +73,158 @@ if not soils_dict:
     load_soils()
 
 
+class CachedSoil:
+    """
+    A parsed soil file along with the data derived from it.
+    """
+    def __init__(self, file_path, file_stat, soil, layers_bounds=None):
+        self.file_path = file_path
+        # The (mtime, size) of the soil file when it was read, used to detect changes.
+        self.file_stat = file_stat
+        self.soil = soil
+        # Depth of the bottom of each layer (sllb) of the first soil profile.
+        if layers_bounds is None:
+            layers_bounds = tuple([int(layer['sllb']) for layer in soil['soils'][0]['soilLayer']])
+        self.layers_bounds = layers_bounds
+        self.metrics = None
+
+
 class SoilDAO:
+    # Process-wide cache of soils, indexed by soil id.
+    __cache__ = {}
+    __cache_lock__ = threading.Lock()
+    __catalog__ = None
 
     def __init__(self):
         pass
 
     @staticmethod
     def get_soil(soil_id):
+        """
+        :returns The parsed soil file, a dict shared by every caller which mustn't be modified, or None if the soil
+        doesn't exist.
+        """
+        cached_soil = SoilDAO.get_cached_soil(soil_id)
+        if not cached_soil:
+            return None
+        return cached_soil.soil
+
+    @staticmethod
+    def get_layers_bounds(soil_id):
+        """
+        :returns A list with the depth of the bottom of each layer (sllb) of the given soil.
+        """
+        return list(SoilDAO.get_cached_soil(soil_id, required=True).layers_bounds)
+
+    @staticmethod
+    def get_metrics(soil_id):
+        """
+        :returns The water metrics of the given soil (see SoilDAO.calculate_metrics).
+        """
+        cached_soil = SoilDAO.get_cached_soil(soil_id, required=True)
+        if cached_soil.metrics is None:
+            cached_soil.metrics = SoilDAO.calculate_metrics(cached_soil.soil['soils'][0]['soilLayer'])
+        return dict(cached_soil.metrics)
+
+    @staticmethod
+    def get_cached_soil(soil_id, required=False):
+        """
+        Gets a soil from the cache, the soil file is (re)read if it isn't cached yet or if it was modified since it was
+        cached.
+        :param required: Raise an exception instead of returning None when the soil doesn't exist.
+        :returns A CachedSoil instance or None.
+        """
         if not soils_dict:
             raise RuntimeError('Soils dictionary not configured.')
 
-        if soil_id in soils_dict:
-            try:
-                return json.load(open(soils_dict[soil_id]), encoding='latin-1')
-            except Exception as ex:
-                print('@ soil file: "%s.json"' % soil_id)
-                raise ex
-        else:
+        if soil_id not in soils_dict:
+            if required:
+                raise RuntimeError('Soil %s not found.' % soil_id)
             logging.warning('Soil "%s" not found in soils directory (%s).' % (soil_id, soils_path))
             return None
+
+        file_path = soils_dict[soil_id]
+        file_stat = os.stat(file_path)
+        file_stat = (file_stat.st_mtime_ns, file_stat.st_size)
+
+        with SoilDAO.__cache_lock__:
+            cached_soil = SoilDAO.__cache__.get(soil_id)
+
+        if cached_soil and cached_soil.file_path == file_path and cached_soil.file_stat == file_stat:
+            return cached_soil
+
+        catalog = SoilDAO.catalog()
+        # Soils modified after the catalog was built are read from their files.
+        from_catalog = catalog is not None and soil_id in catalog and file_stat[0] <= catalog.file_stat[0] and \
+            os.path.abspath(catalog.source(soil_id)) == os.path.abspath(file_path)
+
+        # Parse outside the lock, so soils can be read in parallel (see SoilDAO.warm_up).
+        try:
+            if from_catalog:
+                cached_soil = CachedSoil(file_path, file_stat, catalog.get(soil_id), catalog.layers_bounds(soil_id))
+            else:
+                with open(file_path, encoding='latin-1') as f:
+                    cached_soil = CachedSoil(file_path, file_stat, json.load(f))
+        except Exception as ex:
+            print('@ soil file: "%s.json"' % soil_id)
+            raise ex
+
+        with SoilDAO.__cache_lock__:
+            SoilDAO.__cache__[soil_id] = cached_soil
+        return cached_soil
+
+    @staticmethod
+    def catalog():
+        """
+        :returns The soils catalog (which is opened again if it was rebuilt) or None if there's no catalog.
+        """
+        try:
+            file_stat = os.stat(catalog_path)
+        except OSError:
+            return None
+
+        with SoilDAO.__cache_lock__:
+            catalog = SoilDAO.__catalog__
+            if not catalog or catalog.file_stat != (file_stat.st_mtime_ns, file_stat.st_size):
+                catalog = SoilCatalog.open(catalog_path)
+                SoilDAO.__catalog__ = catalog
+            return catalog
+
+    @staticmethod
+    def warm_up(max_workers=4):
+        """
+        Reads every soil in the soils directory into the cache.
+        """
+        start_time = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='soils_warm_up') as \
+                executor:
+            futures = dict([(executor.submit(SoilDAO.get_cached_soil, soil_id), soil_id) for soil_id in soils_dict])
+
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception():
+                    logging.warning('Failed to load soil "%s". Reason: %s.' % (futures[future], future.exception()))
+        logging.info('Loaded %d soils (time=%.2fs).' % (len(soils_dict), time.time() - start_time))
+
+    @staticmethod
+    def calculate_metrics(soil_layers):
+        prev_layer_depth = 0
+        wilting_point = 0
+        field_capacity = 0
+        field_saturation = 0
+
+        for layer in soil_layers:
+            layer_depth = int(layer['sllb']) * 10
+            layer_depth_diff = layer_depth - prev_layer_depth
+
+            wilting_point += float(layer['slll']) * layer_depth_diff
+            field_capacity += float(layer['sldul']) * layer_depth_diff
+            field_saturation += float(layer['slsat']) * layer_depth_diff
+
+            prev_layer_depth = layer_depth
+
+        return {
+            'wilting_point': wilting_point,
+            'field_capacity': field_capacity,
+            'field_saturation': field_saturation,
+            'max_available_water': field_capacity - wilting_point
+        }
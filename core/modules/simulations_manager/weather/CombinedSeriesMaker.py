@@ -1,16 +1,21 @@
 # coding=utf-8
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from psycopg2.extras import DictCursor
 from core.lib.dssat.DSSATWthWriter import DSSATWthWriter
 from core.lib.utils.database import DatabaseUtils
 from core.lib.utils.extended_collections import DotDict
 from core.modules.simulations_manager.weather.DatabaseWeatherSeries import DatabaseWeatherSeries
+from core.modules.simulations_manager.weather.WeatherScenarioCache import WeatherScenarioCache
 import itertools
+import numpy as np
 
 __author__ = 'Federico Schmidt'
 
 
 class CombinedSeriesMaker(DatabaseWeatherSeries):
+    series_columns = ('fecha', 'fecha_original', 'tmax', 'tmin', 'prcp', 'rad')
+    history_columns = ('fecha', 'tmax', 'tmin', 'prcp', 'rad')
+
     def __init__(self, system_config, max_parallelism, weather_writer=None):
         if not weather_writer:
             weather_writer = DSSATWthWriter
@@ -18,22 +23,118 @@ class CombinedSeriesMaker(DatabaseWeatherSeries):
         self.campaign_first_month = system_config.get('campaign_first_month', 5)
 
     def create_from_db(self, location, forecast):
+        omm_id = location['weather_station']
+
+        for _, campaign_year, scen_weather in self.create_from_db_batch([omm_id], forecast):
+            yield (campaign_year, scen_weather)
+
+    def create_from_db_batch(self, omm_ids, forecast):
+        """
+        Exports every scenario year of the given weather stations with a single query (see pr_crear_series in
+        core/lib/SQL/Base Functions.sql) and splits the result stream by station and campaign year.
+        :param omm_ids: A list of weather stations ids.
+        :param forecast: The forecast the series are created for.
+        :returns A generator of (omm_id, campaign_year, rows) tuples where rows starts with a header row. Each rows
+        iterator must be consumed before advancing to the next tuple.
+        """
         forecast_date = forecast.forecast_date
         # Export 90 extra days from the database to avoid missing yields on crops that should be harvested a few days
         # after the campaign ends.
         start_date = (forecast.campaign_start_date - timedelta(days=90)).strftime('%Y-%m-%d')
         end_date = (forecast.campaign_end_date + timedelta(days=90)).strftime('%Y-%m-%d')
+
+        with self.system_config.database['weather_db'].connection() as wth_db_connection:
+            cursor = wth_db_connection.cursor()
+
+            cursor.execute("SELECT * FROM pr_crear_series(%s, %s, %s, %s, %s)",
+                           ([int(omm_id) for omm_id in omm_ids], start_date, forecast_date, end_date,
+                            self.campaign_first_month))
+            # The first two columns (omm_id, year_inflexion) are only used to split the stream.
+            colnames = [tuple([desc[0] for desc in cursor.description[2:]])]
+
+            for (omm_id, campaign_year), rows in itertools.groupby(cursor, key=lambda r: (r[0], r[1])):
+                yield (omm_id, campaign_year, itertools.chain(colnames, (r[2:] for r in rows)))
+
+    def create_from_cache(self, location, forecast):
+        """
+        Builds the same series as pr_crear_serie (see core/lib/SQL/Base Functions.sql) but only queries the observed
+        stretch of the campaign up to the forecast date. The historical part of each scenario is spliced from the
+        scenario cache, which is filled (with a single query) only for the campaign years that aren't cached yet.
+        """
+        forecast_date = datetime.strptime(forecast.forecast_date, '%Y-%m-%d').date()
+        start_date = (forecast.campaign_start_date - timedelta(days=90)).date()
+        end_date = (forecast.campaign_end_date + timedelta(days=90)).date()
         omm_id = location['weather_station']
+        data_version = self.scenario_cache.data_version()
+
+        with self.system_config.database['weather_db'].connection() as wth_db_connection:
+            cursor = wth_db_connection.cursor()
+            cursor.execute("SELECT fecha, tmax, tmin, prcp, rad FROM estacion_registro_diario_completo "
+                           "WHERE omm_id = %s AND fecha BETWEEN %s AND %s ORDER BY fecha",
+                           (omm_id, start_date, forecast_date))
+            observed = WeatherScenarioCache.to_array(((r[0], r[0]) + tuple(r[1:]) for r in cursor), self.series_columns)
+            cursor.close()
+
+            full_campaigns = self.__full_campaigns__(wth_db_connection, omm_id, data_version)
+            histories = self.__campaigns_history__(wth_db_connection, omm_id, full_campaigns, data_version)
+
+        # Same bounds than pr_crear_serie: the historical stretch starts the day after the forecast date (in the
+        # scenario year) and spans as many days as there are between the forecast date and the series end date.
+        n_days = (end_date - start_date).days + 1
+        n_history_days = (end_date - forecast_date).days
+
+        for campaign_year in full_campaigns:
+            if (forecast_date.month, forecast_date.day) == (2, 29):
+                history_start = date(campaign_year, 3, 1)
+            else:
+                history_start = forecast_date.replace(year=campaign_year) + timedelta(days=1)
+            history_end = history_start + timedelta(days=n_history_days - 1)
+
+            history = histories[campaign_year]
+            history = history[(history['fecha'] >= np.datetime64(history_start)) &
+                              (history['fecha'] <= np.datetime64(history_end))]
+
+            history_series = np.empty(len(history), dtype=observed.dtype)
+            for column in self.history_columns:
+                history_series[column] = history[column]
+            history_series['fecha_original'] = history['fecha']
+
+            series = np.concatenate((observed, history_series))[0:n_days]
+            # Renumber dates continuously starting at the series start date.
+            series['fecha'] = np.datetime64(start_date) + np.arange(len(series))
+            yield (campaign_year, series)
+
+    def __campaigns_history__(self, wth_db_connection, omm_id, campaign_years, data_version):
+        """
+        Gets the daily records that any combined series of the given campaign years could use, i.e. from the start of
+        the campaign year to the end of the second following year. Missing years are exported in a single query.
+        :returns A dict mapping each campaign year to a structured array (see WeatherScenarioCache.to_array).
+        """
+        histories = {}
+        missing_years = []
+
+        for campaign_year in campaign_years:
+            key = WeatherScenarioCache.key('history', omm_id, campaign_year, self.campaign_first_month)
+            history = self.scenario_cache.get(key, data_version)
+
+            if history is None:
+                missing_years.append(campaign_year)
+            else:
+                histories[campaign_year] = history
 
-        wth_db_connection = self.system_config.database['weather_db']
-        cursor = wth_db_connection.cursor()
+        if len(missing_years) > 0:
+            cursor = wth_db_connection.cursor()
+            cursor.execute("SELECT fecha, tmax, tmin, prcp, rad FROM estacion_registro_diario_completo "
+                           "WHERE omm_id = %s AND fecha BETWEEN %s AND %s ORDER BY fecha",
+                           (omm_id, date(min(missing_years), 1, 1), date(max(missing_years) + 2, 12, 31)))
+            records = WeatherScenarioCache.to_array(cursor, self.history_columns)
+            cursor.close()
 
-        cursor.execute('SELECT pr_campañas_completas(%s, %s)', (omm_id, self.campaign_first_month))
-        full_campaigns = cursor.fetchall()
+            for campaign_year in missing_years:
+                history = records[(records['fecha'] >= np.datetime64(date(campaign_year, 1, 1))) &
+                                  (records['fecha'] <= np.datetime64(date(campaign_year + 2, 12, 31)))]
+                key = WeatherScenarioCache.key('history', omm_id, campaign_year, self.campaign_first_month)
+                self.scenario_cache.put(key, data_version, history)
+                histories[campaign_year] = history
 
-        for campaign in full_campaigns:
-            campaign_year = campaign[0]
-            cursor.execute("SELECT * FROM pr_crear_serie(%s, %s, %s, %s, %s)",
-                           (omm_id, start_date, forecast_date, end_date, campaign_year))
-            colnames = [tuple([desc[0] for desc in cursor.description])]
-            yield (campaign_year, itertools.chain(colnames, cursor))
+        return histories
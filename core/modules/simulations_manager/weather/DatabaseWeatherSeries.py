@@ -1,24 +1,51 @@
+# coding=utf-8
 import abc
+import concurrent.futures
 import logging
+import multiprocessing
 import re
 import threading
 import os.path
+import numpy as np
 
 from core.modules.simulations_manager.weather.WeatherSeriesMaker import WeatherSeriesMaker
+from core.modules.simulations_manager.weather.WeatherScenarioCache import WeatherScenarioCache
 from core.lib.geo.grid import latlon_to_grid
 from core.lib.io.file import listdir_fullpath, create_folder_with_permissions
 
 __author__ = 'Federico Schmidt'
 
 
+def write_station_series(weather_writer, scenarios, output_folder, location, forecast_date, extract_rainfall):
+    """
+    Writes the weather files of a station. Runs in the weather writers process pool when it's enabled.
+    :param scenarios: An iterable of (scenario year, scenario weather) tuples.
+    :returns A (scenario names, rainfall data) tuple.
+    """
+    rainfall_dict = dict()
+    scen_names = []
+
+    for scen_index, (scen_year, scen_weather) in enumerate(scenarios):
+        variables_dict = weather_writer.write_wth_file(scen_index, scen_weather, output_folder, location)
+        if extract_rainfall:
+            weather_writer.extract_rainfall(rainfall_dict, variables_dict, forecast_date, scen_year)
+        scen_names.append(scen_year)
+
+    return scen_names, rainfall_dict
+
+
 class DatabaseWeatherSeries(WeatherSeriesMaker):
     name_re = re.compile('^[0-9]+ - ([0-9]+)\.csv')
+    # Process pool shared by every forecast to write weather files (see "weather_writer_processes" in system.yaml).
+    __writers_pool__ = None
+    __writers_pool_lock__ = threading.Lock()
 
     def __init__(self, system_config, max_parallelism, weather_writer):
         super(DatabaseWeatherSeries, self).__init__(system_config, max_parallelism)
         self.max_paralellism = max_parallelism
         self.weather_writer = weather_writer
         self.concurrency_lock = threading.BoundedSemaphore(self.max_paralellism)
+        self.scenario_cache = WeatherScenarioCache.from_config(system_config)
 
     def create_series(self, location, forecast, extract_rainfall=True):
         with self.concurrency_lock:
@@ -38,17 +65,23 @@ class DatabaseWeatherSeries(WeatherSeriesMaker):
             if not os.path.exists(grid_column_folder):
                 create_folder_with_permissions(grid_column_folder)
 
-            rainfall_dict = dict()
-            scen_names = []
-            scen_index = 0
-            for scen_year, scen_weather in self.create_from_db(location, forecast):
-                variables_dict = self.weather_writer.write_wth_file(scen_index, scen_weather, grid_column_folder,
-                                                                    location)
-                if extract_rainfall:
-                    self.weather_writer.extract_rainfall(rainfall_dict, variables_dict, forecast.forecast_date,
-                                                         scen_year)
-                scen_names.append(scen_year)
-                scen_index += 1
+            if self.scenario_cache:
+                scenarios = self.create_from_cache(location, forecast)
+            else:
+                scenarios = self.create_from_db(location, forecast)
+
+            writers_pool = DatabaseWeatherSeries.writers_pool(self.system_config)
+            if writers_pool:
+                # The series are fetched in this thread and written by a worker process. Row iterators are consumed
+                # here since they can't be sent to another process.
+                scenarios = [(scen_year, scen_weather if isinstance(scen_weather, np.ndarray) else list(scen_weather))
+                             for scen_year, scen_weather in scenarios]
+                scen_names, rainfall_dict = writers_pool.submit(write_station_series, self.weather_writer, scenarios,
+                                                                grid_column_folder, location, forecast.forecast_date,
+                                                                extract_rainfall).result()
+            else:
+                scen_names, rainfall_dict = write_station_series(self.weather_writer, scenarios, grid_column_folder,
+                                                                 location, forecast.forecast_date, extract_rainfall)
 
             if extract_rainfall:
                 forecast.rainfall[str(omm_id)] = rainfall_dict
@@ -57,13 +90,56 @@ class DatabaseWeatherSeries(WeatherSeriesMaker):
             forecast.weather_stations[omm_id]['num_scenarios'] = len(scen_names)
             forecast.weather_stations[omm_id]['scen_names'] = scen_names
 
+    @staticmethod
+    def writers_pool(system_config):
+        """
+        :returns The process pool used to write weather files or None if "weather_writer_processes" isn't set.
+        """
+        processes = system_config.get('weather_writer_processes', 0)
+        if not processes:
+            return None
+
+        with DatabaseWeatherSeries.__writers_pool_lock__:
+            if not DatabaseWeatherSeries.__writers_pool__:
+                if not isinstance(processes, int) or processes < 1:
+                    raise RuntimeError('Invalid weather_writer_processes value (%s).' % processes)
+                # The pool is created lazily, once the scheduler and the web server threads are running, so workers
+                # are started by a fork server: forking this process could leave a worker waiting on a lock taken by
+                # one of those threads.
+                DatabaseWeatherSeries.__writers_pool__ = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=processes, mp_context=multiprocessing.get_context('forkserver'))
+            return DatabaseWeatherSeries.__writers_pool__
+
     @abc.abstractmethod
     def create_from_db(self, location, forecast):
         return iter([])
 
+    def create_from_cache(self, location, forecast):
+        """
+        Same as create_from_db but reusing the historical scenarios stored in the scenario cache. Subclasses that can't
+        take advantage of the cache fall back to a full export from the database.
+        """
+        return self.create_from_db(location, forecast)
+
+    def __full_campaigns__(self, wth_db_connection, omm_id, data_version):
+        """
+        Finds the complete campaigns of a weather station (see pr_campañas_completas), using the scenario cache.
+        """
+        key = WeatherScenarioCache.key('campaigns', omm_id, None, self.campaign_first_month)
+        campaigns = self.scenario_cache.get(key, data_version)
+
+        if campaigns is None:
+            cursor = wth_db_connection.cursor()
+            cursor.execute('SELECT pr_campañas_completas(%s, %s)', (omm_id, self.campaign_first_month))
+            campaigns = np.array([c[0] for c in cursor.fetchall()], dtype='i4')
+            cursor.close()
+            self.scenario_cache.put(key, data_version, campaigns)
+
+        return campaigns.tolist()
+
     @staticmethod
     def validate_location(location_yaml, forecast, system_config):
-        weather_db_connection = system_config.database['weather_db']
+        weather_db_pool = system_config.database['weather_db']
         name = location_yaml['name']
 
         if 'weather_station' not in location_yaml or len(str(location_yaml['weather_station'])) == 0:
@@ -85,10 +161,13 @@ class DatabaseWeatherSeries(WeatherSeriesMaker):
             LIMIT 1
             """
 
-            cursor = weather_db_connection.cursor()
-            cursor.execute(nearest_station_query, (coord_x, coord_y))
+            with weather_db_pool.connection() as weather_db_connection:
+                cursor = weather_db_connection.cursor()
+                cursor.execute(nearest_station_query, (coord_x, coord_y))
+
+                result = cursor.fetchone()
+                cursor.close()
 
-            result = cursor.fetchone()
             logging.debug('Found station "%s" at %s kilometers from (%s, %s) for location "%s".' % (
                 result[2], result[0], coord_y, coord_x, name
             ))
@@ -103,10 +182,13 @@ class DatabaseWeatherSeries(WeatherSeriesMaker):
             SELECT e.nombre, e.lat_dec, e.lon_dec FROM estacion e WHERE e.omm_id = %s
             """
 
-            cursor = weather_db_connection.cursor()
-            cursor.execute(find_station, (location_yaml['weather_station'], ))
+            with weather_db_pool.connection() as weather_db_connection:
+                cursor = weather_db_connection.cursor()
+                cursor.execute(find_station, (location_yaml['weather_station'], ))
+
+                result = cursor.fetchone()
+                cursor.close()
 
-            result = cursor.fetchone()
             if not result:
                 raise RuntimeError('No weather station found with id = %s for location "%s".' %
                                    (location_yaml['weather_station'], name))
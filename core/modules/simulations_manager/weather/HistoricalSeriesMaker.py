@@ -3,11 +3,14 @@ import itertools
 import logging
 from core.lib.dssat.DSSATWthWriter import DSSATWthWriter
 from core.modules.simulations_manager.weather.DatabaseWeatherSeries import DatabaseWeatherSeries
+from core.modules.simulations_manager.weather.WeatherScenarioCache import WeatherScenarioCache
 
 __author__ = 'Federico Schmidt'
 
 
 class HistoricalSeriesMaker(DatabaseWeatherSeries):
+    series_columns = ('fecha', 'fecha_original', 'tmax', 'tmin', 'prcp', 'rad')
+
     def __init__(self, system_config, max_parallelism, weather_writer=None):
         if not weather_writer:
             weather_writer = DSSATWthWriter
@@ -33,15 +36,42 @@ class HistoricalSeriesMaker(DatabaseWeatherSeries):
     def create_from_db(self, location, forecast):
         omm_id = location['weather_station']
 
-        wth_db_connection = self.system_config.database['weather_db']
-        cursor = wth_db_connection.cursor()
+        with self.system_config.database['weather_db'].connection() as wth_db_connection:
+            cursor = wth_db_connection.cursor()
+
+            cursor.execute('SELECT pr_campañas_completas(%s, %s)', (omm_id, self.campaign_first_month))
+            full_campaigns = cursor.fetchall()
+
+            for campaign in full_campaigns:
+                campaign_year = campaign[0]
+                cursor.execute("SELECT * FROM pr_serie_agraria(%s, %s, %s)",
+                               (omm_id, campaign_year, self.campaign_first_month))
+                colnames = [tuple([desc[0] for desc in cursor.description])]
+                yield (campaign_year, itertools.chain(colnames, cursor))
+
+    def create_from_cache(self, location, forecast):
+        """
+        Historical series don't depend on the forecast date, so every pr_serie_agraria export is cached as is and
+        only the campaign years that aren't cached yet are queried.
+        """
+        omm_id = location['weather_station']
+        data_version = self.scenario_cache.data_version()
+
+        with self.system_config.database['weather_db'].connection() as wth_db_connection:
+            cursor = wth_db_connection.cursor()
+
+            for campaign_year in self.__full_campaigns__(wth_db_connection, omm_id, data_version):
+                key = WeatherScenarioCache.key('serie_agraria', omm_id, campaign_year, self.campaign_first_month)
+                series = self.scenario_cache.get(key, data_version)
+
+                if series is None:
+                    cursor.execute("SELECT fecha, fecha_original, tmax, tmin, prcp, rad "
+                                   "FROM pr_serie_agraria(%s, %s, %s)",
+                                   (omm_id, campaign_year, self.campaign_first_month))
+                    series = WeatherScenarioCache.to_array(cursor, self.series_columns)
+                    self.scenario_cache.put(key, data_version, series)
 
-        cursor.execute('SELECT pr_campañas_completas(%s, %s)', (omm_id, self.campaign_first_month))
-        full_campaigns = cursor.fetchall()
+                # The weather writer takes the structured array as is (see DSSATWthWriter.write_wth_columns).
+                yield (campaign_year, series)
 
-        for campaign in full_campaigns:
-            campaign_year = campaign[0]
-            cursor.execute("SELECT * FROM pr_serie_agraria(%s, %s, %s)",
-                           (omm_id, campaign_year, self.campaign_first_month))
-            colnames = [tuple([desc[0] for desc in cursor.description])]
-            yield (campaign_year, itertools.chain(colnames, cursor))
+            cursor.close()
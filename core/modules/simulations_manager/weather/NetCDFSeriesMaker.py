@@ -1,4 +1,3 @@
-import itertools
 from core.lib.dssat.DSSATWthWriter import DSSATWthWriter
 
 __author__ = 'Federico Schmidt'
@@ -7,9 +6,8 @@ import threading
 import os.path
 # Do not remove this import, prevents a bug in strptime when using it in parallel.
 import _strptime
-from datetime import datetime, timedelta
-from netCDF4 import Dataset
 from core.modules.simulations_manager.weather.WeatherSeriesMaker import WeatherSeriesMaker
+from core.modules.simulations_manager.weather.NetCDFSource import NetCDFSource
 from core.lib.io.file import create_folder_with_permissions
 import numpy as np
 
@@ -22,6 +20,8 @@ class NetCDFSeriesMaker(WeatherSeriesMaker):
         self.max_paralellism = max_parallelism
         self.weather_writer = weather_writer
         self.concurrency_lock = threading.BoundedSemaphore(self.max_paralellism)
+        self.netcdf_source = None
+        self.netcdf_source_lock = threading.Lock()
 
     def create_series(self, location, forecast, extract_rainfall=True):
         with self.concurrency_lock:
@@ -41,56 +41,21 @@ class NetCDFSeriesMaker(WeatherSeriesMaker):
             if not os.path.exists(grid_column_folder):
                 create_folder_with_permissions(grid_column_folder)
 
-            nc = Dataset(forecast.configuration.netcdf_source, mode='r')
-
-            varnames = {
-                'x': forecast.configuration.netcdf_variables.get('coord_x', 'x'),
-                'y': forecast.configuration.netcdf_variables.get('coord_y', 'y'),
-                'time': forecast.configuration.netcdf_variables.get('time', 'time'),
-                'scen': forecast.configuration.netcdf_variables.get('scenario', None),
-                'tx': forecast.configuration.netcdf_variables.get('tx', 'tx'),
-                'tn': forecast.configuration.netcdf_variables.get('tn', 'tn'),
-                'prcp': forecast.configuration.netcdf_variables.get('prcp', 'prcp'),
-                'srad': forecast.configuration.netcdf_variables.get('srad', 'srad')
-            }
-
-            if 'scenario' in forecast.configuration.netcdf_variables:
-                varnames['scen'] = forecast.configuration.netcdf_variables['scenario']
-
-            x_proj = nc.variables[varnames['x']][:].tolist()
-            y_proj = nc.variables[varnames['y']][:].tolist()
-
-            ref_date = datetime.strptime(nc.variables[varnames['time']].units, 'Days since %Y-%m-%d')
-
-            fecha = [ref_date + timedelta(days=d.item()) for d in nc.variables[varnames['time']]]
-
-            scenarios = [0]
-            # Creating a scenario dimension in the NetCDF is optional.
-            if varnames['scen'] and len(varnames['scen']) > 0:
-                scenarios = nc.variables[varnames['scen']][:].tolist()
-            else:
-                # If it's an empty variable name, coerce it to None.
-                varnames['scen'] = None
-
-            x_idx = x_proj.index(float(location['netcdf_x']))
-            y_idx = y_proj.index(float(location['netcdf_y']))
+            source = self.__netcdf_source__(forecast)
+            x_idx, y_idx = source.cell(location['netcdf_x'], location['netcdf_y'])
+            clim = source.read_cell(x_idx, y_idx)
 
             rainfall_dict = dict()
             scen_names = []
 
-            for scen_index, scenario in enumerate(scenarios):
-                clim = {}
-
-                for climate_variable in ['tx', 'tn', 'prcp', 'srad']:
-                    access_t = self.get_access_tuple(nc.variables[varnames[climate_variable]].dimensions,
-                                                     varnames, x_idx, y_idx, scen_index)
-                    clim[climate_variable] = nc.variables[varnames[climate_variable]][access_t]
-
-                clim['srad'] = np.maximum(clim['srad'], 1).tolist()
-
-                rows = list(zip(fecha, clim['tx'], clim['tn'], clim['prcp'], clim['srad']))
-                colnames = [tuple(['fecha', 'tmax', 'tmin', 'prcp', 'rad'])]
-                scen_weather = itertools.chain(colnames, rows)
+            for scen_index, scenario in enumerate(source.scenarios):
+                scen_weather = {
+                    'fecha': source.dates,
+                    'tmax': clim['tx'][scen_index],
+                    'tmin': clim['tn'][scen_index],
+                    'prcp': clim['prcp'][scen_index],
+                    'rad': np.maximum(clim['srad'][scen_index], 1)
+                }
 
                 variables_dict = self.weather_writer.write_wth_file(scen_index, scen_weather, grid_column_folder,
                                                                     location)
@@ -106,22 +71,38 @@ class NetCDFSeriesMaker(WeatherSeriesMaker):
             forecast.weather_stations[zone_id]['num_scenarios'] = len(scen_names)
             forecast.weather_stations[zone_id]['scen_names'] = scen_names
 
+    def __netcdf_source__(self, forecast):
+        """
+        Opens the forecast's NetCDF file the first time it's needed. The series maker is instantiated once per forecast
+        run, so every location (and thread) shares the same open file and coordinate indexes.
+        The cells of every zone of the forecast are registered at once to read them in chunk-aligned blocks (see
+        NetCDFSource.prefetch).
+        """
+        with self.netcdf_source_lock:
+            if not self.netcdf_source:
+                self.netcdf_source = NetCDFSource.from_forecast(forecast)
+
+                cells = {}
+                for location in forecast['locations'].values():
+                    # A single series is created for each zone.
+                    try:
+                        cells[location['weather_station']] = self.netcdf_source.cell(location['netcdf_x'],
+                                                                                     location['netcdf_y'])
+                    except RuntimeError:
+                        # The error is raised when creating the series of this zone.
+                        continue
+                self.netcdf_source.prefetch(cells.values())
+            return self.netcdf_source
+
+    def close(self):
+        with self.netcdf_source_lock:
+            if self.netcdf_source:
+                self.netcdf_source.close()
+                self.netcdf_source = None
+
     @staticmethod
     def get_access_tuple(var_dimensions, varnames, x_idx, y_idx, scen_number):
-        time_var_idx = var_dimensions.index(varnames['time'])
-        x_var_idx = var_dimensions.index(varnames['x'])
-        y_var_idx = var_dimensions.index(varnames['y'])
-
-        access_tuple = [None] * 3
-        if varnames['scen'] is not None:
-            access_tuple = [None] * 4
-            access_tuple[var_dimensions.index(varnames['scen'])] = scen_number
-
-        access_tuple[x_var_idx] = x_idx
-        access_tuple[y_var_idx] = y_idx
-        access_tuple[time_var_idx] = Ellipsis
-
-        return tuple(access_tuple)
+        return NetCDFSource.get_access_tuple(var_dimensions, varnames, x_idx, y_idx, scen_number)
 
     @staticmethod
     def validate_location(location_yaml, forecast, system_config):
@@ -0,0 +1,205 @@
+import threading
+from datetime import datetime
+from netCDF4 import Dataset
+import numpy as np
+
+__author__ = 'Federico Schmidt'
+
+
+class CoordinateIndex:
+    """
+    Sorted index of a NetCDF coordinate variable used to find the cell nearest to a projected coordinate in
+    O(log n).
+    """
+    def __init__(self, values, tolerance=None):
+        values = np.asarray(values, dtype='f8')
+        self.order = np.argsort(values, kind='mergesort')
+        self.sorted_values = values[self.order]
+
+        if tolerance is None:
+            # Half the (smallest) cell size: a coordinate always falls within one cell.
+            steps = np.diff(self.sorted_values)
+            steps = steps[steps > 0]
+            tolerance = 0.5 * steps.min() if len(steps) > 0 else 0.
+        self.tolerance = tolerance
+
+    def nearest(self, value):
+        """
+        :returns The index (in the original variable) of the cell nearest to the given value.
+        :raise RuntimeError: If the nearest cell is further than the index tolerance.
+        """
+        value = float(value)
+        position = int(np.searchsorted(self.sorted_values, value))
+        candidates = [p for p in (position - 1, position) if 0 <= p < len(self.sorted_values)]
+
+        if len(candidates) == 0:
+            raise RuntimeError('Coordinate %s not found: the coordinate variable is empty.' % value)
+
+        nearest = min(candidates, key=lambda p: abs(self.sorted_values[p] - value))
+        if abs(self.sorted_values[nearest] - value) > self.tolerance:
+            raise RuntimeError('Coordinate %s is outside the NetCDF grid (nearest cell at %s).' %
+                               (value, self.sorted_values[nearest]))
+        return int(self.order[nearest])
+
+
+class NetCDFSource:
+    """
+    A NetCDF weather file opened once per forecast and shared by every thread creating weather series for it. The
+    coordinates, dates and scenarios are read once when the file is opened.
+
+    Cells registered with prefetch are read in blocks aligned to the (x, y) chunks of the climate variables: the first
+    read of a cell loads its whole block (every scenario and date) and the following cells of the block are served
+    from memory, so each chunk is decompressed once per forecast. A block is released as soon as all of its
+    registered cells have been read.
+    """
+    climate_variables = ['tx', 'tn', 'prcp', 'srad']
+    # Block size used when the variables aren't chunked (contiguous storage).
+    contiguous_block_size = 16
+
+    def __init__(self, file_path, varnames):
+        self.file_path = file_path
+        self.varnames = varnames
+        # The NetCDF/HDF5 libraries aren't thread safe, every read must hold this lock.
+        self.lock = threading.Lock()
+        self.dataset = Dataset(file_path, mode='r')
+
+        variables = self.dataset.variables
+        self.x_index = CoordinateIndex(variables[varnames['x']][:])
+        self.y_index = CoordinateIndex(variables[varnames['y']][:])
+
+        time_variable = variables[varnames['time']]
+        ref_date = datetime.strptime(time_variable.units, 'Days since %Y-%m-%d')
+        self.dates = np.datetime64(ref_date.date(), 'D') + np.floor(time_variable[:]).astype('i8')
+
+        self.scenarios = [0]
+        if varnames['scen']:
+            self.scenarios = variables[varnames['scen']][:].tolist()
+
+        self.block_size = self.__block_size__()
+        self.blocks = {}
+        self.pending_cells = {}
+
+    @staticmethod
+    def from_forecast(forecast):
+        netcdf_variables = forecast.configuration.netcdf_variables
+
+        varnames = {
+            'x': netcdf_variables.get('coord_x', 'x'),
+            'y': netcdf_variables.get('coord_y', 'y'),
+            'time': netcdf_variables.get('time', 'time'),
+            # Creating a scenario dimension in the NetCDF is optional, an empty variable name is coerced to None.
+            'scen': netcdf_variables.get('scenario', None) or None,
+            'tx': netcdf_variables.get('tx', 'tx'),
+            'tn': netcdf_variables.get('tn', 'tn'),
+            'prcp': netcdf_variables.get('prcp', 'prcp'),
+            'srad': netcdf_variables.get('srad', 'srad')
+        }
+        return NetCDFSource(forecast.configuration.netcdf_source, varnames)
+
+    def cell(self, netcdf_x, netcdf_y):
+        """
+        :returns The (x, y) indexes of the grid cell nearest to the given projected coordinates.
+        """
+        return self.x_index.nearest(netcdf_x), self.y_index.nearest(netcdf_y)
+
+    def prefetch(self, cells):
+        """
+        Registers the cells that are going to be read, each one must be read once with read_cell.
+        :param cells: An iterable of (x, y) indexes.
+        """
+        with self.lock:
+            for x_idx, y_idx in cells:
+                block_key = self.__block_key__(x_idx, y_idx)
+                self.pending_cells[block_key] = self.pending_cells.get(block_key, 0) + 1
+
+    def read_cell(self, x_idx, y_idx):
+        """
+        Reads the climate variables of a grid cell.
+        :returns A dict mapping each climate variable to a (masked) array of shape (scenarios, time).
+        """
+        block_key = self.__block_key__(x_idx, y_idx)
+
+        with self.lock:
+            if block_key not in self.pending_cells:
+                # Not prefetched, read only this cell.
+                block = self.__read_block__(slice(x_idx, x_idx + 1), slice(y_idx, y_idx + 1))
+                return dict([(v, block[v][0, 0]) for v in self.climate_variables])
+
+            x_start, y_start = block_key[0] * self.block_size[0], block_key[1] * self.block_size[1]
+            if block_key not in self.blocks:
+                self.blocks[block_key] = self.__read_block__(slice(x_start, x_start + self.block_size[0]),
+                                                             slice(y_start, y_start + self.block_size[1]))
+            block = self.blocks[block_key]
+            clim = dict([(v, block[v][x_idx - x_start, y_idx - y_start].copy()) for v in self.climate_variables])
+
+            self.pending_cells[block_key] -= 1
+            if self.pending_cells[block_key] == 0:
+                del self.pending_cells[block_key]
+                del self.blocks[block_key]
+        return clim
+
+    def close(self):
+        with self.lock:
+            self.blocks.clear()
+            self.pending_cells.clear()
+            self.dataset.close()
+
+    def __read_block__(self, x_slice, y_slice):
+        """
+        Reads a rectangle of cells of every climate variable (with all their scenarios and dates). Must be called
+        holding the lock.
+        :returns A dict mapping each climate variable to an array of shape (x, y, scenarios, time).
+        """
+        block = {}
+        for climate_variable in self.climate_variables:
+            variable = self.dataset.variables[self.varnames[climate_variable]]
+            dimensions = variable.dimensions
+
+            access_t = [slice(None)] * len(dimensions)
+            access_t[dimensions.index(self.varnames['x'])] = x_slice
+            access_t[dimensions.index(self.varnames['y'])] = y_slice
+            values = variable[tuple(access_t)]
+
+            if self.varnames['scen'] is None:
+                # Add a single scenario axis.
+                values = values[..., np.newaxis]
+                scen_axis = len(dimensions)
+            else:
+                scen_axis = dimensions.index(self.varnames['scen'])
+
+            values = values.transpose(dimensions.index(self.varnames['x']), dimensions.index(self.varnames['y']),
+                                      scen_axis, dimensions.index(self.varnames['time']))
+            block[climate_variable] = values
+        return block
+
+    def __block_key__(self, x_idx, y_idx):
+        return x_idx // self.block_size[0], y_idx // self.block_size[1]
+
+    def __block_size__(self):
+        """
+        The (x, y) size of the blocks read, taken from the chunking of the first climate variable.
+        """
+        variable = self.dataset.variables[self.varnames[self.climate_variables[0]]]
+        chunking = variable.chunking()
+
+        if chunking == 'contiguous' or chunking is None:
+            return self.contiguous_block_size, self.contiguous_block_size
+        return chunking[variable.dimensions.index(self.varnames['x'])], \
+            chunking[variable.dimensions.index(self.varnames['y'])]
+
+    @staticmethod
+    def get_access_tuple(var_dimensions, varnames, x_idx, y_idx, scen_number):
+        time_var_idx = var_dimensions.index(varnames['time'])
+        x_var_idx = var_dimensions.index(varnames['x'])
+        y_var_idx = var_dimensions.index(varnames['y'])
+
+        access_tuple = [None] * 3
+        if varnames['scen'] is not None:
+            access_tuple = [None] * 4
+            access_tuple[var_dimensions.index(varnames['scen'])] = scen_number
+
+        access_tuple[x_var_idx] = x_idx
+        access_tuple[y_var_idx] = y_idx
+        access_tuple[time_var_idx] = Ellipsis
+
+        return tuple(access_tuple)
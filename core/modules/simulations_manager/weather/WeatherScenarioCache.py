@@ -0,0 +1,130 @@
+import os
+import shutil
+import threading
+import uuid
+import numpy as np
+from xxhash import xxh64
+
+__author__ = 'Federico Schmidt'
+
+
+class WeatherScenarioCache:
+    """
+    On-disk cache of historical weather scenarios exported from the weather database.
+
+    Entries are content addressed by a (kind, omm_id, campaign year, campaign_first_month) key and grouped inside a
+    folder for each data version. The data version is bumped every time the weather materialized view is refreshed
+    (see WeatherUpdater.refresh_view), which makes every previously cached entry unreachable.
+    """
+    version_file_name = 'VERSION'
+
+    def __init__(self, cache_path):
+        self.cache_path = os.path.abspath(cache_path)
+        self.lock = threading.Lock()
+
+        if not os.path.exists(self.cache_path):
+            os.makedirs(self.cache_path)
+
+    @staticmethod
+    def from_config(system_config):
+        """
+        Creates a cache instance if the "weather_cache" path is defined in the system configuration.
+        :returns A WeatherScenarioCache instance or None if the cache is disabled.
+        """
+        paths = system_config.get('paths', None)
+        if not paths or not paths.get('weather_cache', None):
+            return None
+        return WeatherScenarioCache(paths['weather_cache'])
+
+    def data_version(self):
+        version_file = os.path.join(self.cache_path, self.version_file_name)
+
+        if not os.path.exists(version_file):
+            return 0
+        with open(version_file, mode='r') as f:
+            return int(f.read().strip() or 0)
+
+    def bump_data_version(self):
+        """
+        Increments the data version and removes the entries cached for older versions.
+        :returns The new data version.
+        """
+        with self.lock:
+            version = self.data_version() + 1
+            self.__atomic_write__(os.path.join(self.cache_path, self.version_file_name), str(version).encode('ascii'))
+
+            for entry in os.listdir(self.cache_path):
+                entry_path = os.path.join(self.cache_path, entry)
+                if os.path.isdir(entry_path) and entry != self.__version_folder_name__(version):
+                    shutil.rmtree(entry_path, ignore_errors=True)
+            return version
+
+    def get(self, key, version):
+        entry_path = self.__entry_path__(key, version)
+
+        if not os.path.exists(entry_path):
+            return None
+        try:
+            return np.load(entry_path, allow_pickle=False)
+        except (IOError, ValueError):
+            # Corrupted or partially written entry, it'll be overwritten.
+            return None
+
+    def put(self, key, version, array):
+        entry_path = self.__entry_path__(key, version)
+        version_folder = os.path.dirname(entry_path)
+
+        if not os.path.exists(version_folder):
+            os.makedirs(version_folder, exist_ok=True)
+
+        tmp_path = '%s.%s.tmp' % (entry_path, uuid.uuid4().hex)
+        with open(tmp_path, mode='wb') as f:
+            np.save(f, array, allow_pickle=False)
+        # Rename is atomic, concurrent readers see either the old entry or the new one.
+        os.replace(tmp_path, entry_path)
+
+    @staticmethod
+    def key(kind, omm_id, campaign_year, campaign_first_month):
+        return kind, int(omm_id), campaign_year, int(campaign_first_month)
+
+    @staticmethod
+    def to_array(rows, columns):
+        """
+        Converts database rows into a structured array. Columns named "fecha*" are stored as dates, the rest as
+        floats (NULL values are stored as NaN).
+        :param rows: An iterable of rows (tuples).
+        :param columns: The column names of each row.
+        """
+        dtype = [(c, 'datetime64[D]' if c.startswith('fecha') else 'f8') for c in columns]
+        records = [tuple((np.datetime64('NaT') if v is None else v) if c.startswith('fecha') else
+                         (np.nan if v is None else v) for c, v in zip(columns, r)) for r in rows]
+        return np.array(records, dtype=dtype)
+
+    @staticmethod
+    def to_rows(array):
+        """
+        Converts a structured array created by to_array back into a list of rows (dates are returned as
+        datetime.date instances and NaN values as None).
+        """
+        columns = []
+        for c in array.dtype.names:
+            if c.startswith('fecha'):
+                columns.append(array[c].astype(object).tolist())
+            else:
+                columns.append([None if np.isnan(v) else v for v in array[c].tolist()])
+        return list(zip(*columns))
+
+    def __entry_path__(self, key, version):
+        entry_name = xxh64(repr(key).encode('utf8')).hexdigest() + '.npy'
+        return os.path.join(self.cache_path, self.__version_folder_name__(version), entry_name)
+
+    @staticmethod
+    def __version_folder_name__(version):
+        return 'v%d' % version
+
+    @staticmethod
+    def __atomic_write__(file_path, content):
+        tmp_path = '%s.%s.tmp' % (file_path, uuid.uuid4().hex)
+        with open(tmp_path, mode='wb') as f:
+            f.write(content)
+        os.replace(tmp_path, file_path)
@@ -12,6 +12,12 @@ class WeatherSeriesMaker(metaclass=abc.ABCMeta):
     def create_series(self, location, forecast, extract_rainfall=False):
         pass
 
+    def close(self):
+        """
+        Releases the resources held by the series maker once every series of the forecast has been created.
+        """
+        pass
+
     @staticmethod
     def validate_location(location_yaml, forecast, system_config):
         """
@@ -19,12 +19,12 @@ class CSVCombinedSeriesMaker(CSVDatabaseWeatherSeries):
         start_date = forecast.campaign_start_date.strftime('%Y-%m-%d')
         end_date = forecast.campaign_end_date.strftime('%Y-%m-%d')
 
-        wth_db_connection = self.system_config.database['weather_db']
-        cursor = wth_db_connection.cursor()
-
-        # start_time = time.time()
-        cursor.execute("SELECT pr_create_campaigns(%s, %s, %s, %s, %s)",
-                       (omm_id, start_date, forecast_date, end_date,
-                        wth_output))
-        # logging.getLogger().debug("Station: %s. Date: %s. Time: %s." %
-        #                           (omm_id, forecast_date, (time.time() - start_time)))
+        with self.system_config.database['weather_db'].connection() as wth_db_connection:
+            cursor = wth_db_connection.cursor()
+
+            # start_time = time.time()
+            cursor.execute("SELECT pr_create_campaigns(%s, %s, %s, %s, %s)",
+                           (omm_id, start_date, forecast_date, end_date,
+                            wth_output))
+            # logging.getLogger().debug("Station: %s. Date: %s. Time: %s." %
+            #                           (omm_id, forecast_date, (time.time() - start_time)))
@@ -1,7 +1,5 @@
 #!/usr/bin/env bash
 
-cd "%s" # pSIMS path.
-rm -rf "./campaigns/run/*"
-rm -rf "./campaigns/run"
-cp -rf "%s" "./campaigns/run" # Rundir path.
-./psims -s local -p "./campaigns/run/params" -c "./campaigns/run" -g "./campaigns/run/gridList.txt"
\ No newline at end of file
+cd "%s" # pSIMS working directory (a view of the pSIMS installation inside the rundir).
+# The campaign (rundir) is read in place.
+./psims -s local -p "%s/params" -c "%s" -g "%s/gridList.txt"
@@ -26,6 +26,7 @@ from core.lib.logging.stream import WebStream
 from core.modules.statistics.StatsCenter import StatsCenter
 from frontend.web import WebServer
 from core.modules.data_updater.SoilsUpdater import SoilsUpdater
+from core.modules.simulations_manager.soil.SoilDAO import SoilDAO
 
 
 __author__ = 'Federico Schmidt'
@@ -95,6 +96,12 @@ class Main:
         self.system_config.logger.addHandler(web_log_stream)
         self.system_config.logger.info("System startup.")
 
+        # Read every soil into the soils cache in the background.
+        soils_warm_up_thread = threading.Thread(target=SoilDAO.warm_up, name='Soils warm-up',
+                                                kwargs={'max_workers': self.system_config.max_parallelism})
+        soils_warm_up_thread.daemon = True
+        soils_warm_up_thread.start()
+
         # Start the web server so we can start monitoring system tasks.
         web_server_thread = threading.Thread(target=self.web_server.start, name='Webserver')
         web_server_thread.daemon = True
@@ -143,6 +150,9 @@ class Main:
         raise KeyboardInterrupt
 
 
-main = Main()
-# Start running the system.
-main.run()
+if __name__ == '__main__':
+    # Worker processes (see DatabaseWeatherSeries.writers_pool and RunDSSAT) import this module too, they must not
+    # start the system.
+    main = Main()
+    # Start running the system.
+    main.run()
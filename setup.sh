@@ -141,6 +141,10 @@ elif [[ ! -d .tmp/rundir ]]; then
     mkdir .tmp/rundir
 fi
 
+# Build the soils catalog (data/soils.catalog) from the soil files
+python3 -m core.modules.simulations_manager.soil.SoilCatalog
+if [[ $? -ne 0 ]] ; then exit 1; fi
+
 # Set backend PostgreSQL database address
 if [[ ! ${NON_IT_MODE} ]]; then
     read -p "Back-end PostgreSQL database address [localhost]: " POSTGRES_DB_ADDRESS
@@ -285,6 +289,7 @@ if [[ ! ${DONT_RESTORE_POSTGRES} ]]; then
         pg_restore --host=localhost --username=postgres --dbname=crcsas --no-password --jobs=2 "./crcsas.dump"
         psql --host localhost --username=postgres --dbname=crcsas --no-password --quiet -f "./core/lib/SQL/Base Functions.sql"
         psql --host localhost --username=postgres --dbname=crcsas --no-password --quiet -f "./core/modules/data_updater/impute_script/Schema.sql"
+        psql --host localhost --username=postgres --dbname=crcsas --no-password --quiet -f "./core/modules/data_updater/impute_script/Incremental.sql"
         rm crcsas.dump crcsas.zip
     else
         if [[ -f crcsas.zip ]]; then
@@ -1,6 +1,9 @@
 import threading
 import time
+from pymongo.errors import BulkWriteError
+from pymongo.results import BulkWriteResult
 from core.lib.jobs.base import BaseJob
+from core.lib.jobs.monitor import NullMonitor
 
 __author__ = 'Federico Schmidt'
 
@@ -16,14 +19,15 @@ class TestJob(BaseJob):
 
 class ReaderThread(threading.Thread):
 
-    def __init__(self, rwlock, id, run_order):
+    def __init__(self, rwlock, id, run_order, priority=0):
         super(ReaderThread, self).__init__()
         self.rwlock = rwlock
         self.id = id
         self.run_order = run_order
+        self.priority = priority
 
     def run(self):
-        with self.rwlock.reader():
+        with self.rwlock.reader(self.priority):
             time.sleep(0.5)
             self.run_order.append(self.id)
 
@@ -41,3 +45,118 @@ class WriterThread(threading.Thread):
         with self.rwlock.writer(self.priority):
             time.sleep(1)
             self.run_order.append(self.id)
+
+
+class RecordingMonitor(NullMonitor):
+    def __init__(self):
+        super(RecordingMonitor, self).__init__()
+        self.values = []
+
+    def update_progress(self, new_value=None, job_status=None):
+        self.values.append(new_value)
+
+
+class FakeCursor(list):
+    def sort(self, field, direction=1):
+        return FakeCursor(sorted(self, key=lambda d: d[field], reverse=direction < 0))
+
+    def batch_size(self, size):
+        return self
+
+
+class FakeCollection(object):
+    """
+    An in-memory collection with the subset of the Pymongo API used by the database synchronization and the results
+    ingestion. Queries match fields by value or with the "$in" and "$gt" operators.
+    """
+    def __init__(self, documents=None, name=None, events=None, fail_with_code=None):
+        """
+        :param events: An optional list where an ("insert" or "bulk_write", collection name, ids) tuple is appended
+        with every write.
+        :param fail_with_code: If set, every inserted document fails with this error code.
+        """
+        self.documents = dict([(d['_id'], d) for d in documents or []])
+        self.name = name
+        self.events = events if events is not None else []
+        self.fail_with_code = fail_with_code
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def matches(document, query):
+        for field, condition in query.items():
+            value = document.get(field)
+            if isinstance(condition, dict):
+                if '$in' in condition and value not in condition['$in']:
+                    return False
+                if '$gt' in condition and (value is None or not value > condition['$gt']):
+                    return False
+            elif value != condition:
+                return False
+        return True
+
+    def find(self, query=None, projection=None):
+        with self.lock:
+            documents = [d for d in self.documents.values() if self.matches(d, query or {})]
+        if projection:
+            documents = [dict([(f, d[f]) for f in ['_id'] + list(projection) if f in d]) for d in documents]
+        return FakeCursor(documents)
+
+    def find_one(self, query):
+        documents = self.find(query)
+        return documents[0] if len(documents) > 0 else None
+
+    def count_documents(self, query):
+        return len(self.find(query))
+
+    def create_index(self, keys):
+        pass
+
+    def insert_many(self, documents, ordered=True):
+        errors = []
+        with self.lock:
+            for index, d in enumerate(documents):
+                if self.fail_with_code:
+                    errors.append({'index': index, 'code': self.fail_with_code})
+                elif d['_id'] in self.documents:
+                    errors.append({'index': index, 'code': 11000})
+                else:
+                    self.documents[d['_id']] = d
+            self.events.append(('insert', self.name, [d['_id'] for d in documents]))
+        if len(errors) > 0:
+            raise BulkWriteError({'writeErrors': errors})
+
+    def bulk_write(self, requests, ordered=True):
+        """
+        Runs UpdateOne requests with a "$set" update.
+        """
+        matched = 0
+        with self.lock:
+            for request in requests:
+                document = self.documents.get(request._filter['_id'])
+                if document is not None:
+                    document.update(request._doc['$set'])
+                    matched += 1
+            self.events.append(('bulk_write', self.name, [request._filter['_id'] for request in requests]))
+        return BulkWriteResult({'nMatched': matched}, True)
+
+    def replace_one(self, query, document, upsert=False):
+        with self.lock:
+            self.documents[query['_id']] = dict(document)
+
+
+class FakeDatabase(dict):
+    """
+    A dict of FakeCollections, created when they're first accessed, that share a list of events.
+    """
+    def __init__(self, collections=None):
+        super(FakeDatabase, self).__init__()
+        self.events = []
+        for name, documents in (collections or {}).items():
+            self[name] = FakeCollection(documents, name=name, events=self.events)
+
+    def __missing__(self, name):
+        self[name] = FakeCollection(name=name, events=self.events)
+        return self[name]
+
+    def __getattr__(self, name):
+        return self[name]
@@ -0,0 +1,84 @@
+import threading
+import time
+import unittest
+import psycopg2.extensions
+from core.lib.utils.database import PostgreSQLConnectionPool
+
+__author__ = 'Federico Schmidt'
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.closed = 0
+        self.rollbacks = 0
+        self.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def get_transaction_status(self):
+        return self.transaction_status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.created = []
+
+        def connect():
+            c = FakeConnection()
+            self.created.append(c)
+            return c
+
+        self.pool = PostgreSQLConnectionPool(connect, max_connections=2)
+
+    def test_connections_are_reused(self):
+        with self.pool.connection() as c1:
+            pass
+        with self.pool.connection() as c2:
+            pass
+        self.assertIs(c1, c2)
+        self.assertEqual(len(self.created), 1)
+
+    def test_concurrent_checkouts_use_different_connections(self):
+        with self.pool.connection() as c1:
+            with self.pool.connection() as c2:
+                self.assertIsNot(c1, c2)
+        self.assertEqual(len(self.created), 2)
+
+    def test_size_limit(self):
+        c1 = self.pool.checkout()
+        c2 = self.pool.checkout()
+        checked_out = []
+
+        t = threading.Thread(target=lambda: checked_out.append(self.pool.checkout()))
+        t.start()
+        time.sleep(0.2)
+        # The pool is exhausted, the thread must wait for a connection to be returned.
+        self.assertEqual(len(checked_out), 0)
+
+        self.pool.checkin(c1)
+        t.join()
+        self.assertIs(checked_out[0], c1)
+        self.pool.checkin(c2)
+
+    def test_checkout_timeout(self):
+        self.pool.checkout_timeout = 0.1
+        self.pool.checkout()
+        self.pool.checkout()
+        self.assertRaises(RuntimeError, self.pool.checkout)
+
+    def test_broken_connections_are_replaced(self):
+        with self.pool.connection() as c1:
+            c1.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        # Open transactions are rolled back when the connection is returned.
+        self.assertEqual(c1.rollbacks, 1)
+
+        c1.close()
+        with self.pool.connection() as c2:
+            self.assertIsNot(c1, c2)
+            self.assertFalse(c2.closed)
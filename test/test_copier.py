@@ -0,0 +1,33 @@
+import unittest
+from core.modules.data_updater.copier import DocumentsCopier
+from test.mock import FakeCollection
+
+__author__ = 'Federico Schmidt'
+
+
+class TestDocumentsCopier(unittest.TestCase):
+
+    def setUp(self):
+        self.source = FakeCollection([{'_id': i} for i in range(100)])
+
+    def test_copy(self):
+        # Already present documents are skipped.
+        target = FakeCollection([{'_id': 5}])
+
+        with DocumentsCopier(self.source, target, writers=3, batch_size=7) as copier:
+            copier.copy(list(range(0, 100, 2)))
+
+        self.assertEqual(sorted(target.documents.keys()), sorted([5] + list(range(0, 100, 2))))
+
+    def test_writer_errors_are_raised(self):
+        target = FakeCollection(fail_with_code=121)
+
+        def copy():
+            with DocumentsCopier(self.source, target, writers=2, batch_size=10) as copier:
+                copier.copy(list(range(100)))
+
+        self.assertRaises(RuntimeError, copy)
+
+
+if __name__ == '__main__':
+    unittest.main()
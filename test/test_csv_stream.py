@@ -0,0 +1,37 @@
+from core.lib.io.stream import CSVBodyStream
+
+__author__ = 'Federico Schmidt'
+
+import unittest
+
+
+class TestCSVBodyStream(unittest.TestCase):
+
+    def setUp(self):
+        self.payload = b'omm_id\tfecha\ttmax\n87585\t2016-01-01\t30.5\n87585\t2016-01-02\t\\N\n\n'
+
+    def chunks(self, size):
+        return [self.payload[i:i + size] for i in range(0, len(self.payload), size)]
+
+    def test_skips_header_and_trailing_whitespace(self):
+        for chunk_size in [1, 3, 7, len(self.payload)]:
+            stream = CSVBodyStream(self.chunks(chunk_size))
+            data = b''
+            while True:
+                read = stream.read(4)
+                if not read:
+                    break
+                data += read
+            self.assertEqual(data, b'87585\t2016-01-01\t30.5\n87585\t2016-01-02\t\\N')
+            self.assertEqual(stream.data_size, len(data))
+
+    def test_readline(self):
+        stream = CSVBodyStream(self.chunks(5))
+        self.assertEqual(stream.readline(), b'87585\t2016-01-01\t30.5\n')
+        self.assertEqual(stream.readline(), b'87585\t2016-01-02\t\\N')
+        self.assertEqual(stream.readline(), b'')
+
+    def test_header_only(self):
+        stream = CSVBodyStream([b'omm_id\tfe', b'cha\n', b'\n'])
+        self.assertEqual(stream.read(), b'')
+        self.assertEqual(stream.data_size, 0)
@@ -0,0 +1,107 @@
+import threading
+import time
+import unittest
+from pymongo.errors import AutoReconnect
+from core.lib.sync import JobsLock
+from core.lib.utils.extended_collections import DotDict
+from core.modules.simulations_manager.ForecastManager import ForecastManager
+
+__author__ = 'Federico Schmidt'
+
+
+class FakeSimulation(dict):
+    def __init__(self, sim_id):
+        super(FakeSimulation, self).__init__()
+        self.sim_id = sim_id
+
+    def persistent_view(self):
+        return {'_id': self.sim_id}
+
+
+class InterruptedCollection(object):
+    """
+    Writes the first documents of each insert and then loses the connection.
+    """
+    def __init__(self, ids, written_count):
+        self.documents = set(ids)
+        self.written_count = written_count
+
+    def find(self, query, projection=None):
+        return [{'_id': i} for i in query['_id']['$in'] if i in self.documents]
+
+    def insert_many(self, documents, ordered=True):
+        self.documents |= set([d['_id'] for d in documents[:self.written_count]])
+        raise AutoReconnect('Connection lost.')
+
+
+class TestForecastManager(unittest.TestCase):
+
+    @staticmethod
+    def forecast_manager(psims_slots):
+        system_config = DotDict({
+            'system_config_yaml': {},
+            'max_parallelism': 4,
+            'psims_slots': psims_slots,
+            'jobs_lock': JobsLock(max_parallel_tasks=4)
+        })
+        return ForecastManager(scheduler=None, system_config=system_config, weather_updater=None)
+
+    def test_forecasts_exclude_blocking_jobs(self):
+        manager = self.forecast_manager(psims_slots=2)
+        jobs_lock = manager.system_config.jobs_lock
+        events = []
+
+        def forecast(name, priority=0):
+            with manager.forecast_slot(priority):
+                events.append('%s started' % name)
+                time.sleep(0.5)
+                events.append('%s finished' % name)
+
+        def blocking_job():
+            with jobs_lock.blocking_job():
+                events.append('blocking job')
+
+        threads = [threading.Thread(target=forecast, args=('forecast 1',)),
+                   threading.Thread(target=forecast, args=('forecast 2',)),
+                   threading.Thread(target=blocking_job),
+                   threading.Thread(target=forecast, args=('forecast 3', 0)),
+                   threading.Thread(target=forecast, args=('forecast 4', 0)),
+                   threading.Thread(target=forecast, args=('forecast 5', 1))]
+
+        for t in threads:
+            t.start()
+            # Small sleep to ensure threads are executed in this order.
+            time.sleep(0.05)
+
+        # Two forecasts run at once, the blocking job waits for them.
+        self.assertEqual(jobs_lock.active_readers, 2)
+        self.assertEqual(len(jobs_lock.queued_writers), 1)
+
+        for t in threads:
+            t.join()
+
+        self.assertEqual(set(events[:4]), {'forecast 1 started', 'forecast 2 started',
+                                           'forecast 1 finished', 'forecast 2 finished'})
+        # The blocking job runs once both forecasts finish, then the most prioritized forecast takes the first slot.
+        self.assertEqual(events[4], 'blocking job')
+        self.assertEqual(set(events[5:7]), {'forecast 5 started', 'forecast 3 started'})
+        # Never more than two forecasts at once.
+        running = 0
+        for event in events:
+            running += 1 if event.endswith('started') else -1 if event.endswith('finished') else 0
+            self.assertTrue(running <= 2)
+
+    def test_insert_rollback_keeps_existing_simulations(self):
+        manager = self.forecast_manager(psims_slots=1)
+        # The first two simulations were inserted by a previous run.
+        collection = InterruptedCollection(ids=['a', 'b'], written_count=3)
+        inserted_ids = []
+
+        self.assertRaises(AutoReconnect, manager.insert_simulations, collection,
+                          [FakeSimulation(sim_id) for sim_id in ['a', 'b', 'c', 'd']], inserted_ids)
+        # Only the simulations this insert may have written are rolled back.
+        self.assertEqual(sorted(inserted_ids), ['c', 'd'])
+
+
+if __name__ == '__main__':
+    unittest.main()
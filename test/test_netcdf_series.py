@@ -1,7 +1,12 @@
 import os
+import shutil
+import tempfile
+import numpy as np
+from netCDF4 import Dataset
 from core.lib.utils.extended_collections import DotDict
 from core.model.Location import Location
 from core.modules.simulations_manager.weather.NetCDFSeriesMaker import NetCDFSeriesMaker
+from core.modules.simulations_manager.weather.NetCDFSource import CoordinateIndex, NetCDFSource
 
 __author__ = 'Federico Schmidt'
 
@@ -46,3 +51,51 @@ class TestNetCDFSeries(unittest.TestCase):
         t2 = self.series_maker.get_access_tuple(self.default_dimensions, self.default_varnames, x_idx=1, y_idx=1, scen_number=0)
 
         self.assertEqual(t1, t2)
+
+    def test_coordinate_index(self):
+        # Projected coordinates are usually stored in descending order for the y axis.
+        y_index = CoordinateIndex([5910000, 5907500, 5905000, 5902500])
+
+        self.assertEqual(y_index.nearest(5907500), 1)
+        self.assertEqual(y_index.nearest('5902500'), 3)
+        # Nearest cell within half a cell size.
+        self.assertEqual(y_index.nearest(5906300), 1)
+        self.assertEqual(y_index.nearest(5911000), 0)
+        self.assertRaises(RuntimeError, y_index.nearest, 5900000)
+
+    def test_block_reads(self):
+        folder = tempfile.mkdtemp()
+        file_path = os.path.join(folder, 'weather.nc')
+
+        nc = Dataset(file_path, mode='w')
+        nc.createDimension('time', 10)
+        nc.createDimension('x', 6)
+        nc.createDimension('y', 6)
+        nc.createVariable('time', 'i4', ('time',)).units = 'Days since 2015-05-01'
+        nc.variables['time'][:] = np.arange(10)
+        nc.createVariable('x', 'f8', ('x',))[:] = np.arange(6)
+        nc.createVariable('y', 'f8', ('y',))[:] = np.arange(6)
+        for v in NetCDFSource.climate_variables:
+            variable = nc.createVariable(v, 'f4', ('time', 'y', 'x'), chunksizes=(10, 3, 3), zlib=True)
+            variable[:] = np.random.uniform(0, 30, size=(10, 6, 6))
+        nc.close()
+
+        source = NetCDFSource(file_path, dict([(v, v) for v in NetCDFSource.climate_variables + ['x', 'y', 'time']],
+                                              scen=None))
+        try:
+            self.assertEqual(source.block_size, (3, 3))
+            expected = source.read_cell(1, 4)
+
+            source.prefetch([(1, 4), (2, 5)])
+            clim = source.read_cell(1, 4)
+            self.assertEqual(len(source.blocks), 1)
+            source.read_cell(2, 5)
+            # Blocks are released once every registered cell has been read.
+            self.assertEqual(len(source.blocks), 0)
+
+            for v in NetCDFSource.climate_variables:
+                self.assertEqual(clim[v].shape, (1, 10))
+                self.assertTrue(np.array_equal(clim[v], expected[v]))
+        finally:
+            source.close()
+            shutil.rmtree(folder)
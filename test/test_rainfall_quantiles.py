@@ -0,0 +1,42 @@
+import numpy as np
+from core.modules.data_updater.WeatherUpdater import WeatherUpdater
+
+__author__ = 'Federico Schmidt'
+
+import unittest
+
+
+class TestRainfallQuantiles(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        self.stations = {
+            87544: np.cumsum(random.uniform(0, 10, size=(30, 366)), axis=1),
+            87585: np.cumsum(random.uniform(0, 10, size=(12, 365)), axis=1)
+        }
+        self.records = [(omm_id, 1970 + campaign, sums[campaign].tolist())
+                        for omm_id, sums in sorted(self.stations.items()) for campaign in range(len(sums))]
+
+    def test_quantiles_match_per_station(self):
+        stations, cube, invalid_stations = WeatherUpdater.parse_rainfalls(iter(self.records))
+        self.assertEqual(stations, [87544, 87585])
+        self.assertEqual(cube.shape, (2, 30, 365))
+        self.assertEqual(invalid_stations, [])
+
+        quantiles = WeatherUpdater.get_quantiles(cube, quantiles=[5, 25, 50, 75, 95])
+
+        for idx, omm_id in enumerate(stations):
+            station_sums = self.stations[omm_id][:, 0:365]
+            for q in [5, 25, 50, 75, 95]:
+                np.testing.assert_allclose(quantiles[str(q)][idx], np.percentile(station_sums, q=q, axis=0))
+
+    def test_missing_values(self):
+        self.records[3][2][100] = None
+        stations, cube, invalid_stations = WeatherUpdater.parse_rainfalls(iter(self.records))
+        self.assertEqual(stations, [87585])
+        self.assertEqual(invalid_stations, [87544])
+        self.assertEqual(cube.shape, (1, 12, 365))
+
+
+if __name__ == '__main__':
+    unittest.main()
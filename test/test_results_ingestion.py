@@ -0,0 +1,152 @@
+import threading
+import unittest
+from pymongo import MongoClient
+from pymongo.errors import ConnectionFailure
+from core.modules.simulations_manager.ResultsIngestion import ResultsIngestion, find_negative_hwam, \
+    find_negative_hwam_simulations
+from test.mock import FakeCollection, RecordingMonitor
+
+__author__ = 'Federico Schmidt'
+
+
+def fake_collection(count):
+    return FakeCollection([{'_id': i} for i in range(count)])
+
+
+def written_batches(collection):
+    return [len(ids) for event, name, ids in collection.events if event == 'bulk_write']
+
+
+def results(hwam):
+    return {'cycle_results': {'HWAM': {'scenarios': [{'scenario_name': '2001', 'value': hwam}]}}}
+
+
+class TestResultsIngestion(unittest.TestCase):
+
+    def test_ingestion(self):
+        collection = fake_collection(10)
+        monitor = RecordingMonitor()
+
+        with ResultsIngestion(collection, list(range(10)), batch_size=4, check_hwam=True,
+                              progress_monitor=monitor) as ingestion:
+            for i in range(10):
+                ingestion.put(i, results(1000 + i))
+        ingestion.validate()
+
+        self.assertEqual(sum(written_batches(collection)), 10)
+        self.assertTrue(max(written_batches(collection)) <= 4)
+        self.assertEqual(monitor.values[-1], 10)
+        self.assertEqual(collection.documents[3]['cycle_results']['HWAM']['scenarios'][0]['value'], 1003)
+
+    def test_pending_batches_are_bounded(self):
+        collection = fake_collection(50)
+        blocked = threading.Event()
+        bulk_write = collection.bulk_write
+
+        def slow_bulk_write(requests, ordered=True):
+            # The database doesn't answer until every result was put.
+            blocked.wait()
+            return bulk_write(requests, ordered)
+        collection.bulk_write = slow_bulk_write
+
+        with ResultsIngestion(collection, list(range(50)), batch_size=5, max_pending_batches=2) as ingestion:
+            putter = threading.Thread(target=lambda: [ingestion.put(i, results(1000)) for i in range(50)])
+            putter.start()
+            putter.join(timeout=0.5)
+
+            # One batch being written, two waiting and the current one.
+            self.assertTrue(putter.is_alive())
+            self.assertTrue(len(ingestion.pending) >= 50 - 4 * 5)
+
+            blocked.set()
+            putter.join()
+        ingestion.validate()
+        self.assertEqual(sum(written_batches(collection)), 50)
+
+    def test_invalid_results(self):
+        collection = fake_collection(3)
+
+        with ResultsIngestion(collection, [0, 1, 2], check_hwam=True) as ingestion:
+            ingestion.put(0, results(1000))
+            # Negative yields, repeated and unexpected simulations are rejected.
+            self.assertRaises(RuntimeError, ingestion.put, 1, results(-99))
+            self.assertRaises(RuntimeError, ingestion.put, 0, results(1000))
+            self.assertRaises(RuntimeError, ingestion.put, 5, results(1000))
+
+        # The results of two simulations are missing.
+        self.assertRaises(RuntimeError, ingestion.validate)
+
+
+def simulation(sim_id, *scenarios_values):
+    """
+    :param scenarios_values: The HWAM value of each scenario, a list of values when the scenarios have nested years.
+    """
+    scenarios = []
+    for scen_idx, value in enumerate(scenarios_values):
+        if isinstance(value, list):
+            value = [{'value': v} for v in value]
+        scenarios.append({'scenario_name': str(2001 + scen_idx), 'value': value})
+    return {'_id': sim_id, 'name': 'Simulation %s' % sim_id,
+            'cycle_results': {'HWAM': {'scenarios': scenarios}},
+            'daily_results': {'SWTD': {'scenarios': [{'scenario_name': '2001', 'value': [-1, -2]}]}}}
+
+
+hwam_simulations = [
+    simulation('scalar_ok', 1000, 2000),
+    simulation('scalar_negative', 1000, -99),
+    simulation('nested_ok', [1000, 2000], [3000, 4000]),
+    simulation('nested_negative', [1000, 2000], [3000, -99]),
+    simulation('no_hwam', 1000)
+]
+del hwam_simulations[-1]['cycle_results']['HWAM']
+
+
+class RecordingCollection(object):
+    def __init__(self):
+        self.pipelines = []
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        return []
+
+
+class TestNegativeHWAMSimulations(unittest.TestCase):
+
+    def test_results_are_not_transferred(self):
+        collection = RecordingCollection()
+        find_negative_hwam_simulations(collection, [s['_id'] for s in hwam_simulations])
+
+        # Only the fields needed to find the negative values are projected.
+        for stage in collection.pipelines[0]:
+            self.assertTrue('daily_results' not in str(stage))
+            if '$project' in stage:
+                self.assertTrue('cycle_results' not in stage['$project'])
+
+    def test_matches_find_negative_hwam(self):
+        client = MongoClient(serverSelectionTimeoutMS=1000)
+        try:
+            client.admin.command('ping')
+        except ConnectionFailure:
+            self.skipTest('MongoDB isn\'t available.')
+
+        db = client['test_results_ingestion']
+        try:
+            db.simulations.insert_many(hwam_simulations)
+            values = find_negative_hwam_simulations(db.simulations, [s['_id'] for s in hwam_simulations])
+        finally:
+            client.drop_database(db.name)
+
+        expected = []
+        for sim in hwam_simulations:
+            negative_hwam = find_negative_hwam(sim['cycle_results'])
+            if negative_hwam:
+                expected.append((sim['_id'], sim['name'], negative_hwam[0], negative_hwam[1]))
+
+        # Both scalar and nested-year values are found, the year index is None for scalar values.
+        self.assertEqual([(v[0], v[2], v[3]) for v in expected], [('scalar_negative', 1, None),
+                                                                  ('nested_negative', 1, 1)])
+        self.assertEqual(sorted(values), sorted(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+from core.modules.simulations_manager.RunDSSAT import read_summary, read_daily_outputs, cycle_results, daily_results
+
+__author__ = 'Federico Schmidt'
+
+summary_file = '''*SUMMARY : XX1234567 DSSAT Cropping System Model
+
+!IDENTIFIERS.......................... TREATMENT................ DATES...........................
+@   RUNNO   TRNO R# O# C# CR MODEL... TNAM..................... FNAM....    PDAT    MDAT    HWAM
+        1      1  0  0  1 MZ MZCER045 First scenario            IBMZ0001 2016260 2017060    4500
+        2      2  0  0  1 MZ MZCER045 Second scenario           IBMZ0001 2016260 2017061     -99
+'''
+
+daily_file = '''*DSSAT Cropping System Model
+
+*RUN   1        : First scenario
+ MODEL          : MZCER045 - Maize
+@YEAR DOY   DAS   WSGD   SWTD
+ 2016 260     0  0.000    120
+ 2016 261     1  0.500    118
+
+*RUN   2        : Second scenario
+ MODEL          : MZCER045 - Maize
+@YEAR DOY   DAS   WSGD   SWTD
+ 2016 260     0  0.100     90
+ 2016 261     1 ******
+'''
+
+
+class TestRunDSSAT(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_file(self, file_name, content):
+        file_path = os.path.join(self.temp_dir, file_name)
+        with open(file_path, mode='w') as f:
+            f.write(content)
+        return file_path
+
+    def test_cycle_results(self):
+        runs = read_summary(self.write_file('Summary.OUT', summary_file))
+        self.assertEqual([(run['TRNO'], run['PDAT'], run['MDAT'], run['HWAM']) for run in runs],
+                         [(1, 2016260, 2017060, 4500), (2, 2016260, 2017061, -99)])
+
+        results = cycle_results(runs, ['HWAM'], ['2001', '2002'], 1)
+        self.assertEqual(results, {'HWAM': {'scenarios': [{'scenario_name': '2001', 'value': 4500},
+                                                          {'scenario_name': '2002', 'value': -99}]}})
+
+        # Two years of one scenario.
+        results = cycle_results(runs, ['MDAT'], ['2001'], 2)
+        self.assertEqual(results['MDAT']['scenarios'][0]['value'], [{'value': 2017060}, {'value': 2017061}])
+
+        self.assertRaises(RuntimeError, cycle_results, runs, ['HWAM'], ['2001'], 1)
+
+    def test_daily_results(self):
+        runs = read_daily_outputs(self.write_file('PlantGro.OUT', daily_file))
+        results = daily_results([runs], ['SWTD', 'WSGD'], ['2001', '2002'], 1)
+
+        # Empty and overflowed values are omitted (replaced by 0).
+        self.assertEqual(results, {
+            'SWTD': {'scenarios': [{'scenario_name': '2001', 'value': [120, 118]},
+                                   {'scenario_name': '2002', 'value': [90, 0]}]},
+            'WSGD': {'scenarios': [{'scenario_name': '2001', 'value': [0.0, 0.5]},
+                                   {'scenario_name': '2002', 'value': [0.1, 0]}]}
+        })
+
+        # Two years of one scenario.
+        results = daily_results([runs], ['SWTD'], ['2001'], 2)
+        self.assertEqual(results['SWTD']['scenarios'][0]['value'], [{'value': [120, 118]}, {'value': [90, 0]}])
+
+        # Variables missing from every output file are left out.
+        self.assertEqual(daily_results([runs], ['ETAC'], ['2001', '2002'], 1), {})
+
+if __name__ == '__main__':
+    unittest.main()
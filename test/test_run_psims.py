@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+from core.modules.simulations_manager.RunpSIMS import RunpSIMS
+from test.mock import RecordingMonitor
+
+__author__ = 'Federico Schmidt'
+
+
+class TestRunpSIMS(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        # Error dumps are written in the working directory.
+        os.chdir(self.temp_dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.temp_dir)
+
+    def write_script(self, content):
+        script_path = os.path.join(self.temp_dir, 'run_psims.sh')
+        with open(script_path, mode='w') as f:
+            f.write(content)
+        return script_path
+
+    def test_progress(self):
+        lines = ['echo "Progress: Selecting site:%d Active:2 Finished successfully:%d"' % (20000 - i, i)
+                 for i in range(0, 20000, 1000)]
+        script = self.write_script('\n'.join(['echo "Swift started"'] + lines +
+                                             ['printf "Progress: Finished successfully:20000"', 'exit 3']))
+        monitor = RecordingMonitor()
+
+        self.assertEqual(RunpSIMS().__run__(script, 'test', 20000, monitor, False), 3)
+        # Every progress line is parsed, including the last one (without a trailing new line).
+        self.assertEqual(monitor.values, list(range(0, 20000, 1000)) + [20000])
+
+    def test_failed_task(self):
+        script = self.write_script('echo "Progress: Active:1 Failed:1"\nsleep 30\n')
+        monitor = RecordingMonitor()
+
+        self.assertNotEqual(RunpSIMS().__run__(script, 'test', 1, monitor, False), 0)
+        self.assertEqual(monitor.values, [])
+        self.assertEqual(len([f for f in os.listdir(self.temp_dir) if f.startswith('ERR')]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from core.modules.simulations_manager.soil.SoilDAO import SoilDAO, soils_dict
+
+__author__ = 'Federico Schmidt'
+
+
+class TestSoilCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.soil_path = os.path.join(self.temp_dir, 'test_soil.json')
+        self.write_soil(['020', '045'])
+        soils_dict['test_soil'] = self.soil_path
+
+    def tearDown(self):
+        del soils_dict['test_soil']
+        shutil.rmtree(self.temp_dir)
+
+    def write_soil(self, layers_bounds):
+        layers = [{'sllb': sllb, 'slll': '0.1', 'sldul': '0.3', 'slsat': '0.4'} for sllb in layers_bounds]
+        with open(self.soil_path, mode='w', encoding='latin-1') as f:
+            json.dump({'soils': [{'soil_id': 'TS00000001', 'soilLayer': layers}]}, f)
+
+    def test_soils_are_cached(self):
+        soil = SoilDAO.get_soil('test_soil')
+        self.assertIs(SoilDAO.get_soil('test_soil'), soil)
+        self.assertEqual(SoilDAO.get_layers_bounds('test_soil'), [20, 45])
+        self.assertAlmostEqual(SoilDAO.get_metrics('test_soil')['max_available_water'], 90.)
+
+    def test_modified_soils_are_read_again(self):
+        soil = SoilDAO.get_soil('test_soil')
+        self.write_soil(['020', '045', '100'])
+        stat = os.stat(self.soil_path)
+        # Make sure the modification time changes, even in file systems with a coarse resolution.
+        os.utime(self.soil_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+        self.assertIsNot(SoilDAO.get_soil('test_soil'), soil)
+        self.assertEqual(SoilDAO.get_layers_bounds('test_soil'), [20, 45, 100])
+
+    def test_missing_soils(self):
+        self.assertIsNone(SoilDAO.get_soil('missing_soil'))
+        self.assertRaises(RuntimeError, SoilDAO.get_layers_bounds, 'missing_soil')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from core.modules.simulations_manager.soil import SoilDAO as soil_dao
+from core.modules.simulations_manager.soil.SoilCatalog import SoilCatalog
+
+__author__ = 'Federico Schmidt'
+
+
+class TestSoilCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.catalog_path = os.path.join(self.temp_dir, 'soils.catalog')
+        self.soils = {}
+
+        for soil_idx, layers_bounds in enumerate([['020', '045'], ['015', '030', '100'], []]):
+            soil_id = 'TS%08d' % soil_idx
+            soil = {'soils': [{'soil_id': soil_id, 'soil_name': 'Cañada',
+                               'soilLayer': [{'sllb': sllb, 'slll': '0.1'} for sllb in layers_bounds]}]}
+            soil_path = os.path.join(self.temp_dir, soil_id + '.json')
+            with open(soil_path, mode='w', encoding='latin-1') as f:
+                json.dump(soil, f, ensure_ascii=False)
+            self.soils[soil_id] = (soil_path, soil)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_build(self):
+        soil_files = dict([(soil_id, soil_path) for soil_id, (soil_path, _) in self.soils.items()])
+        self.assertEqual(SoilCatalog.build(soil_files, self.catalog_path), 3)
+
+        catalog = SoilCatalog.open(self.catalog_path)
+        self.assertEqual(len(catalog), 3)
+        self.assertEqual(catalog.sources(), soil_files)
+
+        for soil_id, (_, soil) in self.soils.items():
+            self.assertEqual(catalog.get(soil_id), soil)
+            self.assertEqual(list(catalog.layers_bounds(soil_id)),
+                             [int(layer['sllb']) for layer in soil['soils'][0]['soilLayer']])
+
+    def test_invalid_catalog(self):
+        self.assertIsNone(SoilCatalog.open(self.catalog_path))
+
+        with open(self.catalog_path, mode='wb') as f:
+            f.write(b'not a catalog' * 10)
+        self.assertIsNone(SoilCatalog.open(self.catalog_path))
+
+    def test_stale_catalog(self):
+        soil_files = dict([(soil_id, soil_path) for soil_id, (soil_path, _) in self.soils.items()])
+        SoilCatalog.build(soil_files, self.catalog_path)
+        catalog = SoilCatalog.open(self.catalog_path)
+        self.assertFalse(soil_dao.catalog_is_stale(catalog, soil_files))
+
+        # A soil file modified after the catalog was built.
+        soil_path = soil_files['TS00000000']
+        stat = os.stat(soil_path)
+        os.utime(soil_path, ns=(stat.st_atime_ns, catalog.file_stat[0] + 10 ** 9))
+        self.assertTrue(soil_dao.catalog_is_stale(catalog, soil_files))
+
+        # A soil file added after the catalog was built.
+        os.utime(soil_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        soil_files['TS00000003'] = soil_path
+        self.assertTrue(soil_dao.catalog_is_stale(catalog, soil_files))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -174,6 +174,28 @@ class TestPrioritizedRWLock(unittest.TestCase):
         # Once the writer finishes, the two readers should run parallel.
         self.assertEqual(lock.active_readers, 2)
 
+    def test_jobs_lock_readers_priority(self):
+        lock = JobsLock(max_parallel_tasks=1)
+        _threads = []
+        run_order = []
+
+        _threads.append(ReaderThread(lock, "reader 1", run_order))
+        _threads.append(ReaderThread(lock, "reader 2", run_order, priority=0))
+        _threads.append(ReaderThread(lock, "reader 3", run_order, priority=1))  # This reader should run second.
+
+        for t in _threads:
+            t.start()
+            # Small sleep to ensure threads are executed in this order.
+            time.sleep(0.05)
+
+        self.assertEqual(lock.active_readers, 1)
+        self.assertEqual(lock.waiting_readers, 2)
+
+        for t in _threads:
+            t.join()
+
+        self.assertEqual(run_order, ["reader 1", "reader 3", "reader 2"])
+
     def test_jobs_lock_readers_parallelism(self):
         lock = JobsLock(max_parallel_tasks=2)
         _threads = []
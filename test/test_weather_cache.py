@@ -0,0 +1,52 @@
+import shutil
+import tempfile
+from datetime import date
+from core.modules.simulations_manager.weather.WeatherScenarioCache import WeatherScenarioCache
+
+__author__ = 'Federico Schmidt'
+
+import unittest
+
+
+class TestWeatherScenarioCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+        self.cache = WeatherScenarioCache(self.cache_path)
+        self.columns = ('fecha', 'fecha_original', 'tmax', 'tmin', 'prcp', 'rad')
+        self.rows = [
+            (date(1950, 3, 1), date(1981, 3, 1), 30.5, 18.0, 0.0, 22.1),
+            (date(1950, 3, 2), date(1981, 3, 2), 29.0, None, 12.5, 15.0)
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path)
+
+    def test_disabled_without_config(self):
+        self.assertIsNone(WeatherScenarioCache.from_config({}))
+        self.assertIsNone(WeatherScenarioCache.from_config({'paths': {}}))
+
+    def test_rows_round_trip(self):
+        array = WeatherScenarioCache.to_array(self.rows, self.columns)
+        self.assertEqual(WeatherScenarioCache.to_rows(array), self.rows)
+
+    def test_put_and_get(self):
+        key = WeatherScenarioCache.key('serie_agraria', 87585, 1981, 5)
+        self.assertIsNone(self.cache.get(key, self.cache.data_version()))
+
+        self.cache.put(key, self.cache.data_version(), WeatherScenarioCache.to_array(self.rows, self.columns))
+        cached = self.cache.get(key, self.cache.data_version())
+        self.assertEqual(WeatherScenarioCache.to_rows(cached), self.rows)
+
+        # Keys differing in the campaign first month are different entries.
+        self.assertIsNone(self.cache.get(WeatherScenarioCache.key('serie_agraria', 87585, 1981, 9),
+                                         self.cache.data_version()))
+
+    def test_version_bump_invalidates(self):
+        key = WeatherScenarioCache.key('campaigns', 87585, None, 5)
+        self.cache.put(key, self.cache.data_version(), WeatherScenarioCache.to_array(self.rows, self.columns))
+
+        self.assertEqual(self.cache.bump_data_version(), 1)
+        self.assertEqual(self.cache.data_version(), 1)
+        self.assertIsNone(self.cache.get(key, self.cache.data_version()))
+        self.assertIsNone(self.cache.get(key, 0))
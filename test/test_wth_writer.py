@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+from datetime import date, timedelta
+from core.lib.dssat.DSSATWthWriter import DSSATWthWriter
+from core.modules.simulations_manager.weather.WeatherScenarioCache import WeatherScenarioCache
+
+__author__ = 'Federico Schmidt'
+
+import unittest
+
+
+class Location(dict):
+    def __str__(self):
+        return 'Junin'
+
+
+class TestDSSATWthWriter(unittest.TestCase):
+    # Written by the row by row writer that used np.savetxt.
+    golden_file = os.path.join(os.path.dirname(__file__), 'data', 'golden_WTH00000.WTH')
+
+    def setUp(self):
+        self.output_path = tempfile.mkdtemp()
+        self.location = Location(coord_y='-34.55', coord_x='-60.92')
+
+        self.rows = [('fecha', 'fecha_original', 'tmax', 'tmin', 'prcp', 'rad')]
+        for i in range(560):
+            d = date(2014, 2, 1) + timedelta(days=i)
+            tmax = 25 + 10 * ((i * 7919) % 97) / 97.0 - (i % 13) * 0.05
+            tmin = -3.25 + ((i * 104729) % 89) / 4.0
+            prcp = None if i % 17 == 0 else round(((i * 31) % 23) * 1.15, 2) if i % 3 == 0 else 0.0
+            rad = 0.05 * (i % 400) + 1
+            self.rows.append((d, d, tmax, tmin, prcp, rad))
+
+    def tearDown(self):
+        shutil.rmtree(self.output_path)
+
+    def assertMatchesGolden(self, file_name):
+        with open(os.path.join(self.output_path, file_name), mode='rb') as f, open(self.golden_file, mode='rb') as g:
+            self.assertEqual(f.read(), g.read())
+
+    def test_rows_match_golden_file(self):
+        DSSATWthWriter.write_wth_file(0, iter(self.rows), self.output_path, self.location)
+        self.assertMatchesGolden('WTH00000.WTH')
+
+    def test_columns_match_golden_file(self):
+        columns = WeatherScenarioCache.to_array(self.rows[1:], self.rows[0])
+        content = DSSATWthWriter.write_wth_file(1, columns, self.output_path, self.location)
+        self.assertMatchesGolden('WTH00001.WTH')
+
+        self.assertEqual(content['fecha'][0], 14032)
+        # Missing values are written as zeros.
+        self.assertEqual(content['prcp'][0], 0)
+
+    def test_existing_file(self):
+        DSSATWthWriter.write_wth_file(0, iter(self.rows), self.output_path, self.location)
+        self.assertRaises(RuntimeError, DSSATWthWriter.write_wth_file, 0, iter(self.rows), self.output_path,
+                          self.location)
@@ -0,0 +1,99 @@
+import unittest
+from datetime import datetime, timedelta
+from core.lib.utils.database import SYNC_TIMESTAMP_FIELD
+from core.lib.utils.extended_collections import DotDict
+from core.modules.data_updater.sync import YieldDatabaseSync
+from test.mock import FakeDatabase
+
+__author__ = 'Federico Schmidt'
+
+
+def forecast(forecast_id, sync_timestamp):
+    return {'_id': forecast_id, SYNC_TIMESTAMP_FIELD: sync_timestamp,
+            'simulations': ['%s_sim_%d' % (forecast_id, i) for i in range(3)]}
+
+
+class TestYieldDatabaseSync(unittest.TestCase):
+
+    def setUp(self):
+        self.sync = YieldDatabaseSync(DotDict({
+            'system_config_yaml': {'yield_sync_batch_size': 2, 'yield_sync_writers': 2}
+        }))
+        self.watermark = datetime(2020, 1, 1)
+
+        forecasts = [forecast('f%d' % i, self.watermark - timedelta(days=1) + timedelta(hours=i)) for i in range(5)]
+        self.source_db = FakeDatabase({
+            'forecasts': forecasts,
+            'simulations': [{'_id': sim_id} for f in forecasts for sim_id in f['simulations']]
+        })
+
+    def sync_forecasts(self, target_db):
+        self.sync.__sync_collection__(collection_name='forecasts',
+                                      source_db=self.source_db,
+                                      target_db=target_db,
+                                      insert_documents=lambda forecasts: self.sync.__insert_forecasts__(
+                                          forecasts, self.source_db, target_db))
+
+    def assert_synchronized(self, target_db, forecasts_ids):
+        self.assertEqual(sorted(target_db.forecasts.documents), sorted(forecasts_ids))
+        self.assertEqual(sorted(target_db.simulations.documents),
+                         sorted(['%s_sim_%d' % (f, i) for f in forecasts_ids for i in range(3)]))
+
+        # Forecasts are inserted after their simulations.
+        inserted = []
+        for event, collection_name, ids in target_db.events:
+            if collection_name == 'forecasts':
+                for forecast_id in ids:
+                    self.assertTrue(set(self.source_db.forecasts.documents[forecast_id]['simulations']) <=
+                                    set(inserted))
+            inserted.extend(ids)
+
+    def test_first_sync(self):
+        # The first synchronization compares the ids of both databases.
+        target_db = FakeDatabase({'forecasts': [self.source_db.forecasts.documents['f1']],
+                                  'simulations': [{'_id': 'f1_sim_%d' % i} for i in range(3)]})
+        sync_start = datetime.utcnow()
+        self.sync_forecasts(target_db)
+
+        self.assert_synchronized(target_db, ['f0', 'f1', 'f2', 'f3', 'f4'])
+        # The forecast that was already there isn't copied again.
+        self.assertTrue(all(['f1' not in ids for event, name, ids in target_db.events]))
+
+        state = target_db.sync_state.documents['forecasts']
+        self.assertTrue(state['watermark'] >= sync_start)
+        self.assertTrue('ids_sync_last_id' not in state and 'ids_sync_start' not in state)
+
+    def test_resume_first_sync(self):
+        # An interrupted comparison of ids resumes after the last compared id.
+        target_db = FakeDatabase({'sync_state': [{'_id': 'forecasts', 'ids_sync_start': self.watermark,
+                                                  'ids_sync_last_id': 'f2'}]})
+        self.sync_forecasts(target_db)
+
+        self.assert_synchronized(target_db, ['f3', 'f4'])
+        self.assertEqual(target_db.sync_state.documents['forecasts'], {'_id': 'forecasts',
+                                                                       'watermark': self.watermark})
+
+    def test_watermark(self):
+        # Forecasts f0 to f3 were synchronized before, f3 has the watermark's timestamp.
+        watermark = self.source_db.forecasts.documents['f3'][SYNC_TIMESTAMP_FIELD]
+        # f2 is stamped inside the overlap (so it's read again), f4 is new.
+        self.source_db.forecasts.documents['f2'][SYNC_TIMESTAMP_FIELD] = watermark - timedelta(minutes=5)
+        self.source_db.forecasts.documents['f4'][SYNC_TIMESTAMP_FIELD] = watermark + timedelta(minutes=1)
+
+        target_db = FakeDatabase({
+            'sync_state': [{'_id': 'forecasts', 'watermark': watermark}],
+            'forecasts': [self.source_db.forecasts.documents[f] for f in ['f0', 'f1', 'f2', 'f3']],
+            'simulations': [{'_id': '%s_sim_%d' % (f, i)} for f in ['f0', 'f1', 'f2', 'f3'] for i in range(3)]
+        })
+        self.sync_forecasts(target_db)
+
+        self.assert_synchronized(target_db, ['f0', 'f1', 'f2', 'f3', 'f4'])
+        # The forecasts read again because of the overlap are skipped along with their simulations.
+        self.assertEqual(sorted([i for event, name, ids in target_db.events for i in ids]),
+                         ['f4', 'f4_sim_0', 'f4_sim_1', 'f4_sim_2'])
+        self.assertEqual(target_db.sync_state.documents['forecasts']['watermark'],
+                         watermark + timedelta(minutes=1))
+
+
+if __name__ == '__main__':
+    unittest.main()